@@ -0,0 +1,199 @@
+#
+# Choose the fixed points for correlation-based find-neighbors: points in
+# the background are skipped, points are added where the previous round's
+# matches fit poorly and the total is kept within a budget.
+#
+import typing
+
+import numpy as np
+from scipy import ndimage
+
+from .rigid_initialization import read_level
+
+#
+# The tissue mask is made at the finest level whose largest dimension is at
+# most this.
+#
+TISSUE_MASK_MAX_DIMENSION = 256
+#
+# Cells whose residual is above this percentile of the cells' residuals are
+# sampled at REFINE_FACTOR times the grid density in each direction.
+#
+REFINE_RESIDUAL_PERCENTILE = 75
+REFINE_FACTOR = 2
+
+
+def choose_mask_level(shapes:typing.Dict[int, typing.Sequence[int]]) -> int:
+    """
+    Choose the level for making the tissue mask
+
+    :param shapes: the z, y, x shape of each level, e.g. from
+    precomputed_level_shapes
+    :return: the finest level that is small enough or the coarsest level if
+    none are.
+    """
+    levels = sorted(shapes)
+    for level in levels:
+        if max(shapes[level]) <= TISSUE_MASK_MAX_DIMENSION:
+            return level
+    return levels[-1]
+
+
+def otsu_threshold(values:np.ndarray, n_bins:int=256) -> float:
+    """
+    The threshold that best separates values into two classes
+
+    :param values: the values to threshold
+    :param n_bins: the number of histogram bins
+    """
+    counts, edges = np.histogram(values, n_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(counts)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(counts * centers)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    between_variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return float(centers[np.argmax(between_variance)])
+
+
+def tissue_mask(url:str, level:int) -> np.ndarray:
+    """
+    Find the tissue in a coarse level of a volume
+
+    :param url: the URL of the precomputed volume
+    :param level: the level to use, e.g. from choose_mask_level
+    :return: a z, y, x boolean mask of the tissue at that level
+    """
+    volume = ndimage.gaussian_filter(
+        read_level(url, level).astype(np.float32), 1)
+    mask = volume > otsu_threshold(volume)
+    mask = ndimage.binary_opening(mask)
+    return ndimage.binary_fill_holes(mask)
+
+
+def cell_indices(coords:np.ndarray, shape:typing.Sequence[int],
+                 n_cells:typing.Sequence[int]) -> np.ndarray:
+    """
+    The flat index of the grid cell holding each coordinate
+
+    :param coords: N x 3 x, y, z coordinates
+    :param shape: the x, y, z extent of the volume
+    :param n_cells: the number of grid cells in the x, y and z directions
+    """
+    n_cells = np.asarray(n_cells)
+    idxs = np.floor(coords * n_cells / np.asarray(shape, float)).astype(int)
+    idxs = np.clip(idxs, 0, n_cells - 1)
+    return np.ravel_multi_index(idxs.T, n_cells)
+
+
+def center_distances(coords:np.ndarray, shape:typing.Sequence[int],
+                     n_cells:typing.Sequence[int]) -> np.ndarray:
+    """
+    The distance from each coordinate to the center of its grid cell
+
+    :param coords: N x 3 x, y, z coordinates
+    :param shape: the x, y, z extent of the volume
+    :param n_cells: the number of grid cells in the x, y and z directions
+    """
+    cell_size = np.asarray(shape, float) / np.asarray(n_cells)
+    offsets = coords / cell_size
+    offsets = (offsets - np.floor(offsets) - .5) * cell_size
+    return np.sqrt((offsets ** 2).sum(axis=1))
+
+
+def one_per_cell(cells:np.ndarray, distances:np.ndarray) -> np.ndarray:
+    """
+    Pick the point closest to the center of each occupied cell
+
+    :param cells: the cell index of each point
+    :param distances: the distance from each point to its cell's center
+    :return: the indices of the chosen points
+    """
+    order = np.lexsort((distances, cells))
+    _, first = np.unique(cells[order], return_index=True)
+    return np.sort(order[first])
+
+
+def correlation_grid(grid:typing.Sequence[int]) -> typing.List[int]:
+    """
+    The grid to give find-corr-neighbors for points from
+    choose_correlation_points
+
+    find-corr-neighbors grids the volume and correlates the point nearest
+    each grid point, so, given the round's grid, it would thin the points
+    that choose_correlation_points adds in the refined cells back to one
+    per cell. The refined grid has a grid point near each chosen point,
+    which is the one closest to its cell's center, so the chosen points are
+    correlated rather than thinned.
+
+    :param grid: the round's number of grid cells in the x, y and z
+    directions
+    """
+    return [REFINE_FACTOR * _ for _ in grid]
+
+
+def choose_correlation_points(
+        coords:np.ndarray,
+        mask:np.ndarray,
+        mask_level:int,
+        grid:typing.Sequence[int],
+        budget:int,
+        residual_coords:np.ndarray=None,
+        residuals:np.ndarray=None) -> np.ndarray:
+    """
+    Choose the points to correlate
+
+    One point, the one closest to the cell's center, is taken in each cell
+    of the x, y, z grid that holds tissue. Cells where the previous round's
+    matches had large residuals are split in two in each direction, taking
+    one point in each part. If there are more
+    points than the budget, the uniform points are thinned evenly and the
+    extra points are kept for the cells with the largest residuals.
+
+    :param coords: N x 3 x, y, z coordinates of the fixed cells at level 1
+    :param mask: the z, y, x tissue mask
+    :param mask_level: the level of the tissue mask
+    :param grid: the number of grid cells in the x, y and z directions
+    :param budget: the maximum number of points to choose
+    :param residual_coords: the x, y, z fixed coordinates of the previous
+    round's matches or None for the first round
+    :param residuals: the residual of each of the previous round's matches
+    :return: the indices of the chosen points
+    """
+    shape = np.array(mask.shape[::-1]) * mask_level
+    mask_idxs = np.clip((coords / mask_level).astype(int), 0,
+                        np.array(mask.shape[::-1]) - 1)
+    in_tissue = np.where(mask[mask_idxs[:, 2], mask_idxs[:, 1],
+                              mask_idxs[:, 0]])[0]
+    coords = coords[in_tissue]
+    cells = cell_indices(coords, shape, grid)
+    chosen = one_per_cell(cells, center_distances(coords, shape, grid))
+    if len(chosen) >= budget:
+        stride = len(chosen) / budget
+        chosen = chosen[(np.arange(budget) * stride).astype(int)]
+        return in_tissue[chosen]
+    if residual_coords is None or len(residuals) == 0:
+        return in_tissue[chosen]
+    #
+    # The mean residual of each cell
+    #
+    n_cells = int(np.prod(grid))
+    residual_cells = cell_indices(residual_coords, shape, grid)
+    cell_residual = np.bincount(residual_cells, residuals, n_cells) / \
+        np.maximum(np.bincount(residual_cells, minlength=n_cells), 1)
+    threshold = np.percentile(cell_residual[cell_residual > 0],
+                              REFINE_RESIDUAL_PERCENTILE) \
+        if np.any(cell_residual > 0) else np.inf
+    refine = np.where(cell_residual[cells] > threshold)[0]
+    fine_grid = [REFINE_FACTOR * _ for _ in grid]
+    fine_cells = cell_indices(coords[refine], shape, fine_grid)
+    extra = refine[one_per_cell(
+        fine_cells, center_distances(coords[refine], shape, fine_grid))]
+    extra = np.setdiff1d(extra, chosen)
+    #
+    # Spend what is left of the budget on the worst cells first
+    #
+    extra = extra[np.argsort(-cell_residual[cells[extra]], kind="stable")]
+    extra = extra[:budget - len(chosen)]
+    return in_tissue[np.sort(np.concatenate([chosen, extra]))]
@@ -125,8 +125,9 @@ class ApplyAlignmentWidget(QWidget):
                     partial(self.on_input_path_changed, idx=idx))
 
     def on_input_path_changed(self, value, idx):
-        self.model.alignment_output_paths[idx].set(value+"_warped")
-        self.model.alignment_tiff_directories[idx].set(value+"_tiff")
+        with self.model.batch():
+            self.model.alignment_output_paths[idx].set(value+"_warped")
+            self.model.alignment_tiff_directories[idx].set(value+"_tiff")
 
     def on_n_channels_changed(self, *args):
         for variables in (self.model.alignment_input_paths,
@@ -0,0 +1,184 @@
+#
+# Locality for find-corr-neighbors: the fixed coordinates are put in the
+# order of the blockfs blocks that hold them and the compressed bytes of the
+# blocks around them are read ahead of time, so the correlation workers find
+# them in the operating system's page cache instead of seeking for each
+# patch. The blocks are not decompressed here.
+#
+import json
+import os
+import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from blockfs import Directory
+
+from .utils import is_stale
+
+#
+# Never prefetch more than this fraction of physical memory
+#
+PREFETCH_MEMORY_FRACTION = .5
+
+
+def blockfs_path(precomputed_path:str, level:int=1) -> str:
+    """
+    The path to the blockfs directory file of one level of a precomputed
+    volume
+
+    :param precomputed_path: the root directory of the precomputed volume
+    :param level: the level, e.g. 1, 2, 4
+    """
+    return os.path.join(precomputed_path, "%d_%d_%d" % (level, level, level),
+                        "precomputed.blockfs")
+
+
+def block_order_path(coords_path:str) -> str:
+    """
+    The path to the copy of a coordinates file sorted in block order
+
+    :param coords_path: the path to the JSON coordinates file
+    """
+    return os.path.splitext(coords_path)[0] + "-block-order.json"
+
+
+def block_indices(coords:np.ndarray, directory:Directory) -> np.ndarray:
+    """
+    The z, y, x index of the block holding each coordinate
+
+    :param coords: N x 3 x, y, z coordinates
+    :param directory: the blockfs directory of the volume
+    """
+    block_size = np.array([directory.z_block_size,
+                           directory.y_block_size,
+                           directory.x_block_size])
+    zyx = np.asarray(coords)[:, ::-1]
+    return np.floor(zyx / block_size).astype(int)
+
+
+def write_block_ordered_coords(coords_path:str, precomputed_path:str) -> str:
+    """
+    Write a copy of a coordinates file, sorted by the blockfs block that holds
+    each coordinate in z, y, x order, which is the order the blocks are
+    written.
+
+    The copy is only rewritten if the coordinates file has changed.
+
+    :param coords_path: the path to the JSON list of x, y, z coordinates
+    :param precomputed_path: the root directory of the precomputed volume that
+    the coordinates are in
+    :return: the path to the sorted copy
+    """
+    dest_path = block_order_path(coords_path)
+    if not is_stale([dest_path], [coords_path]):
+        return dest_path
+    with open(coords_path) as fd:
+        coords = np.array(json.load(fd), float).reshape(-1, 3)
+    directory = Directory.open(blockfs_path(precomputed_path))
+    idxs = block_indices(coords, directory)
+    order = np.lexsort((coords[:, 0], idxs[:, 2], idxs[:, 1], idxs[:, 0]))
+    with open(dest_path, "w") as fd:
+        json.dump(coords[order].tolist(), fd)
+    return dest_path
+
+
+def blocks_around(coords:np.ndarray, directory:Directory,
+                  radius:typing.Sequence[float]) -> typing.List[tuple]:
+    """
+    The z, y, x indices of the blocks within a radius of some coordinates,
+    in block order
+
+    :param coords: N x 3 x, y, z coordinates
+    :param directory: the blockfs directory of the volume
+    :param radius: the x, y, z radius, in voxels, of the patch around each
+    coordinate
+    """
+    n_blocks = np.array([
+        (directory.z_extent + directory.z_block_size - 1) //
+        directory.z_block_size,
+        (directory.y_extent + directory.y_block_size - 1) //
+        directory.y_block_size,
+        (directory.x_extent + directory.x_block_size - 1) //
+        directory.x_block_size])
+    radius = np.asarray(radius, float)
+    low = np.clip(block_indices(coords - radius, directory), 0, n_blocks - 1)
+    high = np.clip(block_indices(coords + radius, directory), 0, n_blocks - 1)
+    #
+    # Most neighboring coordinates have the same range of blocks
+    #
+    ranges = np.unique(np.hstack([low, high]), axis=0)
+    blocks = set()
+    for z0, y0, x0, z1, y1, x1 in ranges:
+        for z in range(z0, z1 + 1):
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    blocks.add((z, y, x))
+    return sorted(blocks)
+
+
+def physical_memory() -> int:
+    """The number of bytes of physical memory"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def prefetch_byte_range(path:str, offset:int, size:int):
+    """
+    Ask the operating system to read part of a file into the page cache
+
+    :param path: the path to the file
+    :param offset: the offset of the first byte to read
+    :param size: the number of bytes to read
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset, size, os.POSIX_FADV_WILLNEED)
+        else:
+            os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+
+
+def prefetch_blocks(precomputed_path:str,
+                    coords:np.ndarray,
+                    radius:typing.Sequence[float],
+                    n_io_workers:int,
+                    progress:typing.Callable[[int, int], None]=None) -> int:
+    """
+    Read the compressed bytes of the blocks around some coordinates so that
+    they are in the page cache when the correlation workers read them.
+
+    :param precomputed_path: the root directory of the precomputed volume
+    :param coords: N x 3 x, y, z coordinates at level 1
+    :param radius: the x, y, z radius, in voxels, of the patch around each
+    coordinate
+    :param n_io_workers: the number of threads to read with
+    :param progress: called, in the calling thread, with the number of blocks
+    read and the number of blocks to read from time to time
+    :return: the number of blocks read
+    """
+    directory = Directory.open(blockfs_path(precomputed_path))
+    #
+    # The file, offset and size of the compressed bytes of each block, up to
+    # the memory limit
+    #
+    blocks = []
+    n_bytes = 0
+    max_bytes = physical_memory() * PREFETCH_MEMORY_FRACTION
+    for z, y, x in blocks_around(coords, directory, radius):
+        path, offset, size = directory.get_block_location(
+            x * directory.x_block_size,
+            y * directory.y_block_size,
+            z * directory.z_block_size)
+        n_bytes += size
+        if n_bytes > max_bytes:
+            break
+        blocks.append((path, offset, size))
+
+    with ThreadPoolExecutor(n_io_workers) as executor:
+        futures = [executor.submit(prefetch_byte_range, *_) for _ in blocks]
+        for n_done, future in enumerate(as_completed(futures)):
+            future.result()
+            if progress is not None and (n_done + 1) % 100 == 0:
+                progress(n_done + 1, len(blocks))
+    return len(blocks)
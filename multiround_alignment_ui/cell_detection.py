@@ -33,32 +33,33 @@ class CellDetectionWidget(QWidget, OnActivateMixin):
         #    Fixed and moving cell recognition ML model.
         #
         def on_output_changed(*args):
-            self.model.fixed_model_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "fixed.model"))
-            self.model.moving_model_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "moving.model"))
-            self.model.fixed_patches_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "patches_fixed.h5"))
-            self.model.moving_patches_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "patches_moving.h5"))
-            self.model.fixed_blob_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "blobs_fixed.json"))
-            self.model.moving_blob_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "blobs_moving.json"))
-            self.model.fixed_coords_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "coords_fixed.json")
-            )
-            self.model.moving_coords_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "coords_moving.json")
-            )
+            with self.model.batch():
+                self.model.fixed_model_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "fixed.model"))
+                self.model.moving_model_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "moving.model"))
+                self.model.fixed_patches_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "patches_fixed.h5"))
+                self.model.moving_patches_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "patches_moving.h5"))
+                self.model.fixed_blob_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "blobs_fixed.json"))
+                self.model.moving_blob_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "blobs_moving.json"))
+                self.model.fixed_coords_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "coords_fixed.json")
+                )
+                self.model.moving_coords_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "coords_moving.json")
+                )
 
         self.model.output_path.register_callback(
             "cell_detection", on_output_changed)
@@ -199,6 +200,7 @@ class CellDetectionWidget(QWidget, OnActivateMixin):
         """
         can_run_all = True
         do_bypass = self.model.bypass_training.get()
+        file_status = self.model.file_status
         for src_path, blob_path, widget, name, bypass in (
                 (self.model.fixed_precomputed_path.get(),
                  self.model.fixed_blob_path.get(),
@@ -227,13 +229,13 @@ class CellDetectionWidget(QWidget, OnActivateMixin):
         ):
             run_name = "Run %s" % name
             rerun_name = "Rerun %s" % name
-            if not os.path.exists(src_path):
+            if not file_status.exists(src_path):
                 widget.setDisabled(True)
                 widget.setText(run_name)
                 can_run_all = False
             else:
                 widget.setDisabled(bypass and do_bypass)
-                if os.path.exists(blob_path):
+                if file_status.exists(blob_path):
                     widget.setText(rerun_name)
                     can_run_all = False
                 else:
@@ -0,0 +1,294 @@
+#
+# Statistics of the fine alignment's refinement rounds, used to decide
+# whether more rounds are needed.
+#
+import json
+import os
+import tempfile
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from phathom.pipeline.warp_points_cmd import main as warp_points
+
+from .transform_format import binary_interpolator_attributes, \
+    convert_interpolator, load_interpolator
+
+#
+# Never run more refinement rounds than this
+#
+MAX_REFINEMENT_ROUNDS = 10
+#
+# The number of fixed coordinates used to measure how much the transform
+# changed between rounds
+#
+N_TRANSFORM_SAMPLES = 10000
+#
+# The percentile of the match residuals that is reported with the median
+#
+RESIDUAL_PERCENTILE = 90
+#
+# The names used for the fixed and moving points of a match file
+#
+MATCH_KEYS = (("fixed", "moving"),
+              ("fixed_pts", "moving_pts"),
+              ("fixed_coords", "moving_coords"))
+#
+# The number of points that an interpolator's binary copy is checked
+# against warp-points with and how far, in voxels, the two may disagree
+#
+N_CHECK_SAMPLES = 100
+CHECK_TOLERANCE = .01
+#
+# The number of points warped at a time by a loaded interpolator, to bound
+# the memory used by radial basis functions
+#
+WARP_CHUNK_SIZE = 16384
+
+
+def read_matches(path:str) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the matched points written by find-neighbors or filter-matches
+
+    :param path: the path to the match file
+    :return: the N x 3 fixed and moving points in x, y, z order
+    """
+    with open(path) as fd:
+        matches = json.load(fd)
+    fixed_key, moving_key = match_keys(matches)
+    return np.array(matches[fixed_key], float).reshape(-1, 3), \
+        np.array(matches[moving_key], float).reshape(-1, 3)
+
+
+def match_keys(matches:dict) -> typing.Tuple[str, str]:
+    """
+    The keys of the fixed and moving points in a match file's dictionary
+
+    :param matches: the contents of a match file
+    """
+    for fixed_key, moving_key in MATCH_KEYS:
+        if fixed_key in matches and moving_key in matches:
+            return fixed_key, moving_key
+    raise KeyError("The matches do not have fixed and moving points")
+
+
+def sample_coords(path:str, n_samples:int=N_TRANSFORM_SAMPLES) -> np.ndarray:
+    """
+    Take an evenly spaced sample of a coordinates file
+
+    :param path: the path to a JSON list of x, y, z coordinates
+    :param n_samples: the maximum number of coordinates to take
+    """
+    with open(path) as fd:
+        coords = np.array(json.load(fd), float).reshape(-1, 3)
+    stride = max(1, len(coords) // n_samples)
+    return coords[::stride][:n_samples]
+
+
+def warp_coords(coords:np.ndarray, interpolator:str,
+                n_workers:int) -> np.ndarray:
+    """
+    Apply an interpolator to coordinates
+
+    The interpolator's binary copy is used if it is up to date and was
+    checked against warp-points (see convert_checked_interpolator).
+    Otherwise warp-points is run on the pickle.
+
+    :param coords: N x 3 x, y, z coordinates
+    :param interpolator: the path to the interpolator pickle
+    :param n_workers: the number of worker processes to use
+    :return: the N x 3 warped coordinates
+    """
+    attributes = binary_interpolator_attributes(interpolator)
+    if attributes is not None and attributes.get("checked", False):
+        return apply_interpolator(load_interpolator(interpolator), coords,
+                                  n_workers)
+    return run_warp_points(coords, interpolator, n_workers)
+
+
+def run_warp_points(coords:np.ndarray, interpolator:str,
+                    n_workers:int) -> np.ndarray:
+    """
+    Apply an interpolator pickle to coordinates with warp-points
+
+    :param coords: N x 3 x, y, z coordinates
+    :param interpolator: the path to the interpolator pickle
+    :param n_workers: the number of worker processes to use
+    :return: the N x 3 warped coordinates
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, "input.json")
+        output_path = os.path.join(tempdir, "output.json")
+        with open(input_path, "w") as fd:
+            json.dump(coords.tolist(), fd)
+        warp_points([
+            "--interpolator", interpolator,
+            "--input", input_path,
+            "--output", output_path,
+            "--n-workers", str(n_workers)
+        ])
+        with open(output_path) as fd:
+            return np.array(json.load(fd), float).reshape(-1, 3)
+
+
+def apply_interpolator(interpolator, coords:np.ndarray,
+                       n_workers:int=1) -> np.ndarray:
+    """
+    Apply a loaded interpolator to coordinates as warp-points does: the
+    pickle holds a dictionary whose "interpolator" maps z, y, x coordinates
+
+    :param interpolator: the interpolator, e.g. from load_interpolator
+    :param coords: N x 3 x, y, z coordinates
+    :param n_workers: the number of threads to use
+    :return: the N x 3 warped coordinates
+    """
+    if isinstance(interpolator, dict):
+        interpolator = interpolator["interpolator"]
+    coords = np.asarray(coords, float).reshape(-1, 3)
+    chunks = [coords[start:start + WARP_CHUNK_SIZE, ::-1]
+              for start in range(0, len(coords), WARP_CHUNK_SIZE)]
+    if len(chunks) == 0:
+        return np.zeros((0, 3))
+    with ThreadPoolExecutor(max(1, n_workers)) as executor:
+        warped = list(executor.map(interpolator, chunks))
+    return np.vstack(warped).reshape(-1, 3)[:, ::-1]
+
+
+def convert_checked_interpolator(interpolator:str, coords:np.ndarray,
+                                 n_workers:int) -> bool:
+    """
+    Write the binary copy of an interpolator pickle that warp_coords uses
+    instead of warp-points
+
+    The copy is only used if it warps some points to where warp-points does,
+    so that anything in a pickle that the copy can't reproduce falls back to
+    warp-points rather than giving different results.
+
+    :param interpolator: the path to the interpolator pickle
+    :param coords: N x 3 x, y, z coordinates to check with, e.g. the matches
+    that the interpolator was fit to
+    :param n_workers: the number of worker processes to use
+    :return: True if warp_coords will use the binary copy
+    """
+    if len(coords) == 0:
+        return False
+    coords = coords[::max(1, len(coords) // N_CHECK_SAMPLES)]
+    expected = run_warp_points(coords, interpolator, n_workers)
+
+    def check(rebuilt) -> bool:
+        try:
+            actual = apply_interpolator(rebuilt, coords)
+        except Exception:
+            return False
+        return actual.shape == expected.shape and \
+            np.allclose(actual, expected, atol=CHECK_TOLERANCE)
+
+    try:
+        convert_interpolator(interpolator, check=check)
+    except ValueError:
+        # The pickle holds something that can't be stored
+        return False
+    return binary_interpolator_attributes(interpolator).get("checked", False)
+
+
+def match_residuals(matches_path:str, interpolator:str,
+                    voxel_size:typing.Sequence[float],
+                    n_workers:int) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    The distance between each warped fixed match and its moving match
+
+    :param matches_path: the path to the match file
+    :param interpolator: the fixed -> moving interpolator
+    :param voxel_size: the x, y, z voxel size in microns
+    :param n_workers: the number of worker processes to use
+    :return: the N x 3 x, y, z fixed points and their residuals in microns
+    """
+    fixed, moving = read_matches(matches_path)
+    if len(fixed) == 0:
+        return fixed, np.zeros(0)
+    warped = warp_coords(fixed, interpolator, n_workers)
+    residuals = np.sqrt((((warped - moving) * np.asarray(voxel_size, float))
+                         ** 2).sum(axis=1))
+    return fixed, residuals
+
+
+class RoundStatistics:
+    """
+    How well a refinement round's transform fits its matches and how much
+    it differs from the previous round's.
+
+    Distances are in microns.
+    """
+
+    def __init__(self, n_matches:int, median_residual:float,
+                 percentile_residual:float, transform_change:float):
+        self.n_matches = n_matches
+        self.median_residual = median_residual
+        self.percentile_residual = percentile_residual
+        self.transform_change = transform_change
+
+    def __str__(self):
+        return "%d matches, residual median %.2f μm, %dth percentile " \
+               "%.2f μm, median transform change %.2f μm" % (
+            self.n_matches, self.median_residual, RESIDUAL_PERCENTILE,
+            self.percentile_residual, self.transform_change)
+
+
+def compute_round_statistics(matches_path:str,
+                             interpolator:str,
+                             previous_interpolator:str,
+                             sample:np.ndarray,
+                             voxel_size:typing.Sequence[float],
+                             n_workers:int) -> RoundStatistics:
+    """
+    Compute the statistics of a refinement round
+
+    The residuals should be measured on matches that the transform was not
+    fit to, e.g. the round's unfiltered find-neighbors matches: the
+    transform passes close to the filtered matches by construction.
+
+    :param matches_path: the matches to measure the residuals on
+    :param interpolator: the round's fixed -> moving interpolator
+    :param previous_interpolator: the previous round's fixed -> moving
+    interpolator
+    :param sample: fixed coordinates for comparing the two interpolators
+    :param voxel_size: the x, y, z voxel size in microns
+    :param n_workers: the number of worker processes to use
+    """
+    voxel_size = np.asarray(voxel_size, float)
+    fixed, residuals = match_residuals(matches_path, interpolator, voxel_size,
+                                       n_workers)
+    if len(fixed) > 0:
+        median_residual = float(np.median(residuals))
+        percentile_residual = float(
+            np.percentile(residuals, RESIDUAL_PERCENTILE))
+    else:
+        median_residual = percentile_residual = np.inf
+    current = warp_coords(sample, interpolator, n_workers)
+    previous = warp_coords(sample, previous_interpolator, n_workers)
+    transform_change = float(np.median(np.sqrt(
+        (((current - previous) * voxel_size) ** 2).sum(axis=1))))
+    return RoundStatistics(len(fixed), median_residual, percentile_residual,
+                           transform_change)
+
+
+def has_converged(statistics:RoundStatistics,
+                  transform_tolerance:float,
+                  residual_tolerance:float,
+                  require_both:bool=True) -> bool:
+    """
+    Decide whether further rounds are unlikely to improve the alignment
+
+    :param statistics: the statistics of the latest round
+    :param transform_tolerance: the transform has settled if it changed by
+    less than this many microns
+    :param residual_tolerance: the transform fits if the median match
+    residual is less than this many microns
+    :param require_both: if True, converged only if the transform has
+    settled and it fits, otherwise if either is true
+    """
+    settled = statistics.transform_change < transform_tolerance
+    fits = statistics.median_residual < residual_tolerance
+    if require_both:
+        return settled and fits
+    return settled or fits
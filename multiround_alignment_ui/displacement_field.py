@@ -0,0 +1,166 @@
+#
+# Transforms resampled as displacement fields on a regular grid. Evaluating a
+# field is a trilinear lookup, which is much cheaper than evaluating the
+# interpolator it was sampled from.
+#
+import os
+import typing
+
+import numpy as np
+from scipy import ndimage
+
+from .convergence import warp_coords
+from .transform_format import read_transform, write_transform
+from .utils import is_stale
+
+#
+# The default distance, in voxels, between the grid points of a field
+#
+DISPLACEMENT_FIELD_SPACING = 32
+#
+# The type of a displacement field's transform file
+#
+DISPLACEMENT_FIELD_TYPE = "displacement-field"
+
+
+class DisplacementField:
+    """
+    A transform of x, y, z coordinates, sampled on a regular grid
+    """
+
+    def __init__(self, origin:typing.Sequence[float],
+                 spacing:typing.Sequence[float],
+                 displacement:np.ndarray):
+        """
+        :param origin: the x, y, z coordinates of the first grid point
+        :param spacing: the x, y, z distance between grid points
+        :param displacement: an X x Y x Z x 3 array of the displacement of
+        each grid point
+        """
+        self.origin = np.asarray(origin, float)
+        self.spacing = np.asarray(spacing, float)
+        self.displacement = np.asarray(displacement, np.float32)
+
+    @property
+    def shape(self) -> typing.Tuple[int, int, int]:
+        """The number of grid points in the x, y and z directions"""
+        return self.displacement.shape[:3]
+
+    def grid(self) -> np.ndarray:
+        """The x, y, z coordinates of the grid points, X x Y x Z x 3"""
+        axes = [origin + np.arange(size) * spacing
+                for origin, spacing, size
+                in zip(self.origin, self.spacing, self.shape)]
+        return np.stack(np.meshgrid(*axes, indexing="ij"), -1)
+
+    @staticmethod
+    def sample(interpolator:str,
+               shape:typing.Sequence[int],
+               n_workers:int,
+               spacing:float=DISPLACEMENT_FIELD_SPACING) -> "DisplacementField":
+        """
+        Sample an interpolator on a grid covering a volume
+
+        :param interpolator: the path to the interpolator pickle
+        :param shape: the x, y, z extent of the volume that the interpolator
+        takes coordinates from
+        :param n_workers: the number of worker processes to use
+        :param spacing: the distance between grid points
+        """
+        n_points = [int(np.ceil((size - 1) / spacing)) + 1 for size in shape]
+        field = DisplacementField((0, 0, 0), (spacing,) * 3,
+                                  np.zeros(tuple(n_points) + (3,)))
+        grid = field.grid().reshape(-1, 3)
+        warped = warp_coords(grid, interpolator, n_workers)
+        field.displacement = (warped - grid).reshape(field.displacement.shape)\
+            .astype(np.float32)
+        return field
+
+    def __call__(self, coords:np.ndarray) -> np.ndarray:
+        """
+        Transform coordinates
+
+        :param coords: N x 3 x, y, z coordinates
+        :return: the N x 3 transformed coordinates
+        """
+        coords = np.asarray(coords, float)
+        grid_coords = ((coords - self.origin) / self.spacing).T
+        displacement = np.column_stack([
+            ndimage.map_coordinates(self.displacement[..., idx], grid_coords,
+                                    order=1, mode="nearest")
+            for idx in range(3)])
+        return coords + displacement
+
+    def save(self, path:str):
+        """
+        Save the field as a transform file
+
+        :param path: the path to the file
+        """
+        write_transform(path, DISPLACEMENT_FIELD_TYPE,
+                        dict(displacement=self.displacement),
+                        dict(origin=self.origin.tolist(),
+                             spacing=self.spacing.tolist()))
+
+    @staticmethod
+    def load(path:str) -> "DisplacementField":
+        """
+        Load a field saved with DisplacementField.save. The displacements
+        are memory-mapped rather than read.
+
+        :param path: the path to the transform file
+        """
+        transform_type, attributes, arrays = read_transform(path)
+        if transform_type != DISPLACEMENT_FIELD_TYPE:
+            raise ValueError("%s holds a %s, not a displacement field" %
+                             (path, transform_type))
+        return DisplacementField(attributes["origin"], attributes["spacing"],
+                                 arrays["displacement"])
+
+
+def displacement_field_path(interpolator:str) -> str:
+    """
+    The path to the displacement field sampled from an interpolator
+
+    :param interpolator: the path to the interpolator pickle
+    """
+    return os.path.splitext(interpolator)[0] + "-field.xform"
+
+
+def write_displacement_field(interpolator:str, shape:typing.Sequence[int],
+                             n_workers:int) -> str:
+    """
+    Sample an interpolator's displacement field and save it next to the
+    interpolator, unless the saved field is newer than the interpolator.
+
+    :param interpolator: the path to the interpolator pickle
+    :param shape: the x, y, z extent of the volume that the interpolator
+    takes coordinates from
+    :param n_workers: the number of worker processes to use
+    :return: the path to the field
+    """
+    path = displacement_field_path(interpolator)
+    if is_stale([path], [interpolator]):
+        DisplacementField.sample(interpolator, shape, n_workers).save(path)
+    return path
+
+
+def fast_warp_coords(coords:np.ndarray, interpolator:str,
+                     n_workers:int) -> np.ndarray:
+    """
+    Apply an interpolator to coordinates, using its displacement field if it
+    has an up-to-date one
+
+    The field is accurate to within its grid spacing's worth of curvature, so
+    this is for estimates, e.g. which blocks to read, not for measurements.
+
+    :param coords: N x 3 x, y, z coordinates
+    :param interpolator: the path to the interpolator pickle
+    :param n_workers: the number of worker processes to use if there is no
+    field
+    :return: the N x 3 warped coordinates
+    """
+    path = displacement_field_path(interpolator)
+    if not is_stale([path], [interpolator]):
+        return DisplacementField.load(path)(coords)
+    return warp_coords(coords, interpolator, n_workers)
@@ -0,0 +1,175 @@
+#
+# Parsing of the log that elastix writes while phathom-non-rigid-registration
+# runs, so that the rough alignment can report its progress.
+#
+import collections
+import re
+import typing
+
+import numpy as np
+
+#
+# The parameter map is echoed at the start of the log, e.g.
+# "(NumberOfResolutions 4)" and "(MaximumNumberOfIterations 500 500 500 500)"
+#
+N_RESOLUTIONS_RE = re.compile(r"^\(NumberOfResolutions\s+(\d+)\)")
+MAX_ITERATIONS_RE = re.compile(r"^\(MaximumNumberOfIterations\s+([\d\s]+)\)")
+#
+# Each resolution starts with "Resolution: 0"...
+#
+RESOLUTION_RE = re.compile(r"^Resolution:\s*(\d+)")
+#
+# ... followed by a table of iterations whose header is e.g.
+# "1:ItNr	2:Metric	3a:Time	3b:StepSize	4:||Gradient||	Time [ms]"
+#
+ITERATION_HEADER_RE = re.compile(r"^1:ItNr\s+2:Metric")
+ITERATION_ROW_RE = re.compile(r"^(\d+)\s+([-+0-9.eE]+|nan|inf)(\s|$)")
+#
+# and ends with e.g. "Final metric value  = -0.0456"
+#
+FINAL_METRIC_VALUE_RE = re.compile(
+    r"Final metric value\s*=\s*([-+0-9.eE]+|nan|inf)")
+
+IterationEvent = collections.namedtuple(
+    "IterationEvent", ["resolution", "iteration", "metric"])
+
+
+def to_float(text:str) -> float:
+    """Convert a metric value to a float, treating junk as NaN"""
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+class ElastixOutputParser:
+    """
+    Turns the text written by elastix into iteration events
+
+    Feed the parser the text as it arrives. The text does not have to be
+    broken at line boundaries.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.n_resolutions = None
+        self.max_iterations = []
+        self.resolution = None
+        self.in_iteration_table = False
+        self.events = []
+        self.final_metrics = []
+
+    def feed(self, text:str) -> typing.List[IterationEvent]:
+        """
+        Parse more of the output
+
+        :param text: the text written since the last call
+        :return: the iterations completed in the text
+        """
+        lines = (self.buffer + text).split("\n")
+        self.buffer = lines.pop()
+        events = []
+        for line in lines:
+            event = self.parse_line(line.strip())
+            if event is not None:
+                events.append(event)
+        self.events += events
+        return events
+
+    def parse_line(self, line:str) -> typing.Optional[IterationEvent]:
+        if self.in_iteration_table:
+            match = ITERATION_ROW_RE.match(line)
+            if match:
+                return IterationEvent(self.resolution or 0,
+                                      int(match.group(1)),
+                                      to_float(match.group(2)))
+            self.in_iteration_table = False
+        if ITERATION_HEADER_RE.match(line):
+            self.in_iteration_table = True
+            return
+        match = RESOLUTION_RE.match(line)
+        if match:
+            self.resolution = int(match.group(1))
+            return
+        match = FINAL_METRIC_VALUE_RE.search(line)
+        if match:
+            self.final_metrics.append(to_float(match.group(1)))
+            return
+        match = N_RESOLUTIONS_RE.match(line)
+        if match:
+            self.n_resolutions = int(match.group(1))
+            return
+        match = MAX_ITERATIONS_RE.match(line)
+        if match:
+            self.max_iterations = [int(_) for _ in match.group(1).split()]
+
+    @property
+    def final_metric(self) -> float:
+        """
+        The metric at the end of the last resolution or infinity if the
+        registration has not reported one.
+        """
+        if len(self.final_metrics) == 0 or \
+                not np.isfinite(self.final_metrics[-1]):
+            return np.inf
+        return self.final_metrics[-1]
+
+    @property
+    def metric(self) -> float:
+        """The most recently reported metric or NaN if none yet"""
+        if len(self.events) == 0:
+            return np.nan
+        return self.events[-1].metric
+
+    def iterations_per_resolution(self) -> typing.Optional[typing.List[int]]:
+        """
+        The maximum number of iterations for each resolution or None if
+        the parameter map has not been seen.
+        """
+        if self.n_resolutions is None or len(self.max_iterations) == 0:
+            return None
+        if len(self.max_iterations) == 1:
+            return self.max_iterations * self.n_resolutions
+        return self.max_iterations[:self.n_resolutions]
+
+    def total_iterations(self) -> typing.Optional[int]:
+        """The maximum number of iterations over all resolutions"""
+        iterations = self.iterations_per_resolution()
+        if iterations is None:
+            return None
+        return sum(iterations)
+
+    def completed_iterations(self) -> int:
+        """The number of iterations completed over all resolutions"""
+        if len(self.events) == 0:
+            return 0
+        last = self.events[-1]
+        iterations = self.iterations_per_resolution()
+        if iterations is None:
+            return len(self.events)
+        return sum(iterations[:last.resolution]) + last.iteration + 1
+
+    def in_last_resolution(self) -> bool:
+        """True if the registration has reached its last resolution"""
+        return self.n_resolutions is not None and \
+            self.resolution == self.n_resolutions - 1
+
+    def has_plateaued(self, window:int, tolerance:float) -> bool:
+        """
+        Decide whether the metric has stopped improving in the last
+        resolution
+
+        :param window: the number of iterations to look back over
+        :param tolerance: the registration has plateaued if the metric
+        improved by less than this fraction of its magnitude over the window
+        """
+        if not self.in_last_resolution():
+            return False
+        metrics = [_.metric for _ in self.events
+                   if _.resolution == self.resolution]
+        if len(metrics) <= window:
+            return False
+        old, new = metrics[-window - 1], metrics[-1]
+        if not np.isfinite(old) or not np.isfinite(new):
+            return False
+        return old - new < tolerance * max(abs(old), np.finfo(float).eps)
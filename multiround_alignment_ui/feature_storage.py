@@ -0,0 +1,70 @@
+#
+# Storage of cell coordinates and geometric features for the fine alignment.
+#
+# A geometric features file is a .npy array with one row per cell, in the
+# same order as the cells in the coordinates file it was computed from, so
+# row i holds the features of the i-th x, y, z coordinate. The files are
+# opened memory-mapped, so every worker process shares one copy of them.
+#
+import json
+import os
+
+import numpy as np
+
+from .utils import is_stale
+
+
+def coords_npy_path(path:str) -> str:
+    """
+    The path to the numpy copy of a coordinates file
+
+    :param path: the path to the JSON coordinates file
+    """
+    return os.path.splitext(path)[0] + ".npy"
+
+
+def load_coords(path:str) -> np.ndarray:
+    """
+    Load a JSON coordinates file as a read-only memory-mapped array
+
+    A numpy copy of the coordinates is written next to the JSON file the
+    first time and whenever the JSON file changes.
+
+    :param path: the path to the JSON list of x, y, z coordinates
+    :return: an N x 3 array of x, y, z coordinates
+    """
+    npy_path = coords_npy_path(path)
+    if is_stale([npy_path], [path]):
+        with open(path) as fd:
+            coords = np.array(json.load(fd), float).reshape(-1, 3)
+        np.save(npy_path, coords)
+    return np.load(npy_path, mmap_mode="r")
+
+
+def load_geometric_features(path:str) -> np.ndarray:
+    """
+    Open a geometric features file read-only and memory-mapped
+
+    Every process that opens the file this way shares the same pages of the
+    page cache, so the features are in memory once no matter how many
+    workers read them.
+
+    :param path: the path to the .npy features file
+    :return: an N x M array, one row per cell of the coordinates file
+    """
+    return np.load(path, mmap_mode="r")
+
+
+def save_geometric_features(path:str, features:np.ndarray):
+    """
+    Save geometric features so that they can be memory-mapped
+
+    The features are written to a new file that then replaces the old one, so
+    that processes that have the old one mapped keep seeing the old features.
+
+    :param path: the path to the .npy features file
+    :param features: an N x M array, one row per cell of the coordinates file
+    """
+    temp_path = path + ".tmp.npy"
+    np.save(temp_path, np.ascontiguousarray(features))
+    os.replace(temp_path, path)
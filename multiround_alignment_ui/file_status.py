@@ -0,0 +1,108 @@
+#
+# A cache of the existence of the files made by the pipeline, so that the
+# widgets can decorate their buttons without a round-trip to the file system
+# for every path each time a tab is shown.
+#
+import os
+import time
+import weakref
+
+from PyQt5.QtCore import QFileSystemWatcher
+
+
+class FileStatus:
+    """
+    A cache of os.path.exists() results for the pipeline's files.
+
+    A path is checked the first time it is asked about. After that, the answer
+    comes from the cache until the file system watcher reports a change to the
+    path's directory, until the answer is older than the polling interval
+    (the watcher does not see changes made on other hosts of a network file
+    system) or until the cache is invalidated, e.g. after a pipeline step
+    has run.
+    """
+    #
+    # Every FileStatus, so that they can all be invalidated after a step
+    #
+    instances = weakref.WeakSet()
+
+    def __init__(self, poll_interval=10.0):
+        """
+        :param poll_interval: the number of seconds before a cached answer
+        is checked again.
+        """
+        self.poll_interval = poll_interval
+        self.cache = {}
+        self.watcher = None
+        self.watched_directories = set()
+        FileStatus.instances.add(self)
+
+    def exists(self, path:str) -> bool:
+        """
+        Return True if the path exists, using the cached answer if it is
+        still current.
+
+        :param path: the path to a file or directory
+        """
+        if not path:
+            return False
+        now = time.monotonic()
+        entry = self.cache.get(path)
+        if entry is not None:
+            result, timestamp = entry
+            if now - timestamp < self.poll_interval:
+                return result
+        result = os.path.exists(path)
+        self.cache[path] = (result, now)
+        self.watch(os.path.dirname(path))
+        return result
+
+    def all_exist(self, paths) -> bool:
+        """Return True if every one of the paths exists"""
+        return all([self.exists(_) for _ in paths])
+
+    def watch(self, directory:str):
+        """
+        Watch a directory for changes to the files within it
+
+        :param directory: the directory to watch. If it does not exist yet,
+        it will be watched once it does.
+        """
+        if directory in self.watched_directories or \
+                not os.path.isdir(directory):
+            return
+        if self.watcher is None:
+            self.watcher = QFileSystemWatcher()
+            self.watcher.directoryChanged.connect(self.invalidate_directory)
+        self.watcher.addPath(directory)
+        self.watched_directories.add(directory)
+
+    def invalidate(self, path=None):
+        """
+        Forget the cached answer for a path
+
+        :param path: the path to forget or None to forget everything
+        """
+        if path is None:
+            self.cache.clear()
+        elif path in self.cache:
+            del self.cache[path]
+
+    def invalidate_directory(self, directory:str):
+        """
+        Forget the cached answers for the paths in a directory
+
+        :param directory: the directory whose contents changed
+        """
+        for path in [_ for _ in self.cache
+                     if os.path.dirname(_) == directory]:
+            del self.cache[path]
+        if not os.path.isdir(directory):
+            # The watcher stops watching a directory that was removed
+            self.watched_directories.discard(directory)
+
+    @staticmethod
+    def invalidate_all():
+        """Forget every cached answer of every FileStatus"""
+        for file_status in list(FileStatus.instances):
+            file_status.invalidate()
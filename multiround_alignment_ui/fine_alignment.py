@@ -1,21 +1,35 @@
 import functools
+import json
 import os
 
+import numpy as np
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QGroupBox, QHBoxLayout, \
-    QPushButton, QLabel, QSpinBox, QDoubleSpinBox, QComboBox
+    QPushButton, QLabel, QSpinBox, QDoubleSpinBox, QComboBox, QCheckBox
 from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtCore import QUrl
-from phathom.pipeline.geometric_features_cmd import main as geometric_features
 from phathom.pipeline.find_neighbors_cmd import main as find_neighbors
 from phathom.pipeline.find_corr_neighbors_cmd import main as find_corr_neighbors
-from phathom.pipeline.filter_matches_cmd import main as filter_matches
 from phathom.pipeline.fit_nonrigid_transform_cmd \
     import main as fit_nonrigid_transform
+from .adaptive_grid import choose_mask_level, tissue_mask, \
+    choose_correlation_points, correlation_grid
+from .block_prefetch import prefetch_blocks, write_block_ordered_coords
+from .convergence import MAX_REFINEMENT_ROUNDS, sample_coords, \
+    compute_round_statistics, has_converged, match_residuals, \
+    convert_checked_interpolator, read_matches
+from .displacement_field import fast_warp_coords, write_displacement_field
+from .feature_storage import load_coords
+from .incremental_features import compute_geometric_features
+from .match_coherence import compute_match_statistics, statistics_path, \
+    count_passing, passing_matches, read_match_statistics, \
+    write_filter_visualization, write_filtered_matches
 from .model import Model, Variable, FindNeighborsMethod
+from .tiled_neighbors import find_neighbors_tiled
 import pathlib
 
 from .utils import OnActivateMixin, tqdm_progress, fixed_neuroglancer_url, \
-    moving_neuroglancer_url
+    moving_neuroglancer_url, is_stale, set_status_bar_message, \
+    clear_status_bar_message, precomputed_level_shapes, write_parameters
 
 
 def voxel_size(model:Model) -> str:
@@ -38,6 +52,15 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         self.model = model
         self.variables_have_been_hooked_to_widgets = False
         self.last_round_idx = None
+        #
+        # The distance and coherence of the matches by find-neighbors path
+        # and modification time
+        #
+        self.match_statistics = {}
+        #
+        # The fixed volume's tissue mask and its level, by URL
+        #
+        self.tissue_masks = {}
         self.model.output_path.register_callback("fine-alignment",
                                                  self.on_output_path_changed)
         layout = QVBoxLayout()
@@ -92,7 +115,7 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         hlayout.addWidget(QLabel("Number of rounds:"))
         self.n_refinement_rounds_widget = QSpinBox()
         self.n_refinement_rounds_widget.setMinimum(1)
-        self.n_refinement_rounds_widget.setMaximum(10)
+        self.n_refinement_rounds_widget.setMaximum(MAX_REFINEMENT_ROUNDS)
         hlayout.addWidget(self.n_refinement_rounds_widget)
         self.model.n_refinement_rounds.bind_spin_box(
             self.n_refinement_rounds_widget)
@@ -111,6 +134,55 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         self.current_refinement_round_widget.valueChanged.connect(
             self.on_current_round_changed)
         hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        glayout.addLayout(hlayout)
+        self.run_all_rounds_button = QPushButton("Run all rounds")
+        hlayout.addWidget(self.run_all_rounds_button)
+        self.run_all_rounds_button.clicked.connect(self.on_run_all_rounds)
+        hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        glayout.addLayout(hlayout)
+        hlayout.addWidget(QLabel("Stop when transform changes less than (μm):"))
+        self.convergence_transform_tolerance_widget = QDoubleSpinBox()
+        self.convergence_transform_tolerance_widget.setMinimum(0)
+        self.convergence_transform_tolerance_widget.setMaximum(100)
+        self.convergence_transform_tolerance_widget.setSingleStep(.25)
+        hlayout.addWidget(self.convergence_transform_tolerance_widget)
+        self.model.convergence_transform_tolerance.bind_double_spin_box(
+            self.convergence_transform_tolerance_widget)
+        self.convergence_combination_widget = QLabel()
+        hlayout.addWidget(self.convergence_combination_widget)
+        self.convergence_residual_tolerance_widget = QDoubleSpinBox()
+        self.convergence_residual_tolerance_widget.setMinimum(0)
+        self.convergence_residual_tolerance_widget.setMaximum(100)
+        self.convergence_residual_tolerance_widget.setSingleStep(.25)
+        hlayout.addWidget(self.convergence_residual_tolerance_widget)
+        self.model.convergence_residual_tolerance.bind_double_spin_box(
+            self.convergence_residual_tolerance_widget)
+        hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        glayout.addLayout(hlayout)
+        self.convergence_either_widget = QCheckBox(
+            "Stop when either tolerance is met")
+        hlayout.addWidget(self.convergence_either_widget)
+        self.model.convergence_stop_on_either.bind_checkbox(
+            self.convergence_either_widget)
+        self.model.convergence_stop_on_either.register_callback(
+            "fine-alignment", self.on_convergence_stop_on_either_changed)
+        self.on_convergence_stop_on_either_changed()
+        hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        glayout.addLayout(hlayout)
+        self.auto_extend_rounds_widget = QCheckBox(
+            "Add rounds until converged (up to %d)" % MAX_REFINEMENT_ROUNDS)
+        hlayout.addWidget(self.auto_extend_rounds_widget)
+        self.model.auto_extend_rounds.bind_checkbox(
+            self.auto_extend_rounds_widget)
+        hlayout.addStretch(1)
+        self.convergence_log_widget = QLabel()
+        self.convergence_log_widget.setWordWrap(True)
+        glayout.addWidget(self.convergence_log_widget)
+        self.model.convergence_log.bind_label(self.convergence_log_widget)
         #
         ###################################
         #
@@ -195,6 +267,22 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         self.prominence_threshold_widget.valueChanged.connect(
             on_prominence_threshold_change)
         hlayout.addStretch(1)
+        # tiling
+        hlayout = QHBoxLayout()
+        playout.addLayout(hlayout)
+        self.find_neighbors_tiled_widget = QCheckBox("Process in tiles")
+        hlayout.addWidget(self.find_neighbors_tiled_widget)
+        self.model.find_neighbors_tiled.bind_checkbox(
+            self.find_neighbors_tiled_widget)
+        hlayout.addWidget(QLabel("Tile size (voxels):"))
+        self.find_neighbors_tile_size_widget = QSpinBox()
+        self.find_neighbors_tile_size_widget.setMinimum(64)
+        self.find_neighbors_tile_size_widget.setMaximum(16384)
+        self.find_neighbors_tile_size_widget.setSingleStep(64)
+        hlayout.addWidget(self.find_neighbors_tile_size_widget)
+        self.model.find_neighbors_tile_size.bind_spin_box(
+            self.find_neighbors_tile_size_widget)
+        hlayout.addStretch(1)
         self.find_neighbors_correlation_panel = QWidget()
         glayout.addWidget(self.find_neighbors_correlation_panel)
         playout = QVBoxLayout()
@@ -247,6 +335,31 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
             on_corr_neighbors_min_correlation_change
         )
         hlayout.addStretch(1)
+        # prefetching
+        hlayout = QHBoxLayout()
+        playout.addLayout(hlayout)
+        self.find_corr_neighbors_prefetch_widget = QCheckBox(
+            "Read image blocks ahead")
+        hlayout.addWidget(self.find_corr_neighbors_prefetch_widget)
+        self.model.find_corr_neighbors_prefetch.bind_checkbox(
+            self.find_corr_neighbors_prefetch_widget)
+        hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        playout.addLayout(hlayout)
+        self.find_corr_neighbors_adaptive_widget = QCheckBox(
+            "Sample tissue, densest where the last round fit worst")
+        hlayout.addWidget(self.find_corr_neighbors_adaptive_widget)
+        self.model.find_corr_neighbors_adaptive.bind_checkbox(
+            self.find_corr_neighbors_adaptive_widget)
+        hlayout.addWidget(QLabel("Maximum # of points:"))
+        self.find_corr_neighbors_budget_widget = QSpinBox()
+        self.find_corr_neighbors_budget_widget.setMinimum(100)
+        self.find_corr_neighbors_budget_widget.setMaximum(10000000)
+        self.find_corr_neighbors_budget_widget.setSingleStep(1000)
+        hlayout.addWidget(self.find_corr_neighbors_budget_widget)
+        self.model.find_corr_neighbors_budget.bind_spin_box(
+            self.find_corr_neighbors_budget_widget)
+        hlayout.addStretch(1)
         # find-corr-neighbors grid
         fcng_groupbox = QGroupBox("Grid size")
         playout.addWidget(fcng_groupbox)
@@ -331,6 +444,12 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         self.minimum_coherence_widget.valueChanged.connect(
             on_minimum_coherence_changed)
         hlayout.addStretch(1)
+        self.filter_matches_preview_widget = QLabel()
+        glayout.addWidget(self.filter_matches_preview_widget)
+        self.maximum_distance_widget.valueChanged.connect(
+            self.update_filter_matches_preview)
+        self.minimum_coherence_widget.valueChanged.connect(
+            self.update_filter_matches_preview)
         hlayout = QHBoxLayout()
         glayout.addLayout(hlayout)
         self.filter_matches_button = QPushButton("Filter matches")
@@ -372,12 +491,8 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
             self.find_neighbors_method_widget.currentText()
         )
         self.enable_find_neighbors_panels()
-        for path in self.find_neighbors_paths():
-            if not os.path.exists(path):
-                self.find_neighbors_button.setEnabled(False)
-                break
-        else:
-            self.find_neighbors_button.setEnabled(True)
+        self.find_neighbors_button.setEnabled(
+            self.model.file_status.all_exist(self.find_neighbors_paths()))
 
     def enable_find_neighbors_panels(self):
         enable_points = (
@@ -398,8 +513,9 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         else:
             return self.model.moving_coords_path.get()
 
-    def find_neighbors_paths(self):
-        idx = self.current_round_idx
+    def find_neighbors_paths(self, idx=None):
+        if idx is None:
+            idx = self.current_round_idx
         fnm = self.model.find_neighbors_method[idx].get()
         transform_path = self.model.rough_interpolator.get() if idx == 0 \
             else self.model.fit_nonrigid_transform_inverse_path[idx-1].get()
@@ -418,6 +534,7 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
     def update_controls(self):
         self.enable_find_neighbors_panels()
         idx = self.current_round_idx
+        file_status = self.model.file_status
         fnm = self.model.find_neighbors_method[idx].get()
         self.find_neighbors_method_widget.setCurrentText(fnm)
         for src_paths, dest_paths, widget, name, re_name in (
@@ -484,12 +601,12 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
                     "Rerun phathom-fit-nonrigid-transform (round %d)" % (idx+1)
                 )
         ):
-            if not all([os.path.exists(_) for _ in src_paths]):
+            if not file_status.all_exist(src_paths):
                 widget.setDisabled(True)
                 widget.setText(name)
             else:
                 widget.setDisabled(False)
-                if all([os.path.exists(_) for _ in dest_paths]):
+                if file_status.all_exist(dest_paths):
                     widget.setText(re_name)
                 else:
                     widget.setText(name)
@@ -501,39 +618,61 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
                 ( self.show_fit_nonrigid_transform_pdf_button,
                   self.model.fit_nonrigid_transform_pdf_path[idx].get())
         ):
-            if os.path.exists(path):
+            if file_status.exists(path):
                 button.setDisabled(False)
             else:
                 button.setDisabled(True)
+        self.update_filter_matches_preview()
 
     def on_fixed_geometric_features(self, *args):
         with tqdm_progress() as result:
-            geometric_features(
-                [
-                    "--input", self.fixed_coords_path(),
-                    "--output", self.model.fixed_geometric_features_path.get(),
-                    "--voxel-size", voxel_size(self.model),
-                    "--n-workers", str(self.model.n_workers.get()),
-                    "--n-neighbors", str(self.model.n_geometric_neighbors.get())
-                ]
-            )
+            self.run_fixed_geometric_features()
         self.update_controls()
         return result.result()
 
+    def run_fixed_geometric_features(self):
+        """
+        Compute the fixed geometric features, only for the cells whose
+        neighborhoods changed since they were last computed
+        """
+        n_computed = compute_geometric_features(
+            self.fixed_coords_path(),
+            self.model.fixed_geometric_features_path.get(),
+            voxel_size(self.model),
+            self.model.n_geometric_neighbors.get(),
+            self.model.n_workers.get())
+        write_parameters([self.model.fixed_geometric_features_path.get()],
+                         self.geometric_features_parameters())
+        set_status_bar_message(
+            "Computed fixed geometric features for %d cells" % n_computed)
+
     def on_moving_geometric_features(self, *args):
         with tqdm_progress() as result:
-            geometric_features(
-                [
-                    "--input", self.moving_coords_path(),
-                    "--output", self.model.moving_geometric_features_path.get(),
-                    "--voxel-size", voxel_size(self.model),
-                    "--n-workers", str(self.model.n_workers.get()),
-                    "--n-neighbors", str(self.model.n_geometric_neighbors.get())
-                ]
-            )
+            self.run_moving_geometric_features()
         self.update_controls()
         return result.result()
 
+    def run_moving_geometric_features(self):
+        """
+        Compute the moving geometric features, only for the cells whose
+        neighborhoods changed since they were last computed
+        """
+        n_computed = compute_geometric_features(
+            self.moving_coords_path(),
+            self.model.moving_geometric_features_path.get(),
+            voxel_size(self.model),
+            self.model.n_geometric_neighbors.get(),
+            self.model.n_workers.get())
+        write_parameters([self.model.moving_geometric_features_path.get()],
+                         self.geometric_features_parameters())
+        set_status_bar_message(
+            "Computed moving geometric features for %d cells" % n_computed)
+
+    def geometric_features_parameters(self) -> dict:
+        """The settings that the geometric features depend on"""
+        return dict(voxel_size=voxel_size(self.model),
+                    n_neighbors=self.model.n_geometric_neighbors.get())
+
     def on_all_geometric_features(self, *args):
         if self.on_fixed_geometric_features():
             self.on_moving_geometric_features()
@@ -546,8 +685,53 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         else:
             self.on_find_neighbors_correlation()
 
+    def run_find_neighbors(self, idx:int):
+        if self.model.find_neighbors_method[idx].get() ==\
+                FindNeighborsMethod.POINTS.value:
+            self.run_find_neighbors_points(idx)
+        else:
+            self.run_find_neighbors_correlation(idx)
+        write_parameters([self.model.find_neighbors_path[idx].get()],
+                         self.find_neighbors_parameters(idx))
+        self.run_match_statistics(idx)
+
+    def find_neighbors_parameters(self, idx:int) -> dict:
+        """
+        The settings that a round's find-neighbors results depend on
+
+        :param idx: the index of the round
+        """
+        method = self.model.find_neighbors_method[idx].get()
+        parameters = dict(method=method, voxel_size=voxel_size(self.model))
+        if method == FindNeighborsMethod.POINTS.value:
+            parameters.update(
+                radius=self.model.find_neighbors_radius[idx].get(),
+                feature_distance=
+                self.model.find_neighbors_feature_distance[idx].get(),
+                prominence_threshold=
+                self.model.find_neighbors_prominence_threshold[idx].get(),
+                max_neighbors=self.model.max_neighbors[idx].get())
+        else:
+            parameters.update(
+                sigma=self.model.find_corr_neighbors_sigma[idx].get(),
+                radius=self.model.find_corr_neighbors_radius[idx].get(),
+                min_correlation=
+                self.model.find_corr_neighbors_min_correlation[idx].get(),
+                grid=[self.model.find_corr_neighbors_x_grid[idx].get(),
+                      self.model.find_corr_neighbors_y_grid[idx].get(),
+                      self.model.find_corr_neighbors_z_grid[idx].get()],
+                adaptive=self.model.find_corr_neighbors_adaptive.get())
+            if self.model.find_corr_neighbors_adaptive.get():
+                parameters["budget"] = \
+                    self.model.find_corr_neighbors_budget.get()
+        return parameters
+
     def on_find_neighbors_correlation(self):
-        idx = self.current_round_idx
+        with tqdm_progress():
+            self.run_find_neighbors(self.current_round_idx)
+        self.update_controls()
+
+    def run_find_neighbors_correlation(self, idx:int):
         interpolator_variable = \
             self.model.rough_interpolator if idx == 0 \
             else self.model.fit_nonrigid_transform_path[idx-1]
@@ -555,58 +739,238 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
             self.model.find_corr_neighbors_sigma[idx].get() / _.get()
             for _ in (self.model.x_voxel_size, self.model.y_voxel_size,
                       self.model.z_voxel_size)]
+        fixed_coords_path = self.model.fixed_blob_path.get()
+        grid = [self.model.find_corr_neighbors_x_grid[idx].get(),
+                self.model.find_corr_neighbors_y_grid[idx].get(),
+                self.model.find_corr_neighbors_z_grid[idx].get()]
+        if self.model.find_corr_neighbors_adaptive.get():
+            fixed_coords_path = self.write_adaptive_correlation_points(idx)
+            grid = correlation_grid(grid)
+        if self.model.find_corr_neighbors_prefetch.get():
+            inverse_interpolator_variable = \
+                self.model.rough_inverse_interpolator if idx == 0 \
+                else self.model.fit_nonrigid_transform_inverse_path[idx-1]
+            fixed_coords_path = self.prefetch_correlation_blocks(
+                idx, fixed_coords_path, inverse_interpolator_variable.get())
+        find_corr_neighbors([
+            str(_) for _ in (
+                "--fixed-coords", fixed_coords_path,
+                "--fixed-url", fixed_neuroglancer_url(self.model),
+                "--moving-url", moving_neuroglancer_url(self.model),
+                "--transform", interpolator_variable.get(),
+                "--output", self.model.find_neighbors_path[idx].get(),
+                "--visualization-file", self.model.find_neighbors_pdf_path[idx].get(),
+                "--sigma-x", sigma_x,
+                "--sigma-y", sigma_y,
+                "--sigma-z", sigma_z,
+                "--radius", self.model.find_corr_neighbors_radius[idx].get(),
+                "--n-cores", self.model.n_workers.get(),
+                "--min-correlation",
+                self.model.find_corr_neighbors_min_correlation[idx].get(),
+                "--x-grid", grid[0],
+                "--y-grid", grid[1],
+                "--z-grid", grid[2]
+            )
+        ])
+
+    def write_adaptive_correlation_points(self, idx:int) -> str:
+        """
+        Choose the fixed points to correlate for a round: the tissue is
+        sampled on the round's grid, more densely where the previous round's
+        matches fit poorly, within the point budget.
+
+        :param idx: the index of the round
+        :return: the path to the chosen points
+        """
+        fixed_url = fixed_neuroglancer_url(self.model)
+        if fixed_url not in self.tissue_masks:
+            set_status_bar_message("Finding the tissue in the fixed volume")
+            level = choose_mask_level(precomputed_level_shapes(
+                self.model.fixed_precomputed_path.get()))
+            self.tissue_masks[fixed_url] = \
+                (tissue_mask(fixed_url, level), level)
+        mask, level = self.tissue_masks[fixed_url]
+        coords = np.asarray(load_coords(self.model.fixed_blob_path.get()))
+        residual_coords = residuals = None
+        if idx > 0 and self.model.file_status.exists(
+                self.model.filter_matches_path[idx-1].get()):
+            set_status_bar_message(
+                "Round %d: measuring the residuals of round %d" % (idx + 1, idx))
+            residual_coords, residuals = match_residuals(
+                self.model.filter_matches_path[idx-1].get(),
+                self.model.fit_nonrigid_transform_inverse_path[idx-1].get(),
+                (self.model.x_voxel_size.get(),
+                 self.model.y_voxel_size.get(),
+                 self.model.z_voxel_size.get()),
+                self.model.n_workers.get())
+        chosen = choose_correlation_points(
+            coords, mask, level,
+            (self.model.find_corr_neighbors_x_grid[idx].get(),
+             self.model.find_corr_neighbors_y_grid[idx].get(),
+             self.model.find_corr_neighbors_z_grid[idx].get()),
+            self.model.find_corr_neighbors_budget.get(),
+            residual_coords, residuals)
+        path = os.path.join(self.model.output_path.get(),
+                            "find-corr-neighbors-points_round_%d.json" %
+                            (idx + 1))
+        with open(path, "w") as fd:
+            json.dump(coords[chosen].tolist(), fd)
+        return path
+
+    def prefetch_correlation_blocks(self, idx:int, coords_path:str,
+                                    interpolator:str) -> str:
+        """
+        Read the fixed and moving blocks that find-corr-neighbors will need
+        into the page cache, so the correlation workers, and later rounds,
+        do not wait on random reads.
+
+        :param idx: the index of the round
+        :param coords_path: the path to the fixed points
+        :param interpolator: the inverse interpolator, which maps fixed
+        coordinates to moving ones
+        :return: the path to the fixed coordinates sorted in block order
+
+        The blocks of all of the points are read, but find-corr-neighbors
+        only correlates the points nearest its grid points. For adaptive
+        points, that is all of them (see correlation_grid); for the blobs,
+        the extra blocks cost reading time but not correctness.
+        """
+        fixed_coords_path = write_block_ordered_coords(
+            coords_path, self.model.fixed_precomputed_path.get())
+        fixed_coords = np.asarray(load_coords(fixed_coords_path))
+        #
+        # The patch around each point: its radius plus the reach of the
+        # smoothing
+        #
+        patch_radius = [
+            (self.model.find_corr_neighbors_radius[idx].get() +
+             3 * self.model.find_corr_neighbors_sigma[idx].get()) / _.get()
+            for _ in (self.model.x_voxel_size, self.model.y_voxel_size,
+                      self.model.z_voxel_size)]
+        set_status_bar_message(
+            "Round %d: sampling the displacement field" % (idx + 1))
+        self.sample_displacement_field(interpolator)
+        moving_coords = fast_warp_coords(fixed_coords, interpolator,
+                                         self.model.n_workers.get())
+        for name, precomputed_path, coords in (
+                ("fixed", self.model.fixed_precomputed_path.get(),
+                 fixed_coords),
+                ("moving", self.model.moving_precomputed_path.get(),
+                 moving_coords)):
+            def on_progress(n_done, n_blocks, name=name):
+                set_status_bar_message(
+                    "Round %d: read %d of %d %s blocks" %
+                    (idx + 1, n_done, n_blocks, name))
+            prefetch_blocks(precomputed_path, coords, patch_radius,
+                            self.model.n_io_workers.get(), on_progress)
+        return fixed_coords_path
+
+    def on_find_neighbors_points(self):
         with tqdm_progress():
-            find_corr_neighbors([
-                str(_) for _ in (
-                    "--fixed-coords", self.model.fixed_blob_path.get(),
-                    "--fixed-url", fixed_neuroglancer_url(self.model),
-                    "--moving-url", moving_neuroglancer_url(self.model),
-                    "--transform", interpolator_variable.get(),
-                    "--output", self.model.find_neighbors_path[idx].get(),
-                    "--visualization-file", self.model.find_neighbors_pdf_path[idx].get(),
-                    "--sigma-x", sigma_x,
-                    "--sigma-y", sigma_y,
-                    "--sigma-z", sigma_z,
-                    "--radius", self.model.find_corr_neighbors_radius[idx].get(),
-                    "--n-cores", self.model.n_workers.get(),
-                    "--min-correlation",
-                    self.model.find_corr_neighbors_min_correlation[idx].get(),
-                    "--x-grid", self.model.find_corr_neighbors_x_grid[idx].get(),
-                    "--y-grid", self.model.find_corr_neighbors_y_grid[idx].get(),
-                    "--z-grid", self.model.find_corr_neighbors_z_grid[idx].get()
-                )
-            ])
+            self.run_find_neighbors(self.current_round_idx)
         self.update_controls()
 
-    def on_find_neighbors_points(self):
-        idx = self.current_round_idx
+    def run_find_neighbors_points(self, idx:int):
         interpolator_variable = self.model.rough_inverse_interpolator\
             if idx == 0 \
             else self.model.fit_nonrigid_transform_inverse_path[idx-1]
-        with tqdm_progress():
-            find_neighbors([str(_) for _ in (
-                "--fixed-coords", self.fixed_coords_path(),
-                "--moving-coords", self.moving_coords_path(),
-                "--fixed-features",
+        if self.model.find_neighbors_tiled.get():
+            def on_tile_done(n_done, n_tiles):
+                set_status_bar_message(
+                    "Round %d: found neighbors in tile %d of %d" %
+                    (idx + 1, n_done, n_tiles))
+            find_neighbors_tiled(
+                self.fixed_coords_path(),
+                self.moving_coords_path(),
                 self.model.fixed_geometric_features_path.get(),
-                "--moving-features",
                 self.model.moving_geometric_features_path.get(),
-                "--non-rigid-transformation",
                 interpolator_variable.get(),
-                "--output", self.model.find_neighbors_path[idx].get(),
-                "--visualization-file",
+                self.model.find_neighbors_path[idx].get(),
                 self.model.find_neighbors_pdf_path[idx].get(),
-                "--voxel-size", voxel_size(self.model),
-                "--radius", self.model.find_neighbors_radius[idx].get(),
-                "--max-fdist",
+                (self.model.x_voxel_size.get(),
+                 self.model.y_voxel_size.get(),
+                 self.model.z_voxel_size.get()),
+                self.model.find_neighbors_radius[idx].get(),
                 self.model.find_neighbors_feature_distance[idx].get(),
-                "--prom-thresh",
                 self.model.find_neighbors_prominence_threshold[idx].get(),
-                "--max-neighbors",
                 self.model.max_neighbors[idx].get(),
-                "--n-workers", self.model.n_workers.get())
-            ])
-        self.update_controls()
+                self.model.n_workers.get(),
+                tile_size=self.model.find_neighbors_tile_size.get(),
+                progress=on_tile_done)
+            return
+        find_neighbors([str(_) for _ in (
+            "--fixed-coords", self.fixed_coords_path(),
+            "--moving-coords", self.moving_coords_path(),
+            "--fixed-features",
+            self.model.fixed_geometric_features_path.get(),
+            "--moving-features",
+            self.model.moving_geometric_features_path.get(),
+            "--non-rigid-transformation",
+            interpolator_variable.get(),
+            "--output", self.model.find_neighbors_path[idx].get(),
+            "--visualization-file",
+            self.model.find_neighbors_pdf_path[idx].get(),
+            "--voxel-size", voxel_size(self.model),
+            "--radius", self.model.find_neighbors_radius[idx].get(),
+            "--max-fdist",
+            self.model.find_neighbors_feature_distance[idx].get(),
+            "--prom-thresh",
+            self.model.find_neighbors_prominence_threshold[idx].get(),
+            "--max-neighbors",
+            self.model.max_neighbors[idx].get(),
+            "--n-workers", self.model.n_workers.get())
+        ])
+
+    def run_match_statistics(self, idx:int):
+        """
+        Compute the distance and coherence of a round's matches for filter
+        matches and its preview
+
+        :param idx: the index of the round
+        :return: the distance and coherence of each match
+        """
+        set_status_bar_message("Round %d: measuring the matches" % (idx + 1))
+        transform_path = self.model.rough_inverse_interpolator.get() \
+            if idx == 0 \
+            else self.model.fit_nonrigid_transform_inverse_path[idx-1].get()
+        return compute_match_statistics(
+            self.model.find_neighbors_path[idx].get(),
+            transform_path,
+            (self.model.x_voxel_size.get(),
+             self.model.y_voxel_size.get(),
+             self.model.z_voxel_size.get()),
+            self.model.n_workers.get())
+
+    def load_match_statistics(self, idx:int):
+        """
+        The distance and coherence of a round's matches or None if they have
+        not been computed, by this version, since the round's find-neighbors
+        was run
+
+        :param idx: the index of the round
+        """
+        find_neighbors_path = self.model.find_neighbors_path[idx].get()
+        path = statistics_path(find_neighbors_path)
+        if not os.path.exists(find_neighbors_path) or \
+                is_stale([path], [find_neighbors_path]):
+            return None
+        key = (path, os.stat(path).st_mtime)
+        if key not in self.match_statistics:
+            self.match_statistics[key] = read_match_statistics(path)
+        return self.match_statistics[key]
+
+    def update_filter_matches_preview(self, *args):
+        statistics = self.load_match_statistics(self.current_round_idx)
+        if statistics is None:
+            self.filter_matches_preview_widget.setText("")
+            return
+        distance, coherence = statistics
+        n_passing = count_passing(distance, coherence,
+                                  self.maximum_distance_widget.value(),
+                                  self.minimum_coherence_widget.value())
+        self.filter_matches_preview_widget.setText(
+            "%d of %d matches pass these thresholds" %
+            (n_passing, len(distance)))
 
     def on_show_find_neighbors_results(self):
         idx = self.current_round_idx
@@ -615,20 +979,43 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         QDesktopServices.openUrl(QUrl(url))
 
     def on_filter_matches(self):
-        idx = self.current_round_idx
         with tqdm_progress():
-            filter_matches([
-                "--input", self.model.find_neighbors_path[idx].get(),
-                "--output", self.model.filter_matches_path[idx].get(),
-                "--max-distance",
-                str(self.model.filter_matches_max_distance[idx].get()),
-                "--min-coherence",
-                str(self.model.filter_matches_min_coherence[idx].get()),
-                "--visualization-file",
-                self.model.filter_matches_pdf_path[idx].get()
-            ])
+            self.run_filter_matches(self.current_round_idx)
         self.update_controls()
 
+    def run_filter_matches(self, idx:int):
+        """
+        Keep the matches of a round whose distance and coherence pass the
+        round's thresholds. These are the statistics and thresholds of the
+        preview, so it counts the matches that are kept.
+
+        :param idx: the index of the round
+        """
+        distance, coherence = self.run_match_statistics(idx)
+        max_distance = self.model.filter_matches_max_distance[idx].get()
+        min_coherence = self.model.filter_matches_min_coherence[idx].get()
+        n_kept = write_filtered_matches(
+            self.model.find_neighbors_path[idx].get(),
+            self.model.filter_matches_path[idx].get(),
+            passing_matches(distance, coherence, max_distance, min_coherence))
+        write_filter_visualization(
+            self.model.filter_matches_pdf_path[idx].get(),
+            distance, coherence, max_distance, min_coherence)
+        set_status_bar_message("Round %d: kept %d of %d matches" %
+                               (idx + 1, n_kept, len(distance)))
+        write_parameters([self.model.filter_matches_path[idx].get()],
+                         self.filter_matches_parameters(idx))
+
+    def filter_matches_parameters(self, idx:int) -> dict:
+        """
+        The settings that a round's filtered matches depend on
+
+        :param idx: the index of the round
+        """
+        return dict(
+            max_distance=self.model.filter_matches_max_distance[idx].get(),
+            min_coherence=self.model.filter_matches_min_coherence[idx].get())
+
     def on_show_filter_matches_results(self):
         idx = self.current_round_idx
         path = self.model.filter_matches_pdf_path[idx].get()
@@ -636,20 +1023,161 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         QDesktopServices.openUrl(QUrl(url))
 
     def on_fit_nonrigid_transform(self):
-        idx = self.current_round_idx
         with tqdm_progress():
-            fit_nonrigid_transform([
-                "--input", self.model.filter_matches_path[idx].get(),
-                "--output", self.model.fit_nonrigid_transform_path[idx].get(),
-                "--fixed-url", fixed_neuroglancer_url(self.model),
-                "--moving-url", moving_neuroglancer_url(self.model),
-                "--inverse",
-                self.model.fit_nonrigid_transform_inverse_path[idx].get(),
-                "--visualization-file",
-                self.model.fit_nonrigid_transform_pdf_path[idx].get()
-            ])
+            self.run_fit_nonrigid_transform(self.current_round_idx)
+        self.update_controls()
+
+    def run_fit_nonrigid_transform(self, idx:int):
+        fit_nonrigid_transform([
+            "--input", self.model.filter_matches_path[idx].get(),
+            "--output", self.model.fit_nonrigid_transform_path[idx].get(),
+            "--fixed-url", fixed_neuroglancer_url(self.model),
+            "--moving-url", moving_neuroglancer_url(self.model),
+            "--inverse",
+            self.model.fit_nonrigid_transform_inverse_path[idx].get(),
+            "--visualization-file",
+            self.model.fit_nonrigid_transform_pdf_path[idx].get()
+        ])
+        #
+        # The inverse transform is the one that the later rounds apply to
+        # the fixed points. Its binary copy is loaded and applied in-process
+        # rather than by running warp-points on the pickle.
+        #
+        set_status_bar_message(
+            "Round %d: converting the inverse transform" % (idx + 1))
+        fixed, _ = read_matches(self.model.filter_matches_path[idx].get())
+        convert_checked_interpolator(
+            self.model.fit_nonrigid_transform_inverse_path[idx].get(),
+            fixed, self.model.n_workers.get())
+
+    def sample_displacement_field(self, interpolator:str):
+        """
+        Sample a fixed -> moving interpolator as a displacement field, for
+        quick estimates of where the fixed points land, unless the field is
+        up to date or the fixed volume's shape is not known
+
+        :param interpolator: the interpolator from fixed to moving coordinates
+        """
+        shapes = precomputed_level_shapes(
+            self.model.fixed_precomputed_path.get())
+        if 1 not in shapes or not os.path.exists(interpolator):
+            return
+        write_displacement_field(interpolator, shapes[1][::-1],
+                                 self.model.n_workers.get())
+
+    def on_run_all_rounds(self, *args):
+        """
+        Run the refinement rounds in one go, skipping the steps whose
+        outputs are newer than their inputs and were made with the current
+        settings.
+
+        After each round, the round's transform is compared with the previous
+        one and with its matches. The rounds stop early if the alignment has
+        converged and, if "Add rounds until converged" is checked, rounds
+        are added until it does.
+        """
+        log = []
+        self.model.convergence_log.set("")
+        with tqdm_progress():
+            try:
+                uses_points = any([
+                    self.model.find_neighbors_method[idx].get() ==
+                    FindNeighborsMethod.POINTS.value
+                    for idx in range(self.model.n_refinement_rounds.get())])
+                if uses_points:
+                    self.run_geometric_features_if_stale()
+                sample = sample_coords(self.fixed_coords_path())
+                idx = 0
+                while idx < self.model.n_refinement_rounds.get():
+                    self.run_round_if_stale(idx)
+                    set_status_bar_message(
+                        "Round %d: computing convergence statistics" %
+                        (idx + 1))
+                    statistics = self.round_statistics(idx, sample)
+                    converged = has_converged(
+                        statistics,
+                        self.model.convergence_transform_tolerance.get(),
+                        self.model.convergence_residual_tolerance.get(),
+                        not self.model.convergence_stop_on_either.get())
+                    is_last = idx + 1 == self.model.n_refinement_rounds.get()
+                    if converged:
+                        decision = "converged, stopping"
+                    elif not is_last:
+                        decision = "continuing"
+                    elif not self.model.auto_extend_rounds.get():
+                        decision = "not converged, last round"
+                    elif idx + 1 >= MAX_REFINEMENT_ROUNDS:
+                        decision = "not converged, maximum number of rounds"
+                    else:
+                        decision = "not converged, adding a round"
+                        self.model.n_refinement_rounds.set(idx + 2)
+                    log.append("Round %d: %s - %s" %
+                               (idx + 1, statistics, decision))
+                    self.model.convergence_log.set("\n".join(log))
+                    if converged:
+                        break
+                    idx += 1
+            finally:
+                clear_status_bar_message()
         self.update_controls()
 
+    def round_statistics(self, idx:int, sample):
+        """
+        Compute the convergence statistics of a refinement round
+
+        :param idx: the index of the round
+        :param sample: fixed coordinates used to compare the round's transform
+        with the previous round's
+        """
+        previous_interpolator = self.model.rough_inverse_interpolator.get() \
+            if idx == 0 \
+            else self.model.fit_nonrigid_transform_inverse_path[idx-1].get()
+        return compute_round_statistics(
+            self.model.find_neighbors_path[idx].get(),
+            self.model.fit_nonrigid_transform_inverse_path[idx].get(),
+            previous_interpolator,
+            sample,
+            (self.model.x_voxel_size.get(),
+             self.model.y_voxel_size.get(),
+             self.model.z_voxel_size.get()),
+            self.model.n_workers.get())
+
+    def run_geometric_features_if_stale(self):
+        if is_stale([self.model.fixed_geometric_features_path.get()],
+                    [self.fixed_coords_path()],
+                    self.geometric_features_parameters()):
+            set_status_bar_message("Calculating fixed geometric features")
+            self.run_fixed_geometric_features()
+        if is_stale([self.model.moving_geometric_features_path.get()],
+                    [self.moving_coords_path()],
+                    self.geometric_features_parameters()):
+            set_status_bar_message("Calculating moving geometric features")
+            self.run_moving_geometric_features()
+
+    def run_round_if_stale(self, idx:int):
+        """
+        Run the steps of a refinement round that are out of date: whose
+        outputs are older than their inputs or were made with other settings
+
+        :param idx: the index of the round
+        """
+        find_neighbors_path = self.model.find_neighbors_path[idx].get()
+        filter_matches_path = self.model.filter_matches_path[idx].get()
+        if is_stale([find_neighbors_path], self.find_neighbors_paths(idx),
+                    self.find_neighbors_parameters(idx)):
+            set_status_bar_message("Round %d: finding neighbors" % (idx + 1))
+            self.run_find_neighbors(idx)
+        if is_stale([filter_matches_path], [find_neighbors_path],
+                    self.filter_matches_parameters(idx)):
+            set_status_bar_message("Round %d: filtering matches" % (idx + 1))
+            self.run_filter_matches(idx)
+        if is_stale([self.model.fit_nonrigid_transform_path[idx].get(),
+                     self.model.fit_nonrigid_transform_inverse_path[idx].get()],
+                    [filter_matches_path]):
+            set_status_bar_message(
+                "Round %d: fitting nonrigid transform" % (idx + 1))
+            self.run_fit_nonrigid_transform(idx)
+
     def on_show_fit_nonrigid_transform_results(self):
         idx = self.current_round_idx
         path = self.model.fit_nonrigid_transform_pdf_path[idx].get()
@@ -705,6 +1233,14 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
     def current_round_idx(self):
         return self.current_refinement_round_widget.value() - 1
 
+    def on_convergence_stop_on_either_changed(self, *args):
+        if self.model.convergence_stop_on_either.get():
+            self.convergence_combination_widget.setText(
+                "or median residual is less than (μm):")
+        else:
+            self.convergence_combination_widget.setText(
+                "and median residual is less than (μm):")
+
     def on_current_round_changed(self, *args):
         variables_and_widgets = (
             (self.model.max_neighbors,
@@ -750,40 +1286,38 @@ class FineAlignmentWidget(QWidget, OnActivateMixin):
         self.update_controls()
 
     def on_output_path_changed(self, *args):
-        self.model.fixed_geometric_features_path.set(
-            os.path.join(self.model.output_path.get(),
-                         "fixed-geometric-features.npy"))
-        self.model.moving_geometric_features_path.set(
-            os.path.join(self.model.output_path.get(),
-                         "moving-geometric-features.npy"))
-        for idx in range(self.model.n_refinement_rounds.get()):
-            self.model.find_neighbors_path[idx].set(os.path.join(
-                self.model.output_path.get(),
-                "find-neighbors_round_%d.json" % (idx+1)))
-            self.model.find_neighbors_pdf_path[idx].set(os.path.join(
-                self.model.output_path.get(),
-                "find-neighbors_round_%d.pdf" % (idx+1)
-            ))
-            self.model.filter_matches_path[idx].set(os.path.join(
-                self.model.output_path.get(),
-                "filter-matches_round_%d.json" % (idx+1)
-            ))
-            self.model.filter_matches_pdf_path[idx].set(os.path.join(
-                self.model.output_path.get(),
-                "filter-matches_round_%d.pdf" % (idx+1)
-            ))
-            self.model.fit_nonrigid_transform_path[idx].set(
-                os.path.join(
+        with self.model.batch():
+            self.model.fixed_geometric_features_path.set(
+                os.path.join(self.model.output_path.get(),
+                             "fixed-geometric-features.npy"))
+            self.model.moving_geometric_features_path.set(
+                os.path.join(self.model.output_path.get(),
+                             "moving-geometric-features.npy"))
+            for idx in range(self.model.n_refinement_rounds.get()):
+                self.model.find_neighbors_path[idx].set(os.path.join(
                     self.model.output_path.get(),
-                    "fit-nonrigid-transform_round_%d.pkl" % (idx+1)))
-            self.model.fit_nonrigid_transform_inverse_path[idx].set(
-                os.path.join(
+                    "find-neighbors_round_%d.json" % (idx+1)))
+                self.model.find_neighbors_pdf_path[idx].set(os.path.join(
                     self.model.output_path.get(),
-                    "fit-nonrigid-transform-inverse_round_%d.pkl" % (idx+1)))
-            self.model.fit_nonrigid_transform_pdf_path[idx].set(
-                os.path.join(
+                    "find-neighbors_round_%d.pdf" % (idx+1)
+                ))
+                self.model.filter_matches_path[idx].set(os.path.join(
                     self.model.output_path.get(),
-                    "fit-nonrigid-transform_round_%d.pdf" % (idx+1)))
-
-
-
+                    "filter-matches_round_%d.json" % (idx+1)
+                ))
+                self.model.filter_matches_pdf_path[idx].set(os.path.join(
+                    self.model.output_path.get(),
+                    "filter-matches_round_%d.pdf" % (idx+1)
+                ))
+                self.model.fit_nonrigid_transform_path[idx].set(
+                    os.path.join(
+                        self.model.output_path.get(),
+                        "fit-nonrigid-transform_round_%d.pkl" % (idx+1)))
+                self.model.fit_nonrigid_transform_inverse_path[idx].set(
+                    os.path.join(
+                        self.model.output_path.get(),
+                        "fit-nonrigid-transform-inverse_round_%d.pkl" % (idx+1)))
+                self.model.fit_nonrigid_transform_pdf_path[idx].set(
+                    os.path.join(
+                        self.model.output_path.get(),
+                        "fit-nonrigid-transform_round_%d.pdf" % (idx+1)))
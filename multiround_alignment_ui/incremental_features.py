@@ -0,0 +1,173 @@
+#
+# Geometric features that are only recomputed for the cells whose nearest
+# neighbors have changed since the features were last computed.
+#
+import json
+import os
+import tempfile
+import typing
+
+import numpy as np
+from scipy.spatial import cKDTree
+from phathom.pipeline.geometric_features_cmd import main as geometric_features
+
+from .feature_storage import load_coords, load_geometric_features, \
+    save_geometric_features
+
+#
+# If more than this fraction of the cells have changed neighborhoods, all of
+# the features are recomputed.
+#
+MAX_INCREMENTAL_FRACTION = .5
+
+
+def features_cells_path(features_path:str) -> str:
+    """
+    The path to the file recording the cells a features file was built from
+
+    :param features_path: the path to the .npy features file
+    """
+    return os.path.splitext(features_path)[0] + "-cells.npz"
+
+
+def neighborhoods(coords:np.ndarray, voxel_size:typing.Sequence[float],
+                  n_neighbors:int, idxs:np.ndarray=None) -> np.ndarray:
+    """
+    The coordinates of each cell's nearest neighbors
+
+    :param coords: N x 3 x, y, z coordinates
+    :param voxel_size: the x, y, z voxel size in microns
+    :param n_neighbors: the number of neighbors of each cell
+    :param idxs: the cells to find the neighbors of or None for all
+    :return: an M x n_neighbors x 3 array of the neighbors' coordinates,
+    nearest first
+    """
+    scaled = coords * np.asarray(voxel_size, float)
+    if idxs is None:
+        idxs = np.arange(len(coords))
+    tree = cKDTree(scaled)
+    _, neighbors = tree.query(scaled[idxs], n_neighbors + 1)
+    #
+    # The nearest "neighbor" is the cell itself
+    #
+    return coords[neighbors[:, 1:]]
+
+
+def run_geometric_features(coords:np.ndarray, voxel_size:str,
+                           n_neighbors:int, n_workers:int) -> np.ndarray:
+    """
+    Run phathom-geometric-features on some coordinates
+
+    :param coords: N x 3 x, y, z coordinates
+    :param voxel_size: the comma-separated x, y, z voxel size
+    :param n_neighbors: the number of neighbors of each cell
+    :param n_workers: the number of worker processes to use
+    :return: the features, one row per cell
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, "coords.json")
+        output_path = os.path.join(tempdir, "features.npy")
+        with open(input_path, "w") as fd:
+            json.dump(coords.tolist(), fd)
+        geometric_features([
+            "--input", input_path,
+            "--output", output_path,
+            "--voxel-size", voxel_size,
+            "--n-workers", str(n_workers),
+            "--n-neighbors", str(n_neighbors)
+        ])
+        return np.load(output_path)
+
+
+def compute_geometric_features(coords_path:str,
+                               features_path:str,
+                               voxel_size:str,
+                               n_neighbors:int,
+                               n_workers:int) -> int:
+    """
+    Compute the geometric features of the cells in a coordinates file,
+    reusing the rows of the previous features file for the cells whose
+    neighborhoods are unchanged.
+
+    A cell's features depend only on its nearest neighbors, so a cell is
+    recomputed if it is new or any of its neighbors were added or removed.
+    Those cells are recomputed together with their neighbors, which gives
+    them the same neighborhoods as in the whole set.
+
+    :param coords_path: the path to the JSON list of x, y, z coordinates
+    :param features_path: the path to the .npy features file
+    :param voxel_size: the comma-separated x, y, z voxel size
+    :param n_neighbors: the number of neighbors of each cell
+    :param n_workers: the number of worker processes to use
+    :return: the number of cells whose features were computed
+    """
+    coords = np.array(load_coords(coords_path))
+    voxel_size_xyz = [float(_) for _ in voxel_size.split(",")]
+    cells_path = features_cells_path(features_path)
+    reuse = None
+    if os.path.exists(features_path) and os.path.exists(cells_path):
+        with np.load(cells_path) as cells:
+            if int(cells["n_neighbors"]) == n_neighbors and \
+                    np.allclose(cells["voxel_size"], voxel_size_xyz):
+                reuse = find_reusable_rows(
+                    cells["coords"], coords, voxel_size_xyz, n_neighbors)
+    if reuse is None or \
+            np.sum(reuse < 0) > len(coords) * MAX_INCREMENTAL_FRACTION:
+        features = run_geometric_features(coords, voxel_size, n_neighbors,
+                                          n_workers)
+        n_computed = len(coords)
+    else:
+        old_features = load_geometric_features(features_path)
+        features = np.zeros((len(coords),) + old_features.shape[1:],
+                            old_features.dtype)
+        reused = np.where(reuse >= 0)[0]
+        features[reused] = old_features[reuse[reused]]
+        changed = np.where(reuse < 0)[0]
+        n_computed = len(changed)
+        if n_computed > 0:
+            #
+            # The changed cells and their neighbors
+            #
+            tree = cKDTree(coords * np.asarray(voxel_size_xyz))
+            _, neighbors = tree.query(
+                coords[changed] * np.asarray(voxel_size_xyz),
+                n_neighbors + 1)
+            subset = np.unique(np.concatenate([changed, neighbors.ravel()]))
+            subset_features = run_geometric_features(
+                coords[subset], voxel_size, n_neighbors, n_workers)
+            features[changed] = subset_features[
+                np.searchsorted(subset, changed)]
+        del old_features
+    save_geometric_features(features_path, features)
+    np.savez(cells_path, coords=coords, n_neighbors=n_neighbors,
+             voxel_size=voxel_size_xyz)
+    return n_computed
+
+
+def find_reusable_rows(old_coords:np.ndarray, coords:np.ndarray,
+                       voxel_size:typing.Sequence[float],
+                       n_neighbors:int) -> np.ndarray:
+    """
+    Find the cells whose features can be copied from the old features
+
+    :param old_coords: the coordinates the old features were built from
+    :param coords: the new coordinates
+    :param voxel_size: the x, y, z voxel size in microns
+    :param n_neighbors: the number of neighbors of each cell
+    :return: for each new cell, the row of its old features or -1 if they
+    must be recomputed
+    """
+    reuse = -np.ones(len(coords), int)
+    if len(old_coords) <= n_neighbors or len(coords) <= n_neighbors:
+        return reuse
+    old_rows = dict([(tuple(_), idx) for idx, _ in enumerate(old_coords)])
+    rows = np.array([old_rows.get(tuple(_), -1) for _ in coords])
+    present = np.where(rows >= 0)[0]
+    if len(present) == 0:
+        return reuse
+    new_neighborhoods = neighborhoods(coords, voxel_size, n_neighbors, present)
+    old_neighborhoods = neighborhoods(old_coords, voxel_size, n_neighbors,
+                                      rows[present])
+    unchanged = np.all(new_neighborhoods == old_neighborhoods, axis=(1, 2))
+    reuse[present[unchanged]] = rows[present[unchanged]]
+    return reuse
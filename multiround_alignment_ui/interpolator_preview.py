@@ -0,0 +1,210 @@
+#
+# A live preview of the rough alignment while correspondence points are
+# being placed: a thin-plate spline is fit to the points and the moving
+# volume, warped into the fixed volume's space, is shown as a layer of the
+# reference viewer.
+#
+import typing
+import warnings
+
+import numpy as np
+import scipy.linalg
+from scipy import ndimage
+import neuroglancer
+from nuggt.utils.ngutils import layer, green_shader
+
+from .nuggt_points import NuggtPoints
+from .rigid_initialization import read_level
+from .utils import precomputed_level_shapes
+
+#
+# The preview is made at the finest level whose largest dimension is at most
+# this.
+#
+INTERPOLATOR_PREVIEW_MAX_DIMENSION = 192
+#
+# The spline is evaluated every this many voxels of the preview and the
+# coordinates in between are interpolated linearly.
+#
+INTERPOLATOR_PREVIEW_GRID_STEP = 4
+#
+# The name of the preview layer in the reference viewer
+#
+INTERPOLATOR_PREVIEW_LAYER = "warped-moving"
+
+
+class ThinPlateSpline:
+    """
+    A 3-D thin-plate spline, using the biharmonic kernel U(r) = r, that maps
+    source points onto destination points
+    """
+
+    def __init__(self, source:np.ndarray, dest:np.ndarray,
+                 regularization:float=0.0):
+        """
+        :param source: an N x 3 array of points
+        :param dest: the N x 3 array of points that the source points map to
+        :param regularization: zero to interpolate the points exactly,
+        larger to smooth the mapping
+        """
+        source = np.asarray(source, float)
+        dest = np.asarray(dest, float)
+        #
+        # Work in normalized coordinates to keep the system well-conditioned
+        #
+        self.offset = source.mean(axis=0)
+        self.scale = max(np.abs(source - self.offset).max(), 1.0)
+        self.control_points = (source - self.offset) / self.scale
+        n = len(source)
+        a = np.zeros((n + 4, n + 4))
+        a[:n, :n] = self.kernel(self.control_points, self.control_points) + \
+            regularization * np.eye(n)
+        a[:n, n] = 1
+        a[:n, n + 1:] = self.control_points
+        a[n, :n] = 1
+        a[n + 1:, :n] = self.control_points.T
+        b = np.zeros((n + 4, 3))
+        b[:n] = dest
+        #
+        # The system is symmetric, so it is solved directly. Duplicated
+        # points make it singular and only then is the much slower lstsq
+        # used instead.
+        #
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", scipy.linalg.LinAlgWarning)
+                coefficients = scipy.linalg.solve(a, b, assume_a="sym")
+        except (np.linalg.LinAlgError, scipy.linalg.LinAlgWarning):
+            coefficients = np.linalg.lstsq(a, b, rcond=None)[0]
+        self.weights = coefficients[:n]
+        self.affine = coefficients[n:]
+
+    @staticmethod
+    def kernel(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+        """The distance between each point in a and each point in b"""
+        return np.sqrt(((a[:, np.newaxis, :] - b[np.newaxis, :, :]) ** 2)
+                       .sum(axis=2))
+
+    def __call__(self, points:np.ndarray, chunk_size=16384) -> np.ndarray:
+        """
+        Map points
+
+        :param points: an M x 3 array of points in the source space
+        :param chunk_size: the number of points to map at a time, to bound
+        the memory used for the kernel
+        :return: the M x 3 array of mapped points
+        """
+        points = (np.asarray(points, float) - self.offset) / self.scale
+        result = np.zeros(points.shape)
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            result[start:start + chunk_size] = \
+                self.kernel(chunk, self.control_points).dot(self.weights) + \
+                self.affine[0] + chunk.dot(self.affine[1:])
+        return result
+
+
+def warp_volume(moving:np.ndarray, moving_level:int,
+                transform:typing.Callable[[np.ndarray], np.ndarray],
+                fixed_shape:typing.Sequence[int], fixed_level:int,
+                grid_step:int=INTERPOLATOR_PREVIEW_GRID_STEP) -> np.ndarray:
+    """
+    Warp the moving volume into the fixed volume's space
+
+    :param moving: the moving volume at moving_level
+    :param moving_level: the level of the moving volume, e.g. 1, 2, 4
+    :param transform: a function that maps an N x 3 array of z, y, x
+    fixed coordinates at level 1 to moving coordinates at level 1
+    :param fixed_shape: the shape of the fixed volume at fixed_level
+    :param fixed_level: the level of the warped volume
+    :param grid_step: evaluate the transform every this many voxels
+    :return: the warped volume, with the shape, fixed_shape
+    """
+    grid_axes = [np.unique(np.append(np.arange(0, size, grid_step), size - 1))
+                 for size in fixed_shape]
+    grid = np.stack(np.meshgrid(*grid_axes, indexing="ij"), -1)
+    grid_shape = grid.shape[:-1]
+    moving_coords = transform(grid.reshape(-1, 3) * fixed_level) / \
+        moving_level
+    moving_coords = moving_coords.reshape(grid_shape + (3,))
+    #
+    # The fractional index of each voxel in the grid
+    #
+    fractional = [np.interp(np.arange(size), axis, np.arange(len(axis)))
+                  for size, axis in zip(fixed_shape, grid_axes)]
+    fractional = np.meshgrid(*fractional, indexing="ij")
+    coords = [ndimage.map_coordinates(moving_coords[..., idx], fractional,
+                                      order=1)
+              for idx in range(3)]
+    return ndimage.map_coordinates(moving, coords, order=1, cval=0)\
+        .astype(moving.dtype)
+
+
+class InterpolatorPreview:
+    """
+    Shows the moving volume, warped by a thin-plate spline fit to the
+    correspondence points, as a layer of the reference viewer.
+    """
+
+    def __init__(self, viewer:neuroglancer.Viewer,
+                 fixed_path:str, moving_path:str, moving_url:str,
+                 voxel_size:typing.Sequence[float]):
+        """
+        :param viewer: the reference viewer
+        :param fixed_path: the path to the fixed precomputed volume
+        :param moving_path: the path to the moving precomputed volume
+        :param moving_url: the URL of the moving precomputed volume
+        :param voxel_size: the x, y, z voxel size at level 1 in nanometers
+        """
+        self.viewer = viewer
+        self.fixed_shapes = precomputed_level_shapes(fixed_path)
+        self.moving_shapes = precomputed_level_shapes(moving_path)
+        self.moving_url = moving_url
+        self.voxel_size = voxel_size
+        self.level = self.choose_level()
+        self.moving = None
+        self.digest = None
+
+    def choose_level(self) -> int:
+        """The finest level that is small enough for the preview"""
+        levels = sorted(set(self.fixed_shapes).intersection(
+            self.moving_shapes))
+        for level in levels:
+            if max(self.fixed_shapes[level]) <= \
+                    INTERPOLATOR_PREVIEW_MAX_DIMENSION and \
+                    max(self.moving_shapes[level]) <= \
+                    INTERPOLATOR_PREVIEW_MAX_DIMENSION:
+                return level
+        return levels[-1]
+
+    def load_moving(self):
+        """Read the moving volume at the preview level and scale it to 8 bits"""
+        moving = read_level(self.moving_url, self.level).astype(np.float32)
+        low, high = np.percentile(moving, [1, 99.9])
+        self.moving = (np.clip((moving - low) / max(high - low, 1), 0, 1)
+                       * 255).astype(np.uint8)
+
+    def update(self, points:NuggtPoints) -> bool:
+        """
+        Refit the spline and show the warped moving volume
+
+        :param points: the correspondence points, rescaled to level 1
+        :return: True if the preview was updated, False if there are too
+        few points or the points have not changed.
+        """
+        if len(points) < 4:
+            return False
+        digest = points.digest()
+        if digest == self.digest:
+            return False
+        if self.moving is None:
+            self.load_moving()
+        spline = ThinPlateSpline(points.reference, points.moving)
+        warped = warp_volume(self.moving, self.level, spline,
+                             self.fixed_shapes[self.level], self.level)
+        voxel_size = [_ * self.level for _ in self.voxel_size]
+        with self.viewer.txn() as txn:
+            layer(txn, INTERPOLATOR_PREVIEW_LAYER, warped, green_shader, 1.0,
+                  voxel_size=voxel_size)
+        self.digest = digest
+        return True
@@ -0,0 +1,137 @@
+#
+# A read-only array that reads a level of a precomputed volume on demand, so
+# that Neuroglancer can serve volumes that do not fit in memory.
+#
+import collections
+import itertools
+import threading
+import typing
+
+import numpy as np
+from precomputed_tif.client import ArrayReader
+
+#
+# The edge length of the blocks that are read and cached. This matches the
+# block size of the blockfs volumes that the preprocessing step makes.
+#
+BLOCK_SIZE = 64
+#
+# The default size of the block cache in bytes
+#
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class LazyVolume:
+    """
+    An array-like view of one level of a precomputed volume
+
+    Slicing the volume reads only the blocks that overlap the slice. The most
+    recently used blocks are kept in a cache that is shared by the threads
+    of the Neuroglancer server.
+    """
+
+    def __init__(self, url:str, level:int, format:str="blockfs",
+                 cache_size:int=DEFAULT_CACHE_SIZE):
+        """
+        :param url: the URL of the precomputed volume
+        :param level: the level to read, e.g. 1, 2, 4...
+        :param format: the format of the precomputed volume
+        :param cache_size: the maximum number of bytes of blocks to keep
+        """
+        self.reader = ArrayReader(url, format=format, level=level)
+        self.shape = tuple(self.reader.shape)
+        self.dtype = np.dtype(self.reader.dtype)
+        self.ndim = len(self.shape)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        result = self[:, :, :]
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+    def block_extent(self, block_idx:typing.Sequence[int]) \
+            -> typing.Tuple[typing.Tuple[int, int], ...]:
+        """
+        The start and stop of a block along each axis
+
+        :param block_idx: the z, y, x index of the block
+        """
+        return tuple(
+            (idx * BLOCK_SIZE, min((idx + 1) * BLOCK_SIZE, size))
+            for idx, size in zip(block_idx, self.shape))
+
+    def get_block(self, block_idx:typing.Tuple[int, int, int]) -> np.ndarray:
+        """
+        Get a block, from the cache if possible
+
+        :param block_idx: the z, y, x index of the block
+        """
+        with self.lock:
+            block = self.cache.get(block_idx)
+            if block is not None:
+                self.cache.move_to_end(block_idx)
+                return block
+        (z0, z1), (y0, y1), (x0, x1) = self.block_extent(block_idx)
+        block = np.asarray(self.reader[z0:z1, y0:y1, x0:x1])
+        with self.lock:
+            if block_idx not in self.cache:
+                self.cache[block_idx] = block
+                self.cache_bytes += block.nbytes
+                while self.cache_bytes > self.cache_size and \
+                        len(self.cache) > 1:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cache_bytes -= evicted.nbytes
+        return block
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices for a %d-d volume" % self.ndim)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        starts, stops, final_key = [], [], []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step < 0:
+                    raise IndexError("Negative steps are not supported")
+                stop = max(start, stop)
+                final_key.append(slice(None, None, step))
+            else:
+                start = int(k)
+                if start < 0:
+                    start += size
+                if start < 0 or start >= size:
+                    raise IndexError("Index %d is out of bounds for size %d" %
+                                     (int(k), size))
+                stop = start + 1
+                final_key.append(0)
+            starts.append(start)
+            stops.append(stop)
+        result = np.zeros([stop - start for start, stop in zip(starts, stops)],
+                          self.dtype)
+        if result.size > 0:
+            block_ranges = [range(start // BLOCK_SIZE,
+                                  (stop - 1) // BLOCK_SIZE + 1)
+                            for start, stop in zip(starts, stops)]
+            for block_idx in itertools.product(*block_ranges):
+                extent = self.block_extent(block_idx)
+                src, dest = [], []
+                for (b0, b1), start, stop in zip(extent, starts, stops):
+                    i0, i1 = max(b0, start), min(b1, stop)
+                    src.append(slice(i0 - b0, i1 - b0))
+                    dest.append(slice(i0 - start, i1 - start))
+                block = self.get_block(block_idx)
+                result[tuple(dest)] = block[tuple(src)]
+        return result[tuple(final_key)]
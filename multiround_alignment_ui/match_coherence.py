@@ -0,0 +1,228 @@
+#
+# Filtering of the matches of find-neighbors by per-match statistics. The
+# statistics are computed once per round, so that the number of matches that
+# pass a choice of thresholds can be previewed as the thresholds change, and
+# the filter applies the same thresholds to the same statistics.
+#
+import json
+import os
+import typing
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy.spatial import cKDTree
+
+from .convergence import match_keys, read_matches, warp_coords
+from .utils import is_stale
+
+#
+# The number of neighboring matches whose displacements are compared to a
+# match's displacement
+#
+COHERENCE_NEIGHBORS = 10
+#
+# The precision of a match, in voxels. A match's deviation from its neighbors
+# is measured relative to their scatter plus this, so that a field that fits
+# the matches almost exactly does not make every match look incoherent.
+#
+COHERENCE_NOISE = 0.1
+#
+# The version of the statistics saved next to a match file. Statistics saved
+# by another version are recomputed.
+#
+STATISTICS_VERSION = 2
+
+
+def statistics_path(find_neighbors_path:str) -> str:
+    """
+    The path to the statistics of a find-neighbors match file
+
+    :param find_neighbors_path: the path to the match file
+    """
+    return os.path.splitext(find_neighbors_path)[0] + "-statistics.npz"
+
+
+def displacement_coherence(coords:np.ndarray, displacements:np.ndarray,
+                           n_neighbors:int=COHERENCE_NEIGHBORS,
+                           noise:float=0.0) -> np.ndarray:
+    """
+    How well each match's displacement agrees with its neighbors'
+
+    This is the normalized median test: the distance of a match's
+    displacement from the median of its neighbors' displacements, relative
+    to the median distance of the neighbors' displacements from it. Being
+    relative, it works as well for the residuals after a fit, which are
+    close to zero, as for the displacements before one.
+
+    :param coords: N x 3 positions of the matches in microns
+    :param displacements: N x 3 displacement of each match in microns
+    :param n_neighbors: the number of neighbors to compare against
+    :param noise: the precision of the displacements, in microns, which is
+    added to the neighbors' scatter
+    :return: 1 / (1 + r) where r is the normalized distance, from 1 for a
+    match that agrees perfectly to 0. Outliers of the normalized median
+    test, r > 2, have a coherence of less than 1/3.
+    """
+    n_neighbors = min(n_neighbors, len(coords) - 1)
+    if n_neighbors < 1:
+        return np.ones(len(coords))
+    _, neighbors = cKDTree(coords).query(coords, n_neighbors + 1)
+    #
+    # The first neighbor is the match itself
+    #
+    neighbor_displacements = displacements[neighbors[:, 1:]]
+    median = np.median(neighbor_displacements, axis=1)
+    deviation = np.linalg.norm(displacements - median, axis=1)
+    scatter = np.median(np.linalg.norm(
+        neighbor_displacements - median[:, None], axis=2), axis=1) + noise
+    r = deviation / np.maximum(scatter, np.finfo(float).tiny)
+    return 1 / (1 + r)
+
+
+def read_match_statistics(path:str) \
+        -> typing.Optional[typing.Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read the statistics saved by compute_match_statistics
+
+    :param path: the path to the statistics file
+    :return: the distance and coherence of each match or None if the file
+    was written by another version
+    """
+    with np.load(path) as statistics:
+        if "version" not in statistics or \
+                int(statistics["version"]) != STATISTICS_VERSION:
+            return None
+        return statistics["distance"], statistics["coherence"]
+
+
+def compute_match_statistics(find_neighbors_path:str,
+                             transform_path:str,
+                             voxel_size:typing.Sequence[float],
+                             n_workers:int) -> typing.Tuple[np.ndarray,
+                                                            np.ndarray]:
+    """
+    Compute each match's distance and coherence
+
+    The statistics are saved next to the match file and are only recomputed
+    when the match file changes.
+
+    :param find_neighbors_path: the path to the find-neighbors match file
+    :param transform_path: the fixed -> moving interpolator that
+    find-neighbors started from
+    :param voxel_size: the x, y, z voxel size in microns
+    :param n_workers: the number of worker processes to use
+    :return: the distance, in microns, between each warped fixed point and its
+    moving point and the coherence of each match's displacement
+    """
+    path = statistics_path(find_neighbors_path)
+    if not is_stale([path], [find_neighbors_path]):
+        statistics = read_match_statistics(path)
+        if statistics is not None:
+            return statistics
+    voxel_size = np.asarray(voxel_size, float)
+    fixed, moving = read_matches(find_neighbors_path)
+    if len(fixed) == 0:
+        distance = coherence = np.zeros(0)
+    else:
+        warped = warp_coords(fixed, transform_path, n_workers)
+        displacements = (moving - warped) * voxel_size
+        distance = np.linalg.norm(displacements, axis=1)
+        coherence = displacement_coherence(
+            fixed * voxel_size, displacements,
+            noise=COHERENCE_NOISE * float(np.mean(voxel_size)))
+    np.savez(path, distance=distance, coherence=coherence,
+             version=STATISTICS_VERSION)
+    return distance, coherence
+
+
+def passing_matches(distance:np.ndarray, coherence:np.ndarray,
+                    max_distance:float, min_coherence:float) -> np.ndarray:
+    """
+    A mask of the matches that pass the filter thresholds
+
+    :param distance: each match's distance
+    :param coherence: each match's coherence
+    :param max_distance: the maximum allowed distance
+    :param min_coherence: the minimum allowed coherence
+    """
+    return (distance <= max_distance) & (coherence >= min_coherence)
+
+
+def count_passing(distance:np.ndarray, coherence:np.ndarray,
+                  max_distance:float, min_coherence:float) -> int:
+    """
+    The number of matches that pass the filter thresholds
+
+    :param distance: each match's distance
+    :param coherence: each match's coherence
+    :param max_distance: the maximum allowed distance
+    :param min_coherence: the minimum allowed coherence
+    """
+    return int(np.count_nonzero(passing_matches(
+        distance, coherence, max_distance, min_coherence)))
+
+
+def write_filtered_matches(find_neighbors_path:str, output_path:str,
+                           mask:np.ndarray) -> int:
+    """
+    Write the matches that pass the filter in the find-neighbors format
+
+    Every per-match list in the match file is filtered; anything else is
+    copied as is.
+
+    :param find_neighbors_path: the path to the find-neighbors match file
+    :param output_path: the path to the filtered match file
+    :param mask: the matches to keep
+    :return: the number of matches written
+    """
+    with open(find_neighbors_path) as fd:
+        matches = json.load(fd)
+    fixed_key, _ = match_keys(matches)
+    n_matches = len(matches[fixed_key])
+    if len(mask) != n_matches:
+        raise ValueError(
+            "%s has %d matches, but there are statistics for %d" %
+            (find_neighbors_path, n_matches, len(mask)))
+    keep = np.where(mask)[0]
+    filtered = {}
+    for key, value in matches.items():
+        if isinstance(value, list) and len(value) == n_matches:
+            filtered[key] = [value[_] for _ in keep]
+        else:
+            filtered[key] = value
+    with open(output_path, "w") as fd:
+        json.dump(filtered, fd)
+    return len(keep)
+
+
+def write_filter_visualization(path:str,
+                               distance:np.ndarray,
+                               coherence:np.ndarray,
+                               max_distance:float,
+                               min_coherence:float):
+    """
+    Plot the distributions of the match statistics and the thresholds
+
+    :param path: the path to the PDF file to write
+    :param distance: each match's distance
+    :param coherence: each match's coherence
+    :param max_distance: the maximum allowed distance
+    :param min_coherence: the minimum allowed coherence
+    """
+    figure = Figure(figsize=(11, 5))
+    FigureCanvasAgg(figure)
+    n_passing = count_passing(distance, coherence, max_distance,
+                              min_coherence)
+    figure.suptitle("%d of %d matches pass" % (n_passing, len(distance)))
+    for idx, (values, threshold, title) in enumerate((
+            (distance, max_distance, "Distance after previous transform (μm)"),
+            (coherence, min_coherence, "Displacement coherence"))):
+        axes = figure.add_subplot(1, 2, idx + 1)
+        values = values[np.isfinite(values)]
+        if len(values) > 0:
+            axes.hist(values, bins=100)
+        axes.axvline(threshold, color="red")
+        axes.set_title(title)
+        axes.set_ylabel("# of matches")
+    figure.savefig(path)
@@ -2,6 +2,8 @@
 # The model is a blackboard holding the parameters for running the multiround
 # alignment.
 #
+import collections
+import contextlib
 import enum
 import json
 import os
@@ -11,30 +13,111 @@ import typing
 from PyQt5.QtWidgets import QLineEdit, QSpinBox, QDoubleSpinBox, QLabel, QCheckBox, QComboBox
 import uuid
 
+from .file_status import FileStatus
+
 
 class FindNeighborsMethod(enum.Enum):
     POINTS="points"
     CORRELATION="correlation"
 
 
+class VariableBatch:
+    """
+    The state of a model's batch of deferred variable callbacks (see
+    Model.batch). Each model has its own, shared by its variables.
+    """
+
+    def __init__(self):
+        #
+        # The nesting depth of the batch in progress, if any
+        #
+        self.depth = 0
+        #
+        # The variables set during the batch and their values before the
+        # batch
+        #
+        self.pending = collections.OrderedDict()
+        #
+        # The ids of the variables whose values the callbacks can't change
+        # while the batch commits
+        #
+        self.kept = set()
+
+    def begin(self):
+        self.depth += 1
+
+    def keep_values(self, variables:typing.Iterable["Variable"]):
+        """
+        Keep the values of some variables while the batch in progress commits:
+        the callbacks that it calls can't change them.
+
+        :param variables: the variables to keep
+        """
+        self.kept.update([id(_) for _ in variables])
+
+    def end(self):
+        """
+        Commit the batch, calling the callbacks of every variable whose value
+        changed. Variables set by those callbacks are coalesced in turn until
+        no more changes are pending.
+        """
+        if self.depth > 1:
+            self.depth -= 1
+            return
+        try:
+            while len(self.pending) > 0:
+                pending = list(self.pending.values())
+                self.pending.clear()
+                for variable, old_value in pending:
+                    if variable.get() != old_value:
+                        variable.fire_callbacks()
+        finally:
+            self.pending.clear()
+            self.kept.clear()
+            self.depth = 0
+
+
 class Variable:
     """
     A variable in the model, supplying standardized getters and setters
     and a callback mechanism on variable change.
 
+    Callbacks can be deferred by setting variables within a batch (see
+    Model.batch). The variable's value changes immediately, but its callbacks
+    are called once, with the final value, when the batch commits.
     """
-    def __init__(self, value=None):
+
+    def __init__(self, value=None, batch:VariableBatch=None):
         self.__value = value
         self.__callbacks = {}
+        self.__batch = batch
+
+    def set_batch(self, batch:VariableBatch):
+        """
+        Defer this variable's callbacks with those of a model's batches
+
+        :param batch: the model's batch state
+        """
+        self.__batch = batch
 
     def get(self):
         return self.__value
 
     def set(self, new_value):
-        if self.__value == new_value:
+        batch = self.__batch
+        if self.__value == new_value or \
+                batch is not None and id(self) in batch.kept:
+            return
+        if batch is not None and batch.depth > 0:
+            if id(self) not in batch.pending:
+                batch.pending[id(self)] = (self, self.__value)
+            self.__value = new_value
             return
         self.__value = new_value
-        for callback in self.__callbacks.values():
+        self.fire_callbacks()
+
+    def fire_callbacks(self):
+        for callback in list(self.__callbacks.values()):
             callback(self.__value)
 
     def register_callback(self, name, function):
@@ -117,6 +200,8 @@ class Variable:
 
 class Model:
     def __init__(self):
+        self.__batch = VariableBatch()
+        self.__file_status = FileStatus()
         self.__n_workers = Variable(os.cpu_count())
         self.__n_io_workers = Variable(min(os.cpu_count(), 12))
         self.__use_gpu = Variable(True)
@@ -146,6 +231,7 @@ class Model:
         self.__moving_preprocessed_path = Variable("")
         self.__fixed_precomputed_path = Variable("")
         self.__moving_precomputed_path = Variable("")
+        self.__n_precomputed_levels = Variable(7)
         #
         # Nuggt align
         #
@@ -154,6 +240,7 @@ class Model:
         self.__nuggt_reference_url = Variable("")
         self.__nuggt_moving_url = Variable("")
         self.__nuggt_decimation_level = Variable(3)
+        self.__nuggt_show_preview = Variable(True)
         #
         # Rigid alignment
         #
@@ -173,6 +260,9 @@ class Model:
         #
         self.__rough_interpolator = Variable("")
         self.__rough_inverse_interpolator = Variable("")
+        self.__rough_n_starts = Variable(1)
+        self.__rough_angle_perturbation = Variable(10.0) # in degrees
+        self.__rough_offset_perturbation = Variable(50) # in voxels
         #
         # Cell finding
         #
@@ -198,6 +288,11 @@ class Model:
         self.__moving_geometric_features_path = Variable("")
         self.__n_geometric_neighbors = Variable(3)
         self.__n_refinement_rounds = Variable(5)
+        self.__convergence_transform_tolerance = Variable(1.0)
+        self.__convergence_residual_tolerance = Variable(2.0)
+        self.__convergence_stop_on_either = Variable(False)
+        self.__auto_extend_rounds = Variable(False)
+        self.__convergence_log = Variable("")
         #
         # find-neighbors
         self.__find_neighbors_method = [
@@ -215,7 +310,12 @@ class Model:
             Variable(0.3), Variable(0.4), Variable(0.5), Variable(0.6),
             Variable(0.7)
         ]
+        self.__find_neighbors_tiled = Variable(False)
+        self.__find_neighbors_tile_size = Variable(1024)
           # find-neighbors: correlation
+        self.__find_corr_neighbors_prefetch = Variable(False)
+        self.__find_corr_neighbors_adaptive = Variable(False)
+        self.__find_corr_neighbors_budget = Variable(20000)
         self.__find_corr_neighbors_sigma = [
             Variable(6.0) for _ in range(5)
         ]
@@ -246,7 +346,7 @@ class Model:
         self.__filter_matches_path = [Variable("") for _ in range(5)]
         self.__filter_matches_pdf_path = [Variable("") for _ in range(5)]
         self.__filter_matches_max_distance = [Variable(200.) for _ in range(5)]
-        self.__filter_matches_min_coherence = [Variable(.9) for _ in range(5)]
+        self.__filter_matches_min_coherence = [Variable(.33) for _ in range(5)]
         #
         # Fit nonrigid transform
         #
@@ -284,9 +384,11 @@ class Model:
             moving_stack_path=self.moving_stack_path,
             moving_precomputed_path=self.moving_precomputed_path,
             moving_preprocessed_path=self.moving_preprocessed_path,
+            n_precomputed_levels=self.n_precomputed_levels,
             output_path=self.output_path,
             nuggt_points_path=self.nuggt_points_path,
             nuggt_rescaled_points_path=self.nuggt_rescaled_points_path,
+            nuggt_show_preview=self.nuggt_show_preview,
             nuggt_reference_url=self.nuggt_reference_url,
             nuggt_moving_url=self.nuggt_moving_url,
             nuggt_decimation_level=self.nuggt_decimation_level,
@@ -303,6 +405,9 @@ class Model:
             moving_display_threshold=self.moving_display_threshold,
             rough_interpolator=self.rough_interpolator,
             rough_inverse_interpolator=self.rough_inverse_interpolator,
+            rough_n_starts=self.rough_n_starts,
+            rough_angle_perturbation=self.rough_angle_perturbation,
+            rough_offset_perturbation=self.rough_offset_perturbation,
             bypass_training=self.bypass_training,
             fixed_blob_path=self.fixed_blob_path,
             moving_blob_path=self.moving_blob_path,
@@ -324,11 +429,22 @@ class Model:
             find_neighbors_method=self.find_neighbors_method,
             max_neighbors=self.__max_neighbors,
             n_refinement_rounds=self.n_refinement_rounds,
+            convergence_transform_tolerance=
+            self.convergence_transform_tolerance,
+            convergence_residual_tolerance=self.convergence_residual_tolerance,
+            convergence_stop_on_either=self.convergence_stop_on_either,
+            auto_extend_rounds=self.auto_extend_rounds,
+            convergence_log=self.convergence_log,
             find_neighbors_radius=self.find_neighbors_radius,
             find_neighbors_feature_distance=
             self.find_neighbors_feature_distance,
             find_neighbors_promience_threshold=
                 self.find_neighbors_prominence_threshold,
+            find_neighbors_tiled=self.find_neighbors_tiled,
+            find_neighbors_tile_size=self.find_neighbors_tile_size,
+            find_corr_neighbors_prefetch=self.find_corr_neighbors_prefetch,
+            find_corr_neighbors_adaptive=self.find_corr_neighbors_adaptive,
+            find_corr_neighbors_budget=self.find_corr_neighbors_budget,
             find_corr_neighbors_sigma=self.find_corr_neighbors_sigma,
             find_corr_neighbors_radius=self.find_corr_neighbors_radius,
             find_corr_neighbors_min_correlation=\
@@ -355,26 +471,75 @@ class Model:
             alignment_input_coords=self.alignment_input_coords,
             alignment_output_coords=self.alignment_output_coords
         )
+        self.__adopt_variables()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defer variable callbacks until the end of the block
+
+        Within the block, variables take their new values immediately, but
+        their callbacks are called only once, when the outermost batch
+        ends, and only if the value actually changed.
+        """
+        self.__adopt_variables()
+        self.__batch.begin()
+        try:
+            yield
+        finally:
+            self.__batch.end()
+
+    def __adopt_variables(self):
+        """
+        Give the model's batch state to its variables, including the ones
+        appended to its lists of variables since the last batch
+        """
+        for value in list(vars(self).values()):
+            if isinstance(value, Variable):
+                value.set_batch(self.__batch)
+            elif isinstance(value, list):
+                for variable in value:
+                    if isinstance(variable, Variable):
+                        variable.set_batch(self.__batch)
 
     def read(self, path):
         with open(path, "r") as fd:
             d = json.load(fd)
+        #
+        # The callbacks of the loaded variables are deferred until everything
+        # is loaded. The loaded values are kept, so that the callbacks of
+        # e.g. the output path don't replace the loaded paths with the
+        # default paths derived from it.
+        #
+        with self.batch():
+            self.__batch.keep_values(self.__read_dictionary(d, path))
+
+    def __read_dictionary(self, d, path) -> typing.List[Variable]:
+        """
+        Set the model's variables from a dictionary read from a session file
+
+        :return: the variables that were set
+        """
+        variables = []
         for key in self.__serialization_dictionary:
             if key in d:
                 target = self.__serialization_dictionary[key]
                 if isinstance(target, Variable):
                     target.set(d[key])
+                    variables.append(target)
                 elif isinstance(target, list):
                     for i, value in enumerate(d[key]):
                         if len(target) > i:
                             target[i].set(value)
                         else:
-                            target.append(Variable(value))
+                            target.append(Variable(value, self.__batch))
+                        variables.append(target[i])
                 else:
                     raise ValueError("Unsupported type: %s" % type(target))
             else:
                 print("Warning: %s was missing from configuration" % key)
                 print("The file, %s, may be from an older version" % path)
+        return variables
 
     def write(self, path):
         d = dict([
@@ -386,6 +551,11 @@ class Model:
         with open(path, "w") as fd:
             json.dump(d, fd, indent=2)
 
+    @property
+    def file_status(self) -> FileStatus:
+        """The cache of the existence of the pipeline's files"""
+        return self.__file_status
+
     @property
     def n_workers(self) -> Variable:
         return self.__n_workers
@@ -469,6 +639,14 @@ class Model:
     def moving_precomputed_path(self) -> Variable:
         return self.__moving_precomputed_path
 
+    @property
+    def n_precomputed_levels(self) -> Variable:
+        """
+        The number of levels in the precomputed pyramids, chosen from the
+        dimensions of the stacks
+        """
+        return self.__n_precomputed_levels
+
     @property
     def nuggt_decimation_level(self) -> Variable:
         return self.__nuggt_decimation_level
@@ -481,6 +659,14 @@ class Model:
     def nuggt_rescaled_points_path(self) -> Variable:
         return self.__nuggt_rescaled_points_path
 
+    @property
+    def nuggt_show_preview(self) -> Variable:
+        """
+        Whether to show the moving volume, warped by the points placed so far,
+        in the reference viewer
+        """
+        return self.__nuggt_show_preview
+
     @property
     def nuggt_reference_url(self) -> Variable:
         return self.__nuggt_reference_url
@@ -541,6 +727,30 @@ class Model:
     def rough_inverse_interpolator(self) -> Variable:
         return self.__rough_inverse_interpolator
 
+    @property
+    def rough_n_starts(self) -> Variable:
+        """
+        The number of rough registrations to run in parallel, each from a
+        perturbation of the rigid alignment's initial pose
+        """
+        return self.__rough_n_starts
+
+    @property
+    def rough_angle_perturbation(self) -> Variable:
+        """
+        The standard deviation, in degrees, of the perturbation of the initial
+        rotation angles for the multi-start rough registration
+        """
+        return self.__rough_angle_perturbation
+
+    @property
+    def rough_offset_perturbation(self) -> Variable:
+        """
+        The standard deviation, in voxels, of the perturbation of the initial
+        offsets for the multi-start rough registration
+        """
+        return self.__rough_offset_perturbation
+
     @property
     def rough_inverse_interpolator(self) -> Variable:
         return self.__rough_inverse_interpolator
@@ -625,6 +835,47 @@ class Model:
     def n_refinement_rounds(self) -> Variable:
         return self.__n_refinement_rounds
 
+    @property
+    def convergence_transform_tolerance(self) -> Variable:
+        """
+        Stop running refinement rounds when the median displacement between
+        a round's transform and the previous one is less than this many microns
+        """
+        return self.__convergence_transform_tolerance
+
+    @property
+    def convergence_residual_tolerance(self) -> Variable:
+        """
+        Stop running refinement rounds when the median distance, in microns,
+        between a round's warped fixed matches and moving matches is less
+        than this. The distances are measured on the round's unfiltered
+        find-neighbors matches.
+        """
+        return self.__convergence_residual_tolerance
+
+    @property
+    def convergence_stop_on_either(self) -> Variable:
+        """
+        Stop running refinement rounds when either the transform or the
+        residual tolerance is met. If False, both have to be.
+        """
+        return self.__convergence_stop_on_either
+
+    @property
+    def auto_extend_rounds(self) -> Variable:
+        """
+        Add refinement rounds if the last round has not converged
+        """
+        return self.__auto_extend_rounds
+
+    @property
+    def convergence_log(self) -> Variable:
+        """
+        The statistics of each round run by "Run all rounds" and the decision
+        made after it
+        """
+        return self.__convergence_log
+
     @property
     def find_neighbors_method(self) -> typing.List[Variable]:
         return self.__find_neighbors_method
@@ -641,6 +892,45 @@ class Model:
     def find_neighbors_prominence_threshold(self) -> typing.List[Variable]:
         return self.__find_neighbors_prominence_threshold
 
+    @property
+    def find_neighbors_tiled(self) -> Variable:
+        """
+        Find neighbors one tile at a time to bound the memory needed
+        """
+        return self.__find_neighbors_tiled
+
+    @property
+    def find_neighbors_tile_size(self) -> Variable:
+        """
+        The edge length, in voxels, of a tile when finding neighbors by tile
+        """
+        return self.__find_neighbors_tile_size
+
+    @property
+    def find_corr_neighbors_prefetch(self) -> Variable:
+        """
+        Read the compressed image blocks around the points into the page
+        cache ahead of correlation-based find-neighbors and visit the points
+        in block order
+        """
+        return self.__find_corr_neighbors_prefetch
+
+    @property
+    def find_corr_neighbors_adaptive(self) -> Variable:
+        """
+        Correlate only points in the tissue, adding points where the previous
+        round's matches fit poorly
+        """
+        return self.__find_corr_neighbors_adaptive
+
+    @property
+    def find_corr_neighbors_budget(self) -> Variable:
+        """
+        The maximum number of points to correlate per round when sampling
+        adaptively
+        """
+        return self.__find_corr_neighbors_budget
+
     @property
     def find_corr_neighbors_sigma(self) -> typing.List[Variable]:
         return self.__find_corr_neighbors_sigma
@@ -1,6 +1,5 @@
 import traceback
 
-import json
 import neuroglancer
 
 import os
@@ -8,13 +7,15 @@ from PyQt5.QtCore import Qt, QUrl
 from PyQt5.QtGui import QDesktopServices, QGuiApplication, QCursor
 
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QGroupBox, QHBoxLayout, \
-    QPushButton, QLabel, QSpinBox, QMessageBox
+    QPushButton, QLabel, QSpinBox, QMessageBox, QCheckBox
 
 from nuggt.align import ViewerPair
-from phathom.pipeline.pickle_alignment_cmd import main as pickle_alignment
 from precomputed_tif.client import ArrayReader
 
+from .interpolator_preview import InterpolatorPreview
+from .lazy_volume import LazyVolume
 from .model import Model
+from .nuggt_points import NuggtPoints, fit_rough_interpolators
 from .utils import OnActivateMixin, fixed_neuroglancer_url, \
     moving_neuroglancer_url, set_status_bar_message, clear_status_bar_message
 
@@ -39,10 +40,23 @@ class NeuroglancerAlignmentWidget(QWidget, OnActivateMixin):
         self.decimation_widget = QSpinBox()
         hlayout.addWidget(self.decimation_widget)
         self.decimation_widget.setMinimum(1)
-        self.decimation_widget.setMaximum(6)
+        self.decimation_widget.setMaximum(
+            self.model.n_precomputed_levels.get())
+        self.model.n_precomputed_levels.register_callback(
+            "neuroglancer-alignment", self.decimation_widget.setMaximum)
         self.model.nuggt_decimation_level.bind_spin_box(self.decimation_widget)
         hlayout.addStretch(1)
         #
+        # Interpolator preview
+        #
+        hlayout = QHBoxLayout()
+        layout.addLayout(hlayout)
+        show_preview_widget = QCheckBox(
+            "Show the warped moving volume in the reference viewer")
+        self.model.nuggt_show_preview.bind_checkbox(show_preview_widget)
+        hlayout.addWidget(show_preview_widget)
+        hlayout.addStretch(1)
+        #
         # Nuggt-align launch button
         #
         hlayout = QHBoxLayout()
@@ -101,35 +115,38 @@ class NeuroglancerAlignmentWidget(QWidget, OnActivateMixin):
         self.update_controls()
 
     def on_output_change(self, *args):
-        self.model.rough_interpolator.set(
-            os.path.join(self.model.output_path.get(),
-                         "rough-alignment.pkl")
-        )
-        self.model.rough_inverse_interpolator.set(
-            os.path.join(self.model.output_path.get(),
-                         "rough-inverse_alignment.pkl")
-        )
+        with self.model.batch():
+            self.model.rough_interpolator.set(
+                os.path.join(self.model.output_path.get(),
+                             "rough-alignment.pkl")
+            )
+            self.model.rough_inverse_interpolator.set(
+                os.path.join(self.model.output_path.get(),
+                             "rough-inverse_alignment.pkl")
+            )
 
     def update_controls(self):
         if not self.launched:
             self.model.nuggt_reference_url.set("")
             self.model.nuggt_moving_url.set("")
-        if os.path.exists(self.model.nuggt_rescaled_points_path.get()):
+        if self.model.file_status.exists(
+                self.model.nuggt_rescaled_points_path.get()):
             self.make_rough_alignment_button_widget.setEnabled(True)
         else:
             self.make_rough_alignment_button_widget.setEnabled(False)
 
     def on_output_path_changed(self, *args):
-        if not self.model.nuggt_points_path.get():
-            self.model.nuggt_points_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "nuggt-alignment.json")
-            )
-        if not self.model.nuggt_rescaled_points_path.get():
-            self.model.nuggt_rescaled_points_path.set(
-                os.path.join(self.model.output_path.get(),
-                             "nuggt-rescaled-alignment.json")
-            )
+        with self.model.batch():
+            if not self.model.nuggt_points_path.get():
+                self.model.nuggt_points_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "nuggt-alignment.json")
+                )
+            if not self.model.nuggt_rescaled_points_path.get():
+                self.model.nuggt_rescaled_points_path.set(
+                    os.path.join(self.model.output_path.get(),
+                                 "nuggt-rescaled-alignment.json")
+                )
 
     def on_launch(self, *args):
         neuroglancer.set_server_bind_address(
@@ -139,16 +156,14 @@ class NeuroglancerAlignmentWidget(QWidget, OnActivateMixin):
         QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
         try:
             level = 2 ** (self.model.nuggt_decimation_level.get() - 1)
-            fixed_ar = ArrayReader(fixed_neuroglancer_url(self.model),
-                                   format="blockfs",
-                                   level=level)
-            set_status_bar_message("Loading fixed volume...")
-            fixed_volume = fixed_ar[:, :, :]
-            moving_ar = ArrayReader(moving_neuroglancer_url(self.model),
-                                    format="blockfs",
-                                    level=level)
-            set_status_bar_message("Loading moving volume...")
-            moving_volume = moving_ar[:, :, :]
+            #
+            # The volumes are read block by block as Neuroglancer asks for
+            # them, so they do not have to fit in memory.
+            #
+            fixed_volume = LazyVolume(fixed_neuroglancer_url(self.model),
+                                      level)
+            moving_volume = LazyVolume(moving_neuroglancer_url(self.model),
+                                       level)
             voxel_size = (self.model.x_voxel_size.get() * 1000 * level,
                           self.model.y_voxel_size.get() * 1000 * level,
                           self.model.z_voxel_size.get() * 1000 * level)
@@ -160,22 +175,34 @@ class NeuroglancerAlignmentWidget(QWidget, OnActivateMixin):
                 voxel_size, voxel_size)
             self.viewer_pair.n_workers = self.model.n_workers.get()
             self.viewer_pair.max_batch_size = 1
+            self.preview = InterpolatorPreview(
+                self.viewer_pair.reference_viewer,
+                self.model.fixed_precomputed_path.get(),
+                self.model.moving_precomputed_path.get(),
+                moving_neuroglancer_url(self.model),
+                [_ / level for _ in voxel_size])
             real_save = self.viewer_pair.save_points
             #
             # Do some housekeeping associated with saving files
             # * make the rescaled points file
             # * enable the rough alignment button
+            # * update the preview of the alignment
             #
             def on_save(*args):
                 real_save()
-                with open(self.model.nuggt_points_path.get()) as fd:
-                    coords = json.load(fd)
-                coords["reference"], coords["moving"] = [
-                    [[_ * level for _ in __] for __ in coords[k] ]
-                    for k in ("reference", "moving")]
-                with open(self.model.nuggt_rescaled_points_path.get(), "w") as fd:
-                    json.dump(coords, fd)
-                self.update_controls()
+                points = NuggtPoints.from_json(
+                    self.model.nuggt_points_path.get()).rescaled(level)
+                if points.save(self.model.nuggt_rescaled_points_path.get()):
+                    self.model.file_status.invalidate(
+                        self.model.nuggt_rescaled_points_path.get())
+                    self.update_controls()
+                if self.model.nuggt_show_preview.get():
+                    try:
+                        self.preview.update(points)
+                    except:
+                        # This runs in Neuroglancer's thread, so report
+                        # the problem without a message box.
+                        traceback.print_exc()
             self.viewer_pair.save_points = on_save
             reference_url = self.viewer_pair.reference_viewer.get_viewer_url()
             moving_url = self.viewer_pair.moving_viewer.get_viewer_url()
@@ -202,27 +229,21 @@ class NeuroglancerAlignmentWidget(QWidget, OnActivateMixin):
                                format="blockfs")
         moving_ar = ArrayReader(moving_neuroglancer_url(self.model),
                                format="blockfs")
-        zs, ys, xs = fixed_ar.shape
         input = self.model.nuggt_rescaled_points_path.get()
-        #
-        # Yup, the sense is different here and we store fixed->moving as inverse.
-        #
-        pickle_alignment([
-            "--input",
-            input,
-            "--output",
-            self.model.rough_inverse_interpolator.get(),
-            "--image-size",
-            "%d,%d,%d" % (xs, ys, zs)
-        ])
-        zs, ys, xs = moving_ar.shape
-        pickle_alignment([
-            "--input",
-            input,
-            "--output",
-            self.model.rough_interpolator.get(),
-            "--invert",
-            "--image-size",
-            "%d,%d,%d" % (xs, ys, zs)
-        ])
-        set_status_bar_message("Interpolator written to %s" % input)
\ No newline at end of file
+        QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+        try:
+            fit = fit_rough_interpolators(
+                input, fixed_ar.shape, moving_ar.shape,
+                self.model.rough_interpolator.get(),
+                self.model.rough_inverse_interpolator.get())
+        finally:
+            QGuiApplication.restoreOverrideCursor()
+        if fit:
+            self.model.file_status.invalidate(
+                self.model.rough_interpolator.get())
+            self.model.file_status.invalidate(
+                self.model.rough_inverse_interpolator.get())
+            set_status_bar_message("Interpolator written to %s" %
+                                   self.model.rough_interpolator.get())
+        else:
+            set_status_bar_message("Interpolators are up to date")
@@ -0,0 +1,191 @@
+#
+# Storage of the correspondence points placed with nuggt-align and fitting
+# of the rough interpolators from them.
+#
+import hashlib
+import json
+import multiprocessing
+import os
+import typing
+
+import numpy as np
+from phathom.pipeline.pickle_alignment_cmd import main as pickle_alignment
+
+
+class NuggtPoints:
+    """
+    Corresponding reference (fixed) and moving points, in z, y, x order as
+    nuggt-align writes them.
+    """
+
+    def __init__(self, reference:np.ndarray, moving:np.ndarray):
+        self.reference = np.asarray(reference, float).reshape(-1, 3)
+        self.moving = np.asarray(moving, float).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.reference)
+
+    @staticmethod
+    def from_json(path:str) -> "NuggtPoints":
+        """
+        Read the points from a nuggt-align points file
+
+        :param path: the path to the JSON file
+        """
+        with open(path) as fd:
+            coords = json.load(fd)
+        return NuggtPoints(coords["reference"], coords["moving"])
+
+    @staticmethod
+    def load(path:str) -> "NuggtPoints":
+        """
+        Load points saved with NuggtPoints.save, using the numpy copy if
+        it was made from the current JSON file. nuggt-align edits the JSON
+        file, so the numpy copy is out of date once the points are moved
+        there.
+
+        :param path: the path to the JSON file
+        """
+        npz_path = points_npz_path(path)
+        if os.path.exists(npz_path):
+            with np.load(npz_path) as data:
+                if not os.path.exists(path) or (
+                        "json_digest" in data and
+                        str(data["json_digest"]) == file_digest(path)):
+                    return NuggtPoints(data["reference"], data["moving"])
+        return NuggtPoints.from_json(path)
+
+    def rescaled(self, level:int) -> "NuggtPoints":
+        """
+        The points at level 1, given points placed at some level
+
+        :param level: the level at which the points were placed, e.g. 1, 2, 4
+        """
+        return NuggtPoints(self.reference * level, self.moving * level)
+
+    def digest(self) -> str:
+        """A hash of the points, for telling whether they have changed"""
+        md5 = hashlib.md5()
+        md5.update(np.ascontiguousarray(self.reference).tobytes())
+        md5.update(np.ascontiguousarray(self.moving).tobytes())
+        return md5.hexdigest()
+
+    def save(self, path:str) -> bool:
+        """
+        Save the points as a nuggt-align JSON file, for the programs that
+        read them, with a numpy copy alongside.
+
+        Nothing is written if the saved points are the same as these.
+
+        :param path: the path to the JSON file
+        :return: True if the points were written, False if they were unchanged
+        """
+        digest = self.digest()
+        npz_path = points_npz_path(path)
+        if os.path.exists(path) and os.path.exists(npz_path):
+            with np.load(npz_path) as data:
+                if "digest" in data and str(data["digest"]) == digest and \
+                        "json_digest" in data and \
+                        str(data["json_digest"]) == file_digest(path):
+                    return False
+        with open(path, "w") as fd:
+            json.dump(dict(reference=self.reference.tolist(),
+                           moving=self.moving.tolist()), fd)
+        np.savez(npz_path, reference=self.reference, moving=self.moving,
+                 digest=digest, json_digest=file_digest(path))
+        return True
+
+
+def points_npz_path(path:str) -> str:
+    """
+    The path to the numpy copy of a points file
+
+    :param path: the path to the JSON points file
+    """
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def file_digest(path:str) -> str:
+    """
+    A hash of a file's contents
+
+    :param path: the path to the file
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def digest_path(path:str) -> str:
+    """
+    The path to the file that records the points an interpolator was fit to
+
+    :param path: the path to the interpolator
+    """
+    return path + ".digest"
+
+
+def fit_rough_interpolators(points_path:str,
+                            fixed_shape:typing.Sequence[int],
+                            moving_shape:typing.Sequence[int],
+                            forward_path:str,
+                            inverse_path:str,
+                            force:bool=False) -> bool:
+    """
+    Fit the interpolators from the moving to the fixed volume and back
+
+    The two interpolators are fit at the same time. They are not refit if
+    they were last fit to the same points.
+
+    :param points_path: the path to the rescaled points file
+    :param fixed_shape: the z, y, x shape of the fixed volume
+    :param moving_shape: the z, y, x shape of the moving volume
+    :param forward_path: where to write the interpolator that maps moving
+    coordinates to fixed ones
+    :param inverse_path: where to write the interpolator that maps fixed
+    coordinates to moving ones
+    :param force: fit the interpolators even if the points are unchanged
+    :return: True if the interpolators were fit, False if they were current.
+    """
+    points = NuggtPoints.load(points_path)
+    digest = "%s %s %s" % (points.digest(),
+                           ",".join([str(_) for _ in fixed_shape]),
+                           ",".join([str(_) for _ in moving_shape]))
+    if not force and all([is_fit_to(_, digest)
+                          for _ in (forward_path, inverse_path)]):
+        return False
+    #
+    # The sense is different here: fixed->moving is stored as inverse.
+    #
+    zs, ys, xs = fixed_shape
+    inverse_args = [
+        "--input", points_path,
+        "--output", inverse_path,
+        "--image-size", "%d,%d,%d" % (xs, ys, zs)]
+    zs, ys, xs = moving_shape
+    forward_args = [
+        "--input", points_path,
+        "--output", forward_path,
+        "--invert",
+        "--image-size", "%d,%d,%d" % (xs, ys, zs)]
+    with multiprocessing.Pool(2) as pool:
+        pool.map(pickle_alignment, [inverse_args, forward_args])
+    for path in (forward_path, inverse_path):
+        with open(digest_path(path), "w") as fd:
+            fd.write(digest)
+    return True
+
+
+def is_fit_to(path:str, digest:str) -> bool:
+    """
+    Return True if an interpolator exists and was fit to the given points
+
+    :param path: the path to the interpolator
+    :param digest: the digest of the points and volume shapes
+    """
+    if not os.path.exists(path) or not os.path.exists(digest_path(path)):
+        return False
+    with open(digest_path(path)) as fd:
+        return fd.read() == digest
@@ -1,12 +1,53 @@
 from PyQt5.QtWidgets import QWidget, QGroupBox, QVBoxLayout, QMessageBox, QHBoxLayout, QLineEdit
-from PyQt5.QtWidgets import QLabel, QPushButton
+import typing
+from PyQt5.QtWidgets import QLabel, QPushButton, QApplication
 from .model import Model, Variable
-from .utils import tqdm_progress, connect_input_and_button
+from .utils import tqdm_progress, connect_input_and_button, choose_n_levels
 import glob
+import hashlib
+import json
+import multiprocessing
+import numpy as np
 import os
+import shutil
+import threading
+import tifffile
+import time
+import tqdm
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from blockfs import Directory
 from phathom.pipeline.preprocess_cmd import main as preprocess_main
-from precomputed_tif.main import main as precomputed_main
+from precomputed_tif.blockfs_stack import BlockfsStack
+
+#
+# The name of the file in the precomputed directory that records which
+# levels of the pyramid have been completely written.
+#
+BUILD_MANIFEST = "maui-build.json"
+#
+# The directory, in the precomputed directory, that holds the z-slabs of
+# level 1 while it is being built
+#
+SLAB_DIRECTORY = "maui-slabs"
+#
+# The number of planes in a slab of level 1: one blockfs block
+#
+SLAB_DEPTH = 64
+#
+# The name of the blockfs directory file of each level
+#
+BLOCKFS_FILENAME = "precomputed.blockfs"
+#
+# The time in seconds to wait for a cancelled build to shut down its blockfs
+# writers before it is terminated
+#
+STOP_TIMEOUT = 60
+
+
+class BuildCancelled(Exception):
+    """Raised within a build when it is asked to stop"""
+
 
 class PreprocessingWidget(QWidget):
     def __init__(self, model:Model):
@@ -28,10 +69,46 @@ class PreprocessingWidget(QWidget):
         layout.addWidget(do_everything_button)
         do_everything_button.clicked.connect(self.do_everything)
         layout.addStretch(1)
+        for variable in (model.fixed_stack_path, model.moving_stack_path,
+                         model.nuggt_decimation_level):
+            variable.register_callback("precomputed-levels",
+                                       self.update_n_levels)
+        self.update_n_levels()
+
+    def update_n_levels(self, *args):
+        """
+        Choose the depth of the precomputed pyramids from the sizes of the
+        stacks. Both pyramids get the same depth so that every level used
+        by a later stage exists for both volumes.
+        """
+        shapes = [stack_shape(_.get()) for _ in
+                  (self.model.fixed_stack_path, self.model.moving_stack_path)]
+        shapes = [_ for _ in shapes if _ is not None]
+        if len(shapes) == 0:
+            return
+        self.model.n_precomputed_levels.set(max([
+            choose_n_levels(shape, self.model.nuggt_decimation_level.get())
+            for shape in shapes]))
 
     def do_everything(self):
-        if self.fixed_channel.do_everything():
-            self.moving_channel.do_everything()
+        channels = [_ for _ in (self.fixed_channel, self.moving_channel)
+                    if _.src_file_count > 0]
+        if len(channels) == 0:
+            return False
+        #
+        # The build is dominated by reading the TIFF planes, so the
+        # concurrent builds share the I/O worker budget rather than each
+        # taking all of the cores.
+        #
+        n_cores = max(1, min(self.model.n_workers.get(),
+                             self.model.n_io_workers.get()) // len(channels))
+        builds = ConcurrentBuilds([_.make_build(n_cores) for _ in channels])
+        builds.start()
+        with tqdm_progress() as result:
+            builds.wait()
+        for channel in channels:
+            channel.onDestChange()
+        return result.result()
 
 
 class PreprocessingChannel(QGroupBox):
@@ -51,6 +128,7 @@ class PreprocessingChannel(QGroupBox):
         self.src_file_count = 0
         self.dest_file_count = 0
         self.precomputed_exists = False
+        self.precomputed_partial = False
 
         layout = QVBoxLayout()
         self.setLayout(layout)
@@ -83,23 +161,52 @@ class PreprocessingChannel(QGroupBox):
 
         self.precomputed_variable.register_callback("preprocessing",
                                                     self.onDestChange)
+        self.model.n_precomputed_levels.register_callback(
+            uuid.uuid4(), self.onDestChange)
         self.precomputed_button.clicked.connect(self.onPrecomputedButtonPressed)
         self.onDestChange()
 
 
+    def make_build(self, n_cores=None) -> "PrecomputedBuild":
+        if n_cores is None:
+            n_cores = self.model.n_workers.get()
+        return PrecomputedBuild(self.src_variable.get(),
+                                self.precomputed_variable.get(),
+                                self.model.n_precomputed_levels.get(),
+                                n_cores)
+
     def onDestChange(self, *args):
         src_path = self.src_variable.get()
         precomputed_path = self.precomputed_variable.get()
         self.src_file_count = count_files(src_path)
         precomputed_test_file = os.path.join(
             precomputed_path, "1_1_1", "precomputed.blockfs")
-        self.precomputed_exists = os.path.exists(precomputed_test_file)
+        self.precomputed_exists = \
+            self.model.file_status.exists(precomputed_test_file)
+        build = self.make_build()
+        n_completed = build.n_recorded_levels()
+        self.precomputed_partial = \
+            build.has_manifest() and n_completed < build.n_levels
+        n_slabs = build.n_recorded_slabs()
+        shape = stack_shape(src_path)
+        if self.precomputed_partial and n_completed == 0 and \
+                build.is_merging():
+            status = "Partially done, merging the slabs of level 1"
+        elif self.precomputed_partial and n_completed == 0 and n_slabs > 0 \
+                and shape is not None:
+            status = "Partially done, %d of %d slabs of level 1" % \
+                     (n_slabs, (shape[0] + SLAB_DEPTH - 1) // SLAB_DEPTH)
+        elif self.precomputed_partial:
+            status = "Partially done, %d of %d levels" % \
+                     (n_completed, build.n_levels)
+        elif self.precomputed_exists:
+            status = "Done"
+        else:
+            status = "Not done"
         self.source_widget.setText(
             "Source:  (%d files) %s" % (self.src_file_count, src_path))
         self.precomputed_widget.setText(
-            "Precomputed: (%s) %s" % (
-                "Done" if self.precomputed_exists else "Not done",
-                precomputed_path))
+            "Precomputed: (%s) %s" % (status, precomputed_path))
         if self.src_file_count == 0:
             self.message_widget.setText("No image files in source")
             self.message_widget.setStyleSheet("color: red;")
@@ -108,35 +215,515 @@ class PreprocessingChannel(QGroupBox):
             self.message_widget.setText("")
             self.message_widget.setStyleSheet("")
             self.precomputed_button.setDisabled(False)
-            if self.precomputed_exists:
+            if self.precomputed_partial:
+                self.precomputed_button.setText("Resume Neuroglancer volume")
+            elif self.precomputed_exists:
                 self.precomputed_button.setText("Remake Neuroglancer volume")
             else:
                 self.precomputed_button.setText("Make Neuroglancer volume")
 
     def onPrecomputedButtonPressed(self, *args):
-        self.do_precomputed()
+        force = False
+        build = self.make_build()
+        if self.precomputed_exists and not build.levels_to_build():
+            answer = QMessageBox.question(
+                self,
+                "Remake Neuroglancer volume",
+                "The %s volume is up to date with its source. "
+                "Do you want to rebuild it from scratch?" %
+                self.channel_name.lower())
+            if answer != QMessageBox.Yes:
+                return
+            force = True
+        self.do_precomputed(force)
 
-    def do_precomputed(self):
+    def do_precomputed(self, force=False):
         with tqdm_progress() as result:
-            precomputed_main([
-                "--source",
-                self.src_variable.get() + "/*.tif*",
-                "--dest",
-                self.precomputed_variable.get(),
-                "--levels", "7",
-                "--format", "blockfs",
-                "--n-cores", str(self.model.n_workers.get())
-            ])
+            self.make_build().run(force)
         self.onDestChange()
         return result.result()
 
     def do_everything(self):
         return self.do_precomputed()
 
+
 def count_files(path):
     files = glob.glob(os.path.join(path, "*.tif*"))
     return len(files)
 
+
+class ConcurrentBuilds:
+    """
+    Several precomputed builds, run at the same time, each in its own process
+
+    Progress is reported through tqdm, one step per slab of level 1 and per
+    pyramid level, by watching the builds' manifests. A cancelled build is
+    asked to stop so that it can shut down its blockfs writer processes and
+    is only terminated if it does not stop in time.
+    """
+
+    def __init__(self, builds:typing.Sequence["PrecomputedBuild"]):
+        self.builds = builds
+        self.total = sum([_.n_steps_to_build() for _ in builds])
+        self.n_recorded = [_.n_steps() - _.n_steps_to_build()
+                           for _ in builds]
+        self.stop_event = multiprocessing.Event()
+        self.processes = [
+            multiprocessing.Process(target=run_build,
+                                    args=(_, self.stop_event))
+            for _ in builds]
+
+    def start(self):
+        """
+        Start the builds. This should be done outside of tqdm_progress() so
+        that the processes report to the console and not to the GUI.
+        """
+        for process in self.processes:
+            process.start()
+
+    def wait(self, poll_interval=.25):
+        """
+        Wait for the builds to finish. This should be done within
+        tqdm_progress() so that the user can cancel.
+
+        :param poll_interval: the time in seconds between checks
+        """
+        try:
+            self.progress = tqdm.tqdm(self.watch(poll_interval),
+                                      total=self.total)
+            for _ in self.progress:
+                pass
+        finally:
+            self.stop_event.set()
+            deadline = time.time() + STOP_TIMEOUT
+            for process in self.processes:
+                process.join(max(0, deadline - time.time()))
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+
+    def watch(self, poll_interval):
+        while any([_.is_alive() for _ in self.processes]):
+            QApplication.processEvents()
+            if getattr(self.progress, "cancelled", False):
+                raise KeyboardInterrupt("Precomputed builds cancelled")
+            time.sleep(poll_interval)
+            for idx, build in enumerate(self.builds):
+                n_steps = build.n_recorded_steps()
+                for _ in range(n_steps - self.n_recorded[idx]):
+                    yield build
+                self.n_recorded[idx] = max(n_steps, self.n_recorded[idx])
+        for build, process in zip(self.builds, self.processes):
+            if process.exitcode != 0:
+                raise RuntimeError(
+                    "Failed to build %s (exit code %d)" %
+                    (build.dest_path, process.exitcode))
+
+
+def run_build(build:"PrecomputedBuild", stop_event):
+    """
+    Run a build in a ConcurrentBuilds process
+
+    :param build: the build to run
+    :param stop_event: a multiprocessing.Event that is set to stop the build
+    """
+    try:
+        build.run(stop_event=stop_event)
+    except BuildCancelled:
+        pass
+
+
+def stack_shape(path:str) -> typing.Optional[typing.Tuple[int, int, int]]:
+    """
+    Get the shape of a TIFF stack without reading the image data
+
+    :param path: the path to the directory holding the stack's planes
+    :return: the z, y, x shape of the stack or None if it has no planes
+    """
+    files = sorted(glob.glob(os.path.join(path, "*.tif*")))
+    if len(files) == 0:
+        return None
+    try:
+        with tifffile.TiffFile(files[0]) as fd:
+            y, x = fd.pages[0].shape[:2]
+    except Exception:
+        return None
+    return len(files), y, x
+
+
+def level_directory(level:int) -> str:
+    """
+    The name of the directory holding a level of the precomputed pyramid
+
+    :param level: the one-based level index, e.g. 1 for "1_1_1", 2 for "2_2_2"
+    """
+    resolution = 2 ** (level - 1)
+    return "%d_%d_%d" % (resolution, resolution, resolution)
+
+
+def source_fingerprint(paths:typing.Sequence[str]) -> str:
+    """
+    Fingerprint a TIFF stack so that a build of a different or modified
+    stack is not mistaken for a resumable one.
+
+    :param paths: the paths of the TIFF planes in the stack
+    :return: a digest of the plane names, sizes and modification times
+    """
+    md5 = hashlib.md5()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        md5.update(("%s:%d:%d\n" % (
+            os.path.basename(path), stat.st_size, int(stat.st_mtime)))
+                   .encode("utf-8"))
+    return md5.hexdigest()
+
+
+class PrecomputedBuild:
+    """
+    A checkpointed build of a blockfs precomputed volume from a TIFF stack.
+
+    Each level of the pyramid is recorded in a manifest in the destination
+    directory once it has been completely written. An interrupted build
+    resumes with the first level that is not recorded. Each level is made
+    from the one below it, so a level is only considered complete if all of
+    the finer levels are too. A change to the source stack invalidates the
+    whole pyramid, a change in the number of levels only adds or drops the
+    coarse levels.
+
+    Level 1, which is read from the TIFF stack and takes most of the time,
+    is built one z-slab at a time. Each slab is written to its own blockfs
+    volume and recorded in the manifest, so an interrupted build only
+    rereads the planes of the unfinished slab. When all of the slabs are
+    done, the manifest records the merge and the slabs are copied into
+    level 1, in parallel, and deleted. A blockfs volume can't be appended
+    to, so an interrupted merge starts over, but from the slabs and not
+    from the TIFF planes.
+    """
+
+    def __init__(self, src_path:str, dest_path:str, n_levels:int,
+                 n_cores:int):
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.n_levels = n_levels
+        self.n_cores = n_cores
+        self.manifest_path = os.path.join(dest_path, BUILD_MANIFEST)
+
+    def source_glob(self) -> str:
+        return os.path.join(self.src_path, "*.tif*")
+
+    def has_manifest(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def read_manifest(self) -> dict:
+        if not self.has_manifest():
+            return {}
+        try:
+            with open(self.manifest_path) as fd:
+                return json.load(fd)
+        except ValueError:
+            # A manifest that can't be parsed records nothing
+            return {}
+
+    def write_manifest(self, fingerprint:str, completed_levels:list,
+                       completed_slabs:list=(), merging:bool=False):
+        #
+        # Write to a temporary file and rename so that a crash while writing
+        # leaves the previous manifest intact.
+        #
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(dict(fingerprint=fingerprint,
+                           n_levels=self.n_levels,
+                           completed_levels=completed_levels,
+                           completed_slabs=list(completed_slabs),
+                           merging=merging),
+                      fd, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def slab_path(self, z0:int) -> str:
+        """
+        The path to the blockfs directory file of a slab of level 1
+
+        :param z0: the first plane of the slab
+        """
+        return os.path.join(self.dest_path, SLAB_DIRECTORY, "%06d" % z0,
+                            BLOCKFS_FILENAME)
+
+    def completed_slabs(self, fingerprint:str) -> typing.List[int]:
+        """
+        The first planes of the slabs of level 1 that were completely built
+        from the current source stack
+
+        :param fingerprint: the fingerprint of the current source stack
+        """
+        manifest = self.read_manifest()
+        if manifest.get("fingerprint") != fingerprint:
+            return []
+        return [z0 for z0 in manifest.get("completed_slabs", [])
+                if os.path.exists(self.slab_path(z0))]
+
+    def n_recorded_slabs(self) -> int:
+        """
+        The number of slabs of level 1 recorded as complete, without checking
+        the source stack for changes
+        """
+        return len(self.read_manifest().get("completed_slabs", []))
+
+    def is_merging(self) -> bool:
+        """
+        True if the slabs of level 1 are all written and are being copied
+        into level 1, without checking the source stack for changes
+        """
+        return self.read_manifest().get("merging", False)
+
+    def n_slabs(self) -> int:
+        """The number of slabs in level 1"""
+        shape = stack_shape(self.src_path)
+        if shape is None:
+            return 0
+        return (shape[0] + SLAB_DEPTH - 1) // SLAB_DEPTH
+
+    def n_steps(self) -> int:
+        """
+        The number of steps in a whole build, for progress reporting: one per
+        slab of level 1 and one per level
+        """
+        return self.n_slabs() + self.n_levels
+
+    def n_recorded_steps(self) -> int:
+        """
+        The number of steps recorded as complete, without checking the
+        source stack for changes
+        """
+        n_levels = self.n_recorded_levels()
+        if n_levels > 0:
+            return self.n_slabs() + n_levels
+        return self.n_recorded_slabs()
+
+    def n_steps_to_build(self) -> int:
+        """The number of steps that a call to run() would take"""
+        n_levels = len(self.levels_to_build())
+        if n_levels < self.n_levels:
+            return n_levels
+        paths = glob.glob(self.source_glob())
+        n_slabs = len(self.completed_slabs(source_fingerprint(paths)))
+        return self.n_slabs() - n_slabs + n_levels
+
+    def n_recorded_levels(self) -> int:
+        """
+        The number of levels recorded as complete, without checking the
+        source stack for changes
+        """
+        levels = self.read_manifest().get("completed_levels", [])
+        n_levels = 0
+        while n_levels + 1 in levels and n_levels < self.n_levels:
+            n_levels += 1
+        return n_levels
+
+    def completed_levels(self, fingerprint:str) -> typing.List[int]:
+        """
+        The levels that were completely built from the current source stack
+
+        :param fingerprint: the fingerprint of the current source stack
+        """
+        manifest = self.read_manifest()
+        if manifest.get("fingerprint") != fingerprint:
+            return []
+        recorded = manifest.get("completed_levels", [])
+        completed = []
+        for level in range(1, self.n_levels + 1):
+            level_path = os.path.join(self.dest_path, level_directory(level))
+            if level not in recorded or not os.path.exists(level_path):
+                break
+            completed.append(level)
+        return completed
+
+    def levels_to_build(self) -> typing.List[int]:
+        """The levels that a call to run() would write"""
+        paths = glob.glob(self.source_glob())
+        completed = self.completed_levels(source_fingerprint(paths))
+        return list(range(len(completed) + 1, self.n_levels + 1))
+
+    def run(self, force=False, stop_event=None):
+        """
+        Build the levels that are missing or out of date
+
+        :param force: if True, rebuild every level
+        :param stop_event: a multiprocessing.Event that, when set, stops the
+        build with BuildCancelled at the next slab, row of blocks or level
+        """
+        paths = glob.glob(self.source_glob())
+        fingerprint = source_fingerprint(paths)
+        completed = [] if force else self.completed_levels(fingerprint)
+        completed_slabs = [] if force or len(completed) > 0 \
+            else self.completed_slabs(fingerprint)
+        if not os.path.exists(self.dest_path):
+            os.makedirs(self.dest_path)
+        stack = BlockfsStack(self.source_glob(), self.dest_path)
+        stack.write_info_file(self.n_levels)
+        self.write_manifest(fingerprint, completed, completed_slabs)
+        for level in range(len(completed) + 1, self.n_levels + 1):
+            check_stop(stop_event)
+            if level == 1:
+                self.write_level_1(sorted(paths), fingerprint,
+                                   completed_slabs, stop_event)
+            else:
+                stack.write_level_n(level, n_cores=self.n_cores)
+            completed.append(level)
+            self.write_manifest(fingerprint, completed)
+
+    def write_level_1(self, paths:typing.Sequence[str], fingerprint:str,
+                      completed_slabs:typing.List[int], stop_event=None):
+        """
+        Write level 1 of the pyramid from the TIFF planes, slab by slab
+
+        The planes of the next slab are read while the current one is
+        written. The cores are split between the threads that read the
+        planes and the blockfs processes that compress and write the blocks.
+
+        :param paths: the paths of the TIFF planes in z order
+        :param fingerprint: the fingerprint of the source stack
+        :param completed_slabs: the first planes of the slabs that are
+        already written. The slabs written here are added to it.
+        :param stop_event: a multiprocessing.Event that stops the build
+        """
+        z_extent, y_extent, x_extent = stack_shape(self.src_path)
+        n_readers, n_writers = split_cores(self.n_cores)
+        z0s = [z0 for z0 in range(0, z_extent, SLAB_DEPTH)
+               if z0 not in completed_slabs]
+        with ThreadPoolExecutor(n_readers) as executor:
+            def read_ahead(idx):
+                if idx == len(z0s):
+                    return []
+                return [executor.submit(tifffile.imread, path)
+                        for path in paths[z0s[idx]:z0s[idx] + SLAB_DEPTH]]
+
+            planes = read_ahead(0)
+            try:
+                for idx, z0 in enumerate(tqdm.tqdm(z0s, desc="Level 1")):
+                    slab = np.stack([_.result() for _ in planes])
+                    planes = read_ahead(idx + 1)
+                    slab_path = self.slab_path(z0)
+                    if os.path.exists(os.path.dirname(slab_path)):
+                        shutil.rmtree(os.path.dirname(slab_path))
+                    os.makedirs(os.path.dirname(slab_path))
+                    write_slab(slab, slab_path, n_writers, stop_event)
+                    del slab
+                    completed_slabs.append(z0)
+                    self.write_manifest(fingerprint, [], completed_slabs)
+            finally:
+                for future in planes:
+                    future.cancel()
+        self.write_manifest(fingerprint, [], completed_slabs, merging=True)
+        self.merge_slabs(paths, z_extent, y_extent, x_extent, stop_event)
+        shutil.rmtree(os.path.join(self.dest_path, SLAB_DIRECTORY))
+
+    def merge_slabs(self, paths:typing.Sequence[str],
+                    z_extent:int, y_extent:int, x_extent:int,
+                    stop_event=None):
+        """
+        Copy the slabs of level 1 into the level 1 volume
+
+        The blocks of each row are read from the slab by a pool of threads
+        while the blockfs writer processes compress and write the blocks
+        of the previous rows.
+
+        :param paths: the paths of the TIFF planes, for the data type
+        :param z_extent: the number of planes in the stack
+        :param y_extent: the height of the stack
+        :param x_extent: the width of the stack
+        :param stop_event: a multiprocessing.Event that stops the build
+        """
+        n_readers, n_writers = split_cores(self.n_cores)
+        level_path = os.path.join(self.dest_path, level_directory(1))
+        if not os.path.exists(level_path):
+            os.mkdir(level_path)
+        with tifffile.TiffFile(paths[0]) as fd:
+            dtype = fd.pages[0].dtype
+        directory = Directory(x_extent, y_extent, z_extent, dtype,
+                              os.path.join(level_path, BLOCKFS_FILENAME),
+                              n_filenames=n_writers)
+        directory.create()
+        directory.start_writer_processes()
+        #
+        # Each thread opens the slabs for itself so that the threads don't
+        # share file handles.
+        #
+        local = threading.local()
+
+        def read_block(z0, x0, y0):
+            if getattr(local, "z0", None) != z0:
+                local.z0 = z0
+                local.slab = Directory.open(self.slab_path(z0))
+            return local.slab.read_block(x0, y0, 0)
+
+        try:
+            with ThreadPoolExecutor(n_readers) as executor:
+                z0s = range(0, z_extent, SLAB_DEPTH)
+                for z0 in tqdm.tqdm(z0s, desc="Merging level 1"):
+                    for y0 in range(0, y_extent, directory.y_block_size):
+                        check_stop(stop_event)
+                        x0s = range(0, x_extent, directory.x_block_size)
+                        blocks = executor.map(
+                            lambda x0, z0=z0, y0=y0: read_block(z0, x0, y0),
+                            x0s)
+                        for x0, block in zip(x0s, blocks):
+                            directory.write_block(block, x0, y0, z0)
+        finally:
+            directory.close()
+
+
+def split_cores(n_cores:int) -> typing.Tuple[int, int]:
+    """
+    Split the cores of a build between the threads that read and the
+    blockfs processes that compress and write
+
+    :param n_cores: the number of cores given to the build
+    :return: the number of readers and the number of writers
+    """
+    n_readers = max(1, n_cores // 2)
+    return n_readers, max(1, n_cores - n_readers)
+
+
+def check_stop(stop_event):
+    """
+    Raise BuildCancelled if a build has been asked to stop
+
+    :param stop_event: a multiprocessing.Event or None if the build can't be
+    stopped this way
+    """
+    if stop_event is not None and stop_event.is_set():
+        raise BuildCancelled()
+
+
+def write_slab(slab:np.ndarray, dest_path:str, n_writers:int,
+               stop_event=None):
+    """
+    Write some TIFF planes to a blockfs volume
+
+    :param slab: the planes, at most SLAB_DEPTH of them, stacked in z
+    :param dest_path: the path to the volume's blockfs directory file
+    :param n_writers: the number of blockfs writer processes
+    :param stop_event: a multiprocessing.Event that, when set, stops the
+    write with BuildCancelled after shutting down the writers
+    """
+    z_extent, y_extent, x_extent = slab.shape
+    directory = Directory(x_extent, y_extent, z_extent, slab.dtype,
+                          dest_path, n_filenames=n_writers,
+                          z_block_size=SLAB_DEPTH)
+    directory.create()
+    directory.start_writer_processes()
+    try:
+        for y0 in range(0, y_extent, directory.y_block_size):
+            check_stop(stop_event)
+            y1 = min(y_extent, y0 + directory.y_block_size)
+            for x0 in range(0, x_extent, directory.x_block_size):
+                x1 = min(x_extent, x0 + directory.x_block_size)
+                directory.write_block(slab[:, y0:y1, x0:x1], x0, y0, 0)
+    finally:
+        directory.close()
+
+
 def hook_src_path_to_precomputed_path(
         model:Model,
         src_variable:Variable,
@@ -3,7 +3,11 @@
 # https://github.com/vispy/vispy/blob/master/examples/basics/scene/volume.py
 # (BSD license)
 #
+import collections
 import os
+import threading
+import traceback
+import typing
 
 import uuid
 
@@ -11,20 +15,117 @@ import numpy as np
 import pathlib
 
 from PyQt5.QtWidgets import QWidget, QSplitter, QHBoxLayout, QVBoxLayout, QPushButton
-from PyQt5.QtWidgets import QLabel, QSpinBox, QDoubleSpinBox, QGroupBox
+from PyQt5.QtWidgets import QLabel, QSpinBox, QDoubleSpinBox, QGroupBox, \
+    QMessageBox
 from PyQt5 import QtCore
+from PyQt5.QtGui import QGuiApplication, QCursor
 from vispy import scene
 from vispy.color import BaseColormap, get_colormap
 from vispy.visuals.transforms import STTransform, MatrixTransform, ChainTransform
 
 from precomputed_tif.client import get_info, ArrayReader
 from phathom.registration.pcloud import rotation_matrix
+from scipy import optimize
 from vispy.scene import SceneCanvas
 from .model import Model
+from .rigid_initialization import choose_initialization_level, read_level, \
+    initialize_rigid_alignment, normalize_volume, transform_from_display, \
+    score_transform
 from .utils import OnActivateMixin, fixed_neuroglancer_path_is_valid, fixed_neuroglancer_url, \
-    moving_neuroglancer_path_is_valid, moving_neuroglancer_url
+    moving_neuroglancer_path_is_valid, moving_neuroglancer_url, \
+    precomputed_level_shapes, set_status_bar_message, clear_status_bar_message, \
+    choose_display_level
 
 VOLUME_RENDERING_METHOD = "translucent"
+#
+# The coarse level that is shown while the display level loads is this many
+# times coarser.
+#
+PROGRESSIVE_LEVEL_FACTOR = 4
+#
+# The number of (url, level) volumes to keep for redisplay
+#
+VOLUME_CACHE_SIZE = 8
+#
+# The time in milliseconds that the parameters have to stay unchanged before
+# the overlap is scored
+#
+SCORE_DELAY_MS = 250
+
+
+def read_display_volume(url:str, level:int) -> np.ndarray:
+    """
+    Read a level of a volume and scale it to 8 bits for display
+
+    :param url: the URL of the precomputed volume
+    :param level: the level to read
+    """
+    array = ArrayReader(url, format="blockfs", level=level)
+    shape = array.shape
+    volume = array[0:shape[0], 0:shape[1], 0:shape[2]]
+    return (np.clip(volume.astype(np.float32), 100, 1000) / 1000 * 255
+            ).astype(np.uint8)
+
+
+def display_limits(volume:np.ndarray) -> typing.Tuple[float, float]:
+    """The contrast limits for displaying a volume"""
+    low, high = float(volume.min()), float(volume.max())
+    return low, max(high, low + 1)
+
+
+class VolumeLoader(QtCore.QObject):
+    """
+    Reads display volumes and scores the overlap in background threads. The
+    signals are delivered in the GUI thread.
+    """
+    loaded = QtCore.pyqtSignal(str, int, object)
+    #
+    # The URL of a volume that could not be read and why
+    #
+    failed = QtCore.pyqtSignal(str, str)
+    #
+    # The generation of a score request, the score or None if the overlap
+    # could not be scored and why not
+    #
+    scored = QtCore.pyqtSignal(int, object, str)
+
+    def load(self, url:str, level:int):
+        """
+        Start reading a volume
+
+        :param url: the URL of the precomputed volume
+        :param level: the level to read
+        """
+        thread = threading.Thread(target=self.run, args=(url, level))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, url:str, level:int):
+        try:
+            volume = read_display_volume(url, level)
+        except Exception as e:
+            self.failed.emit(url, str(e))
+            volume = None
+        self.loaded.emit(url, level, volume)
+
+    def score(self, generation:int, function:typing.Callable[[], float]):
+        """
+        Start scoring the overlap
+
+        :param generation: a number identifying the request
+        :param function: a function that returns the score
+        """
+        thread = threading.Thread(target=self.run_score,
+                                  args=(generation, function))
+        thread.daemon = True
+        thread.start()
+
+    def run_score(self, generation:int, function:typing.Callable[[], float]):
+        try:
+            self.scored.emit(generation, function(), "")
+        except Exception as e:
+            self.scored.emit(generation, None, str(e))
+
 
 
 class TranslucentFixedColormap(BaseColormap):
@@ -52,6 +153,27 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
         self.moving_volume = None
         self.canvas_shape = None
         self.view = None
+        self.coarse_level = None
+        self.fixed_visual = None
+        self.moving_visual = None
+        self.volume_cache = collections.OrderedDict()
+        self.pending_loads = set()
+        self.volume_loader = VolumeLoader()
+        self.volume_loader.loaded.connect(self.on_volume_loaded)
+        self.volume_loader.failed.connect(self.on_volume_failed)
+        self.volume_loader.scored.connect(self.on_scored)
+        self.score_urls = None
+        self.score_level = None
+        self.score_fixed = None
+        self.score_moving = None
+        self.score_lock = threading.Lock()
+        self.score_generation = 0
+        self.score_running = False
+        self.score_pending = False
+        self.score_timer = QtCore.QTimer(self)
+        self.score_timer.setSingleShot(True)
+        self.score_timer.setInterval(SCORE_DELAY_MS)
+        self.score_timer.timeout.connect(self.start_score)
 
         top_layout = QVBoxLayout()
         self.setLayout(top_layout)
@@ -158,6 +280,23 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
         model.angle_z.register_callback("rotation", self.apply_translation)
         hlayout.addWidget(self.angle_z_spin_box)
         #
+        # ------ Automatic initialization
+        #
+        auto_initialize_button = QPushButton("Auto-initialize")
+        left_layout.addWidget(auto_initialize_button)
+        auto_initialize_button.clicked.connect(self.auto_initialize)
+        #
+        # ------ Overlap score
+        #
+        hlayout = QHBoxLayout()
+        left_layout.addLayout(hlayout)
+        self.score_label = QLabel("Overlap (NCC): -")
+        hlayout.addWidget(self.score_label)
+        hlayout.addStretch(1)
+        optimize_button = QPushButton("Optimize")
+        hlayout.addWidget(optimize_button)
+        optimize_button.clicked.connect(self.optimize_overlap)
+        #
         # Display parameters
         #
         display_group_box = QGroupBox("Display")
@@ -173,7 +312,7 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
         self.model.fixed_display_threshold.bind_double_spin_box(
             fixed_display_threshold_widget)
         self.model.fixed_display_threshold.register_callback(
-            "try_to_draw", self.try_to_draw)
+            "try_to_draw", self.on_threshold_changed)
         hlayout = QHBoxLayout()
         dgb_layout.addLayout(hlayout)
         hlayout.addWidget(QLabel("Moving threshold (0 to 1)"))
@@ -183,11 +322,12 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
         self.model.moving_display_threshold.bind_double_spin_box(
             moving_display_threshold_widget)
         self.model.moving_display_threshold.register_callback(
-            "try_to_draw", self.try_to_draw)
+            "try_to_draw", self.on_threshold_changed)
 
         self.scene = SceneCanvas(keys='interactive')
         splitter.addWidget(self.scene.native)
         self.view = self.scene.central_widget.add_view()
+        self.build_scene()
 
     def on_activated(self):
         self.try_to_draw()
@@ -206,6 +346,237 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
         self.model.center_y.set(fixed_shape[1] // 2)
         self.model.center_z.set(fixed_shape[0] // 2)
 
+    def auto_initialize(self, *args):
+        """
+        Set the center, offsets and angles from the moments and phase
+        correlation of a coarse level of the fixed and moving volumes.
+        """
+        if not fixed_neuroglancer_path_is_valid(self.model) or \
+                not moving_neuroglancer_path_is_valid(self.model):
+            return
+        QGuiApplication.setOverrideCursor(QCursor(QtCore.Qt.WaitCursor))
+        try:
+            level = choose_initialization_level(
+                precomputed_level_shapes(
+                    self.model.fixed_precomputed_path.get()),
+                precomputed_level_shapes(
+                    self.model.moving_precomputed_path.get()))
+            set_status_bar_message("Loading volumes for initialization...")
+            fixed_volume = read_level(fixed_neuroglancer_url(self.model),
+                                      level)
+            moving_volume = read_level(moving_neuroglancer_url(self.model),
+                                       level)
+            set_status_bar_message("Initializing rigid alignment...")
+            initialization = initialize_rigid_alignment(fixed_volume,
+                                                        moving_volume)
+            #
+            # The widget's coordinates are at level 1
+            #
+            center = np.round(initialization.center * level).astype(int)
+            offset = np.round(
+                initialization.display_offset() * level).astype(int)
+            angles = np.degrees(initialization.angles)
+            with self.model.batch():
+                self.model.center_z.set(int(center[0]))
+                self.model.center_y.set(int(center[1]))
+                self.model.center_x.set(int(center[2]))
+                self.model.offset_z.set(int(offset[0]))
+                self.model.offset_y.set(int(offset[1]))
+                self.model.offset_x.set(int(offset[2]))
+                self.model.angle_z.set(float(angles[0]))
+                self.model.angle_y.set(float(angles[1]))
+                self.model.angle_x.set(float(angles[2]))
+        except:
+            why = traceback.format_exc()
+            QMessageBox.critical(None, "Error during execution", why)
+        finally:
+            clear_status_bar_message()
+            QGuiApplication.restoreOverrideCursor()
+
+    def score_volume_source(self) -> typing.Optional[
+            typing.Tuple[typing.Tuple[str, str], typing.Tuple[str, str]]]:
+        """
+        The URLs and precomputed paths of the fixed and moving volumes used to
+        score the overlap or None if they don't exist
+        """
+        if not fixed_neuroglancer_path_is_valid(self.model) or \
+                not moving_neuroglancer_path_is_valid(self.model):
+            return None
+        return ((fixed_neuroglancer_url(self.model),
+                 moving_neuroglancer_url(self.model)),
+                (self.model.fixed_precomputed_path.get(),
+                 self.model.moving_precomputed_path.get()))
+
+    def load_score_volumes(self, source=None) -> bool:
+        """
+        Load the coarse volumes used to score the overlap. This may be called
+        from a background thread.
+
+        :param source: the URLs and precomputed paths of the volumes, as
+        returned by score_volume_source(), or None to get them from the model
+        :return: True if the volumes are loaded
+        """
+        if source is None:
+            source = self.score_volume_source()
+        if source is None:
+            return False
+        urls, paths = source
+        with self.score_lock:
+            if urls != self.score_urls:
+                self.score_level = choose_initialization_level(
+                    precomputed_level_shapes(paths[0]),
+                    precomputed_level_shapes(paths[1]))
+                self.score_fixed = normalize_volume(
+                    read_level(urls[0], self.score_level))
+                self.score_moving = normalize_volume(
+                    read_level(urls[1], self.score_level))
+                self.score_urls = urls
+        return True
+
+    def score_parameters(self, offset:typing.Sequence[float],
+                         angles:typing.Sequence[float],
+                         center:typing.Sequence[float]=None) -> float:
+        """
+        Score the overlap for the given parameters
+
+        :param offset: the z, y, x offsets at level 1
+        :param angles: the z, y and x rotation angles in degrees
+        :param center: the z, y, x center of rotation at level 1 or None for
+        the model's current center
+        :return: the normalized cross-correlation of the fixed volume and
+        the transformed moving volume
+        """
+        if center is None:
+            center = self.current_center()
+        matrix, center, translation = transform_from_display(
+            np.radians(angles),
+            np.asarray(center, float) / self.score_level,
+            np.asarray(offset, float) / self.score_level)
+        return score_transform(self.score_fixed, self.score_moving,
+                               matrix, center, translation)
+
+    def current_center(self) -> np.ndarray:
+        """The z, y, x center of rotation"""
+        return np.array([self.model.center_z.get(),
+                         self.model.center_y.get(),
+                         self.model.center_x.get()], float)
+
+    def current_offset_and_angles(self) \
+            -> typing.Tuple[np.ndarray, np.ndarray]:
+        """The z, y, x offsets and the z, y and x angles"""
+        offset = np.array([self.model.offset_z.get(),
+                           self.model.offset_y.get(),
+                           self.model.offset_x.get()], float)
+        angles = np.array([self.model.angle_z.get(),
+                           self.model.angle_y.get(),
+                           self.model.angle_x.get()])
+        return offset, angles
+
+    def update_score(self):
+        """
+        Show the overlap score for the current parameters once they stop
+        changing
+        """
+        self.score_timer.start()
+
+    def start_score(self):
+        """
+        Score the overlap for the current parameters in the background. The
+        parameters are read here, in the GUI thread.
+        """
+        if self.score_running:
+            self.score_pending = True
+            return
+        source = self.score_volume_source()
+        if source is None:
+            self.score_label.setText("Overlap (NCC): -")
+            return
+        offset, angles = self.current_offset_and_angles()
+        center = self.current_center()
+
+        def score():
+            self.load_score_volumes(source)
+            return self.score_parameters(offset, angles, center)
+
+        self.score_generation += 1
+        self.score_running = True
+        self.volume_loader.score(self.score_generation, score)
+
+    def on_scored(self, generation:int, score, why:str):
+        """
+        Called when the overlap has been scored in the background
+
+        :param generation: the generation of the request
+        :param score: the score or None if the overlap could not be scored
+        :param why: the reason that the overlap could not be scored
+        """
+        self.score_running = False
+        if self.score_pending:
+            self.score_pending = False
+            self.start_score()
+            return
+        if generation != self.score_generation:
+            return
+        if score is None:
+            self.score_label.setText("Overlap (NCC): -")
+            set_status_bar_message("Could not score the overlap: %s" % why)
+        else:
+            self.score_label.setText("Overlap (NCC): %.4f" % score)
+
+    def on_volume_failed(self, url:str, why:str):
+        """
+        Called when a volume could not be read in the background
+
+        :param url: the URL of the volume
+        :param why: the reason that it could not be read
+        """
+        set_status_bar_message("Could not read %s: %s" % (url, why))
+
+    def optimize_overlap(self, *args):
+        """
+        Search locally around the current offsets and angles for the best
+        overlap
+        """
+        QGuiApplication.setOverrideCursor(QCursor(QtCore.Qt.WaitCursor))
+        try:
+            if not self.load_score_volumes():
+                return
+            set_status_bar_message("Optimizing overlap...")
+            offset, angles = self.current_offset_and_angles()
+            x0 = np.hstack([offset, angles])
+            #
+            # Start with steps of a few voxels at the scoring level and
+            # a few degrees.
+            #
+            steps = np.array([4 * self.score_level] * 3 + [4.0] * 3)
+            initial_simplex = np.vstack([x0] + [x0 + np.diag(steps)[_]
+                                                for _ in range(6)])
+
+            def cost(x):
+                return -self.score_parameters(x[:3], x[3:])
+
+            result = optimize.minimize(
+                cost, x0, method="Nelder-Mead",
+                options=dict(initial_simplex=initial_simplex, maxiter=300,
+                             xatol=.5, fatol=1e-4))
+            if -result.fun <= -cost(x0):
+                return
+            offset = np.round(result.x[:3]).astype(int)
+            angles = (result.x[3:] + 180) % 360 - 180
+            with self.model.batch():
+                self.model.offset_z.set(int(offset[0]))
+                self.model.offset_y.set(int(offset[1]))
+                self.model.offset_x.set(int(offset[2]))
+                self.model.angle_z.set(float(angles[0]))
+                self.model.angle_y.set(float(angles[1]))
+                self.model.angle_x.set(float(angles[2]))
+        except:
+            why = traceback.format_exc()
+            QMessageBox.critical(None, "Error during execution", why)
+        finally:
+            clear_status_bar_message()
+            QGuiApplication.restoreOverrideCursor()
+
     def try_to_draw(self, *args):
         if not fixed_neuroglancer_path_is_valid(self.model):
             return
@@ -218,9 +589,11 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
         if fixed_url != self.fixed_url or \
                 self.canvas_shape != canvas_shape:
             # We have to update the fixed volume
-            fixed_array = None
-            fixed_shape = \
-                ArrayReader(fixed_url, format="blockfs", level=1).shape
+            shapes = precomputed_level_shapes(
+                self.model.fixed_precomputed_path.get())
+            if 1 not in shapes:
+                return
+            fixed_shape = shapes[1]
             self.center_x_spin_box.setMinimum(0)
             self.center_x_spin_box.setMaximum(fixed_shape[2])
             self.offset_x_spin_box.setMinimum(-fixed_shape[2])
@@ -233,49 +606,111 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
             self.center_z_spin_box.setMaximum(fixed_shape[0])
             self.offset_z_spin_box.setMinimum(-fixed_shape[0])
             self.offset_z_spin_box.setMaximum(fixed_shape[0])
-            for level_idx in range(0, 6):
-                level = 2 ** level_idx
-                try:
-                    test_fixed_array = ArrayReader(fixed_url,
-                                                   format="blockfs",
-                                                   level = level)
-                    test_shape = test_fixed_array.shape
-                    fixed_array = test_fixed_array
-                    self.level = level
-                    if test_shape[1] < canvas_shape[0] // 2 or \
-                       test_shape[2] < canvas_shape[1] // 2:
-                        break
-                except:
-                    break
-            if not fixed_array:
-                return
-            self.fixed_volume = fixed_array[0:test_shape[0],
-                                            0:test_shape[1],
-                                            0:test_shape[2]]
-            self.fixed_volume = (np.clip(
-                self.fixed_volume.astype(np.float32), 100, 1000) / 1000 * 255
-                                 ).astype(np.uint8)
+            self.level = choose_display_level(shapes, canvas_shape)
+            self.coarse_level = min(self.level * PROGRESSIVE_LEVEL_FACTOR,
+                                    max(shapes))
             self.fixed_url = fixed_url
-            need_to_do_moving = True
-        else:
-            need_to_do_moving = False
-        if need_to_do_moving or moving_url != self.moving_url:
+            self.canvas_shape = canvas_shape
+        self.moving_url = moving_url
+        #
+        # Show whatever is at hand now and fetch the display level in the
+        # background if it is not.
+        #
+        fixed_volume, fixed_level = self.get_display_volume(self.fixed_url)
+        moving_volume, moving_level = self.get_display_volume(self.moving_url)
+        if fixed_volume is None or moving_volume is None:
+            return
+        self.show_volumes(fixed_volume, fixed_level,
+                          moving_volume, moving_level)
+
+    def get_display_volume(self, url:str) -> \
+            typing.Tuple[typing.Optional[np.ndarray], typing.Optional[int]]:
+        """
+        Get the best volume that can be displayed at once
+
+        :param url: the URL of the volume
+        :return: the volume and its level. The volume is at the display level
+        if it has been loaded. If not, the display level is loaded in the
+        background and a coarser level is returned.
+        """
+        if (url, self.level) in self.volume_cache:
+            self.volume_cache.move_to_end((url, self.level))
+            return self.volume_cache[url, self.level], self.level
+        if (url, self.level) not in self.pending_loads:
+            self.pending_loads.add((url, self.level))
+            self.volume_loader.load(url, self.level)
+        if (url, self.coarse_level) not in self.volume_cache:
             try:
-                moving_array = ArrayReader(moving_url,
-                                           format="blockfs",
-                                           level=self.level)
-                moving_shape = moving_array.shape
-                self.moving_volume = \
-                    moving_array[0:moving_shape[0], 0:moving_shape[1],
-                                 0:moving_shape[2]]
-                self.moving_volume = (np.clip(
-                    self.moving_volume.astype(np.float32), 100, 1000) /
-                                      1000 * 255
-                                     ).astype(np.uint8)
-                self.moving_url = moving_url
+                self.cache_volume(url, self.coarse_level,
+                                  read_display_volume(url, self.coarse_level))
             except:
-                return
-        self.draw_scene()
+                return None, None
+        return self.volume_cache[url, self.coarse_level], self.coarse_level
+
+    def cache_volume(self, url:str, level:int, volume:np.ndarray):
+        """
+        Store a volume in the cache, discarding the least recently used
+
+        :param url: the URL of the volume
+        :param level: the level of the volume
+        :param volume: the volume, ready for display
+        """
+        self.volume_cache[url, level] = volume
+        while len(self.volume_cache) > VOLUME_CACHE_SIZE:
+            self.volume_cache.popitem(last=False)
+
+    def on_volume_loaded(self, url:str, level:int, volume):
+        """
+        Called when the display level of a volume has been loaded in the
+        background
+
+        :param url: the URL of the volume
+        :param level: the level that was loaded
+        :param volume: the volume or None if it could not be loaded
+        """
+        self.pending_loads.discard((url, level))
+        if volume is None:
+            return
+        self.cache_volume(url, level, volume)
+        if level == self.level and url in (self.fixed_url, self.moving_url):
+            self.try_to_draw()
+
+    def show_volumes(self, fixed_volume:np.ndarray, fixed_level:int,
+                     moving_volume:np.ndarray, moving_level:int):
+        """
+        Display the fixed and moving volumes
+
+        The scene is in the coordinates of the display level. Volumes that
+        are at a coarser level are scaled up to match.
+
+        :param fixed_volume: the fixed volume
+        :param fixed_level: the level of the fixed volume
+        :param moving_volume: the moving volume
+        :param moving_level: the level of the moving volume
+        """
+        if fixed_volume is not self.fixed_volume:
+            self.fixed_volume = fixed_volume
+            self.fixed_visual.set_data(fixed_volume,
+                                       clim=display_limits(fixed_volume))
+        if moving_volume is not self.moving_volume:
+            self.moving_volume = moving_volume
+            self.moving_visual.set_data(moving_volume,
+                                        clim=display_limits(moving_volume))
+        if not self.fixed_visual.visible:
+            self.camera.elevation = fixed_volume.shape[2] // 2
+            self.fixed_visual.visible = True
+            self.moving_visual.visible = True
+        for visual, level in ((self.fixed_visual, fixed_level),
+                              (self.moving_visual, moving_level)):
+            scale = level / self.level
+            visual.transform = STTransform(scale=(scale, scale, scale))
+        moving_scale = moving_level / self.level
+        self.fixed_frame.transform = STTransform(translate=(
+            -moving_volume.shape[2] * moving_scale // 2,
+            -moving_volume.shape[1] * moving_scale // 2,
+            -500
+        ))
+        self.apply_translation()
 
     def apply_translation(self, *args):
         if self.view and self.level:
@@ -310,47 +745,44 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
                           [0, 0, 0, 1]])
             )
             self.scene.update()
+            self.update_score()
 
-    def draw_scene(self):
+    def build_scene(self):
+        """
+        Build the scene graph. The volumes are hidden until there is data
+        to show, after which only their data, thresholds and transforms are
+        updated.
+        """
+        placeholder = np.zeros((1, 1, 1), np.uint8)
         self.fixed_frame = scene.node.Node(self.view.scene)
-        self.fixed_frame.transform= STTransform(translate=(
-            -self.moving_volume.shape[2] // 2,
-            -self.moving_volume.shape[1] // 2,
-            -500
-        ))
-        fixed_volume = scene.visuals.Volume(
-            self.fixed_volume,
+        self.fixed_visual = scene.visuals.Volume(
+            placeholder,
             parent = self.fixed_frame,
             threshold = self.model.fixed_display_threshold.get(),
+            clim=(0, 1),
             emulate_texture=False)
-        fixed_volume.cmap = TranslucentFixedColormap()
-        fixed_volume.method = VOLUME_RENDERING_METHOD
+        self.fixed_visual.cmap = TranslucentFixedColormap()
+        self.fixed_visual.method = VOLUME_RENDERING_METHOD
+        self.fixed_visual.visible = False
         #
-        # The transformation is done as follows:
-        #
-        # The translation frame handles the offset
-        #
-        # The centering frame picks the center of the moving frame
-        #
-        # The rotation frame rotates about the center
-        #
-        # The uncentering frame readjusts the coordinates so that 0, 0 is
-        # placed away from the center.
+        # The translation frame holds the rotation about the center and the
+        # offset of the moving volume (see apply_translation).
         #
         self.translation_frame = scene.node.Node(
             self.fixed_frame)
 
-        moving_volume = scene.visuals.Volume(
-            self.moving_volume,
+        self.moving_visual = scene.visuals.Volume(
+            placeholder,
             parent = self.translation_frame,
             threshold = self.model.moving_display_threshold.get(),
+            clim=(0, 1),
             emulate_texture=False)
-        moving_volume.cmap = TranslucentMovingColormap()
-        moving_volume.method = VOLUME_RENDERING_METHOD
+        self.moving_visual.cmap = TranslucentMovingColormap()
+        self.moving_visual.method = VOLUME_RENDERING_METHOD
+        self.moving_visual.visible = False
         self.camera = scene.cameras.TurntableCamera(
             parent=self.view.scene,
             fov = 60.,
-            elevation=self.fixed_volume.shape[2] // 2,
             name="Turntable")
         self.view.camera = self.camera
         self.center_frame = scene.node.Node(parent=self.view)
@@ -359,11 +791,16 @@ class RigidAlignmentWidget(QWidget, OnActivateMixin):
             scale=(50, 50, 50, 1)
         )
         self.axis.transform = axis_t.as_matrix()
-        self.apply_translation()
         self.scene.events.mouse_move.connect(self.on_mouse_move)
 
+    def on_threshold_changed(self, *args):
+        self.fixed_visual.threshold = self.model.fixed_display_threshold.get()
+        self.moving_visual.threshold = \
+            self.model.moving_display_threshold.get()
+        self.scene.update()
+
     def on_mouse_move(self, event):
-        if event.button == 1 and event.is_dragging:
+        if event.button == 1 and event.is_dragging and self.level:
             self.axis.transform.reset()
 
             self.axis.transform.rotate(self.camera.roll, (0, 0, 1))
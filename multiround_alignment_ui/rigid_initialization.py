@@ -0,0 +1,299 @@
+#
+# Automatic initialization of the rigid alignment parameters from a coarse
+# level of the fixed and moving volumes.
+#
+# Coordinates here are z, y, x voxel coordinates at the level being used.
+# The rigid transform maps a fixed voxel, f, to a moving voxel, m:
+#
+#     m = A (f - c) + c + d
+#
+# where A is the rotation matrix, c is the center of rotation and d is the
+# translation.
+#
+import itertools
+import typing
+
+import numpy as np
+from scipy import ndimage, optimize
+
+from phathom.registration.pcloud import rotation_matrix
+from precomputed_tif.client import ArrayReader
+
+#
+# Use the finest level whose largest dimension is at most this for the
+# initialization.
+#
+INITIALIZATION_MAX_DIMENSION = 128
+
+
+class RigidInitialization:
+    """
+    The result of initializing the rigid alignment
+
+    :ivar angles: the rotation angles, in radians, in the order passed to
+    phathom's rotation_matrix: about z, about y and about x.
+    :ivar matrix: the 3 x 3 rotation matrix in z, y, x coordinates
+    :ivar center: the z, y, x center of rotation
+    :ivar translation: the z, y, x translation, d above
+    :ivar score: the normalized cross-correlation of the fixed volume
+    and the transformed moving volume.
+    """
+
+    def __init__(self, angles, matrix, center, translation, score):
+        self.angles = angles
+        self.matrix = matrix
+        self.center = center
+        self.translation = translation
+        self.score = score
+
+    def display_offset(self) -> np.ndarray:
+        """
+        The z, y, x offset in the parameterization of the rigid alignment
+        widget, which maps a fixed voxel to m = A (f - c) - A A (t - c)
+
+        :return: t, the offset that gives the same transform as the
+        translation, d.
+        """
+        c = np.asarray(self.center)
+        d = np.asarray(self.translation)
+        return c - self.matrix.T.dot(self.matrix.T).dot(c + d)
+
+
+def choose_initialization_level(
+        fixed_shapes:typing.Dict[int, typing.Sequence[int]],
+        moving_shapes:typing.Dict[int, typing.Sequence[int]]) -> int:
+    """
+    Choose the pyramid level to use for initializing the alignment
+
+    :param fixed_shapes: the shapes of the fixed volume's levels, as
+    returned by precomputed_level_shapes
+    :param moving_shapes: the shapes of the moving volume's levels
+    :return: the finest level, present in both volumes, that is small enough
+    or the coarsest common level if none are.
+    """
+    levels = sorted(set(fixed_shapes).intersection(moving_shapes))
+    if len(levels) == 0:
+        raise ValueError("The fixed and moving volumes have no common levels")
+    for level in levels:
+        if max(fixed_shapes[level]) <= INITIALIZATION_MAX_DIMENSION and \
+                max(moving_shapes[level]) <= INITIALIZATION_MAX_DIMENSION:
+            return level
+    return levels[-1]
+
+
+def read_level(url:str, level:int) -> np.ndarray:
+    """
+    Read a whole level of a blockfs precomputed volume
+
+    :param url: the URL of the volume
+    :param level: the level to read, e.g. 1, 2, 4...
+    """
+    array = ArrayReader(url, format="blockfs", level=level)
+    shape = array.shape
+    return array[0:shape[0], 0:shape[1], 0:shape[2]]
+
+
+def normalize_volume(volume:np.ndarray) -> np.ndarray:
+    """
+    Remove the background from a volume so that the tissue dominates its
+    moments and correlations.
+
+    :param volume: the volume to normalize
+    :return: a float32 volume, zero in the background
+    """
+    volume = volume.astype(np.float32)
+    return np.maximum(volume - np.median(volume), 0)
+
+
+def weighted_moments(volume:np.ndarray) \
+        -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the intensity-weighted centroid and covariance of a volume
+
+    :param volume: a non-negative volume
+    :return: the z, y, x centroid and the 3 x 3 covariance matrix
+    """
+    total = volume.sum()
+    if total == 0:
+        raise ValueError("The volume has no foreground")
+    coords = np.indices(volume.shape, dtype=np.float32).reshape(3, -1)
+    weights = volume.reshape(-1)
+    centroid = coords.dot(weights) / total
+    coords -= centroid[:, np.newaxis]
+    covariance = (coords * weights).dot(coords.T) / total
+    return centroid, covariance
+
+
+def principal_axes(covariance:np.ndarray) -> np.ndarray:
+    """
+    The principal axes of a covariance matrix
+
+    :param covariance: a 3 x 3 covariance matrix
+    :return: a 3 x 3 matrix whose columns are the axes, largest first
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    return eigenvectors[:, np.argsort(eigenvalues)[::-1]]
+
+
+def candidate_rotations(fixed_axes:np.ndarray, moving_axes:np.ndarray) \
+        -> typing.List[np.ndarray]:
+    """
+    The rotations that take the fixed principal axes to the moving ones
+
+    The sign of each axis is arbitrary, so there are four proper rotations
+    that match the axes. The identity is included too, for volumes whose
+    principal axes are ill-defined.
+
+    :param fixed_axes: the principal axes of the fixed volume
+    :param moving_axes: the principal axes of the moving volume
+    """
+    rotations = [np.eye(3)]
+    for signs in itertools.product((1, -1), repeat=3):
+        matrix = moving_axes.dot(np.diag(signs)).dot(fixed_axes.T)
+        if np.linalg.det(matrix) > 0:
+            rotations.append(matrix)
+    return rotations
+
+
+def rotation_to_angles(matrix:np.ndarray) -> np.ndarray:
+    """
+    Find the angles that phathom's rotation_matrix turns into the matrix
+
+    :param matrix: a 3 x 3 rotation matrix
+    :return: the angles, in radians, in rotation_matrix's order
+    """
+    def residuals(angles):
+        return (rotation_matrix(angles) - matrix).ravel()
+
+    best = None
+    for start in itertools.product((-np.pi / 2, np.pi / 2), repeat=3):
+        result = optimize.least_squares(residuals, start)
+        if best is None or result.cost < best.cost:
+            best = result
+    return np.arctan2(np.sin(best.x), np.cos(best.x))
+
+
+def transform_moving(moving:np.ndarray, matrix:np.ndarray,
+                     center:np.ndarray, translation:np.ndarray,
+                     shape:typing.Sequence[int]) -> np.ndarray:
+    """
+    Resample the moving volume into the fixed volume's space
+
+    :param moving: the moving volume
+    :param matrix: the rotation matrix, A
+    :param center: the center of rotation, c
+    :param translation: the translation, d
+    :param shape: the shape of the fixed volume
+    """
+    offset = center + translation - matrix.dot(center)
+    return ndimage.affine_transform(moving, matrix, offset,
+                                    output_shape=tuple(shape), order=1)
+
+
+def phase_correlation(fixed:np.ndarray, moving:np.ndarray) -> np.ndarray:
+    """
+    Find the shift, s, that best aligns fixed(x) with moving(x - s)
+
+    :param fixed: the fixed volume
+    :param moving: a volume of the same shape
+    :return: the z, y, x shift in voxels
+    """
+    cross_power = np.fft.rfftn(fixed) * np.conj(np.fft.rfftn(moving))
+    cross_power /= np.abs(cross_power) + np.finfo(np.float32).eps
+    correlation = np.fft.irfftn(cross_power, s=fixed.shape)
+    shift = np.array(np.unravel_index(np.argmax(correlation),
+                                      correlation.shape), float)
+    shape = np.array(fixed.shape)
+    wrapped = shift > shape / 2
+    shift[wrapped] -= shape[wrapped]
+    return shift
+
+
+def normalized_cross_correlation(a:np.ndarray, b:np.ndarray) -> float:
+    """The normalized cross-correlation of two volumes of the same shape"""
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = np.sqrt((a * a).sum() * (b * b).sum())
+    if denominator == 0:
+        return 0.0
+    return float((a * b).sum() / denominator)
+
+
+def transform_from_display(angles:typing.Sequence[float],
+                           center:typing.Sequence[float],
+                           offset:typing.Sequence[float]) \
+        -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Convert the rigid alignment widget's parameters to a transform
+
+    This is the inverse of RigidInitialization.display_offset.
+
+    :param angles: the rotation angles in radians, in rotation_matrix's order
+    :param center: the z, y, x center of rotation
+    :param offset: the z, y, x offset
+    :return: the rotation matrix, A, the center, c, and the translation, d
+    """
+    matrix = rotation_matrix(angles)
+    center = np.asarray(center, float)
+    translation = -matrix.dot(matrix).dot(np.asarray(offset, float) - center)\
+        - center
+    return matrix, center, translation
+
+
+def score_transform(fixed:np.ndarray, moving:np.ndarray,
+                    matrix:np.ndarray, center:np.ndarray,
+                    translation:np.ndarray, step:int=2) -> float:
+    """
+    Score the overlap of the fixed volume and the transformed moving volume
+
+    :param fixed: the normalized fixed volume
+    :param moving: the normalized moving volume
+    :param matrix: the rotation matrix, A
+    :param center: the center of rotation, c
+    :param translation: the translation, d
+    :param step: score on a grid of every step'th voxel of the fixed volume
+    :return: the normalized cross-correlation
+    """
+    fixed = fixed[::step, ::step, ::step]
+    offset = center + translation - matrix.dot(center)
+    transformed = ndimage.affine_transform(moving, matrix * step, offset,
+                                           output_shape=fixed.shape, order=1)
+    return normalized_cross_correlation(fixed, transformed)
+
+
+def initialize_rigid_alignment(fixed:np.ndarray, moving:np.ndarray) \
+        -> RigidInitialization:
+    """
+    Estimate the rigid transform from the fixed volume to the moving one
+
+    The centroids give the translation and the principal axes give the
+    candidate rotations. Each candidate's translation is refined by phase
+    correlation and the candidate with the best normalized cross-correlation
+    is chosen.
+
+    :param fixed: the fixed volume at a coarse level
+    :param moving: the moving volume at the same level
+    """
+    fixed = normalize_volume(fixed)
+    moving = normalize_volume(moving)
+    fixed_centroid, fixed_covariance = weighted_moments(fixed)
+    moving_centroid, moving_covariance = weighted_moments(moving)
+    candidates = candidate_rotations(principal_axes(fixed_covariance),
+                                     principal_axes(moving_covariance))
+    center = fixed_centroid
+    best = None
+    for candidate in candidates:
+        angles = rotation_to_angles(candidate)
+        matrix = rotation_matrix(angles)
+        translation = moving_centroid - fixed_centroid
+        transformed = transform_moving(moving, matrix, center, translation,
+                                       fixed.shape)
+        shift = phase_correlation(fixed, transformed)
+        translation = translation - matrix.dot(shift)
+        transformed = transform_moving(moving, matrix, center, translation,
+                                       fixed.shape)
+        score = normalized_cross_correlation(fixed, transformed)
+        if best is None or score > best.score:
+            best = RigidInitialization(angles, matrix, center, translation,
+                                       score)
+    return best
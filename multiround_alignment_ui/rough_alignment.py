@@ -1,12 +1,31 @@
+import functools
+import time
+
 import numpy as np
 import os
+import tqdm
 
-from PyQt5.QtCore import QProcess
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QPushButton, QTextEdit, QGroupBox
+from PyQt5.QtCore import QProcess, QProcessEnvironment
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QPushButton, QTextEdit, \
+    QGroupBox, QHBoxLayout, QLabel, QSpinBox, QDoubleSpinBox, QSplitter
+from PyQt5 import QtCore
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.figure import Figure
 
+from multiround_alignment_ui.elastix_output import ElastixOutputParser
 from multiround_alignment_ui.utils import fixed_neuroglancer_path_is_valid, moving_neuroglancer_path_is_valid, \
-    fixed_neuroglancer_url, moving_neuroglancer_url
-from precomputed_tif.client import ArrayReader
+    fixed_neuroglancer_url, moving_neuroglancer_url, \
+    choose_registration_level, precomputed_level_shapes, \
+    start_progress, update_progress, end_progress
+
+#
+# The metric has plateaued if it improves by less than this fraction...
+#
+PLATEAU_TOLERANCE = 1e-4
+#
+# ... over this many iterations of the last resolution
+#
+PLATEAU_WINDOW = 50
 
 
 class RoughAlignmentWidget(QWidget):
@@ -14,7 +33,8 @@ class RoughAlignmentWidget(QWidget):
         QWidget.__init__(self)
         self.model = model
         self.running = False
-        self.process = None
+        self.processes = []
+        self.parsers = []
 
         def on_output_change(*args):
             self.model.rough_interpolator.set(
@@ -32,12 +52,53 @@ class RoughAlignmentWidget(QWidget):
         #
         layout = QVBoxLayout()
         self.setLayout(layout)
+        group_box = QGroupBox("Multi-start")
+        layout.addWidget(group_box)
+        gb_layout = QVBoxLayout()
+        group_box.setLayout(gb_layout)
+        hlayout = QHBoxLayout()
+        gb_layout.addLayout(hlayout)
+        hlayout.addWidget(QLabel("# of starts"))
+        n_starts_widget = QSpinBox()
+        n_starts_widget.setRange(1, 64)
+        self.model.rough_n_starts.bind_spin_box(n_starts_widget)
+        hlayout.addWidget(n_starts_widget)
+        hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        gb_layout.addLayout(hlayout)
+        hlayout.addWidget(QLabel("Angle perturbation (°)"))
+        angle_perturbation_widget = QDoubleSpinBox()
+        angle_perturbation_widget.setRange(0, 180)
+        self.model.rough_angle_perturbation.bind_double_spin_box(
+            angle_perturbation_widget)
+        hlayout.addWidget(angle_perturbation_widget)
+        hlayout.addStretch(1)
+        hlayout = QHBoxLayout()
+        gb_layout.addLayout(hlayout)
+        hlayout.addWidget(QLabel("Offset perturbation (voxels)"))
+        offset_perturbation_widget = QSpinBox()
+        offset_perturbation_widget.setRange(0, 100000)
+        self.model.rough_offset_perturbation.bind_spin_box(
+            offset_perturbation_widget)
+        hlayout.addWidget(offset_perturbation_widget)
+        hlayout.addStretch(1)
         self.go_button = QPushButton()
         self.decorate_go_button()
         self.go_button.clicked.connect(self.on_go)
         layout.addWidget(self.go_button)
+        splitter = QSplitter(QtCore.Qt.Vertical)
+        layout.addWidget(splitter)
+        group_box = QGroupBox("Convergence")
+        splitter.addWidget(group_box)
+        gb_layout = QVBoxLayout()
+        group_box.setLayout(gb_layout)
+        self.figure = Figure()
+        self.canvas = FigureCanvasQTAgg(self.figure)
+        gb_layout.addWidget(self.canvas)
+        self.axes = self.figure.add_subplot(1, 1, 1)
+        self.metric_lines = []
         group_box = QGroupBox("Elastix output")
-        layout.addWidget(group_box)
+        splitter.addWidget(group_box)
         gb_layout = QVBoxLayout()
         group_box.setLayout(gb_layout)
         self.stdout = QTextEdit()
@@ -57,85 +118,281 @@ class RoughAlignmentWidget(QWidget):
             self.go_button.setDisabled(False)
         else:
             self.go_button.setDisabled(True)
-        if os.path.exists(self.model.rough_interpolator.get()):
+        if self.model.file_status.exists(self.model.rough_interpolator.get()):
             self.go_button.setText("Rerun rough alignment")
         else:
             self.go_button.setText("Run rough alignment")
 
+    def initial_poses(self):
+        """
+        The initial rotations and translations for the registrations
+
+        The first pose is the one from the rigid alignment. The rest are
+        random perturbations of it, seeded so that a rerun starts from the
+        same poses.
+
+        :return: a list of (rotation, translation) where the rotation is the
+        x, y and z angles in degrees and the translation is the x, y and z
+        offsets in voxels.
+        """
+        rotation = np.array([self.model.angle_x.get(),
+                             self.model.angle_y.get(),
+                             self.model.angle_z.get()])
+        translation = np.array([self.model.offset_x.get(),
+                                self.model.offset_y.get(),
+                                self.model.offset_z.get()], float)
+        poses = [(rotation, translation)]
+        n_starts = self.model.rough_n_starts.get()
+        random_state = np.random.RandomState(n_starts)
+        for _ in range(1, n_starts):
+            poses.append((
+                rotation + random_state.normal(
+                    scale=self.model.rough_angle_perturbation.get(), size=3),
+                translation + random_state.normal(
+                    scale=self.model.rough_offset_perturbation.get(), size=3)
+            ))
+        return poses
+
+    def start_interpolator_path(self, idx:int) -> str:
+        """
+        The path to the interpolator written by one start of a multi-start
+        registration
+
+        :param idx: the index of the start
+        """
+        root, ext = os.path.splitext(self.model.rough_interpolator.get())
+        return "%s-start-%d%s" % (root, idx, ext)
+
     def on_go(self, *args):
         if self.running:
-            self.process.kill()
+            self.on_cancel()
             return
         self.running = True
-        url = fixed_neuroglancer_url(self.model)
-        for level_idx in range(0, 6):
-            level = 2 ** level_idx
-            fixed_array = ArrayReader(url, format='blockfs', level = level)
-            if np.min(fixed_array.shape) < 50 and \
-                    np.max(fixed_array.shape) < 1000:
-                break
-
-        initial_rotation = "%f,%f,%f" % (
-            self.model.angle_x.get(),
-            self.model.angle_y.get(),
-            self.model.angle_z.get())
-        initial_translation = "%f,%f,%f" % (
-            self.model.offset_x.get(),
-            self.model.offset_y.get(),
-            self.model.offset_z.get())
+        level = choose_registration_level(
+            precomputed_level_shapes(self.model.fixed_precomputed_path.get()),
+            (self.model.x_voxel_size.get(),
+             self.model.y_voxel_size.get(),
+             self.model.z_voxel_size.get()),
+            self.model.n_workers.get())
+
         rotation_center = "%f,%f,%f" % (
             self.model.center_x.get(),
             self.model.center_y.get(),
             self.model.center_z.get())
+        poses = self.initial_poses()
+        multi_start = len(poses) > 1
+        #
+        # Each registration gets its share of the cores
+        #
+        n_threads = max(1, self.model.n_workers.get() // len(poses))
+        environment = QProcessEnvironment.systemEnvironment()
+        environment.insert("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+                           str(n_threads))
+        environment.insert("OMP_NUM_THREADS", str(n_threads))
         self.stdout.clear()
-        self.process = QProcess(self)
-        self.process.readyReadStandardOutput.connect(self.on_stdout)
-        self.process.readyReadStandardError.connect(self.on_stderr)
-        self.process.started.connect(self.on_process_started)
-        self.process.finished.connect(self.on_process_finished)
+        self.processes = []
+        self.parsers = []
+        self.process_interpolators = []
+        self.plateaued = set()
+        self.reset_plot(len(poses))
+        self.n_running = len(poses)
         working_dir = os.path.join(self.model.output_path.get(), "alignment")
-        result = self.process.start(
-                "phathom-non-rigid-registration",
-                ["--fixed-url", fixed_neuroglancer_url(self.model),
-                 "--fixed-url-format", "blockfs",
-                 "--moving-url", moving_neuroglancer_url(self.model),
-                 "--moving-url-format", "blockfs",
-                 "--output", self.model.rough_interpolator.get(),
-                 "--initial-rotation=" + initial_rotation,
-                 "--initial-translation=" + initial_translation,
-                 "--rotation-center=" + rotation_center,
-                 "--mipmap-level=" + str(level),
-                 "--working-dir", working_dir,
-                 "--invert"]
-            )
+        for idx, (rotation, translation) in enumerate(poses):
+            if multi_start:
+                interpolator = self.start_interpolator_path(idx)
+                start_working_dir = os.path.join(working_dir,
+                                                 "start-%d" % idx)
+            else:
+                interpolator = self.model.rough_interpolator.get()
+                start_working_dir = working_dir
+            initial_rotation = "%f,%f,%f" % tuple(rotation)
+            initial_translation = "%f,%f,%f" % tuple(translation)
+            process = QProcess(self)
+            process.setProcessEnvironment(environment)
+            process.readyReadStandardOutput.connect(
+                functools.partial(self.on_stdout, idx))
+            process.readyReadStandardError.connect(
+                functools.partial(self.on_stderr, idx))
+            process.started.connect(self.on_process_started)
+            process.finished.connect(
+                functools.partial(self.on_process_finished, idx))
+            self.processes.append(process)
+            self.parsers.append(ElastixOutputParser())
+            self.process_interpolators.append(interpolator)
+            process.start(
+                    "phathom-non-rigid-registration",
+                    ["--fixed-url", fixed_neuroglancer_url(self.model),
+                     "--fixed-url-format", "blockfs",
+                     "--moving-url", moving_neuroglancer_url(self.model),
+                     "--moving-url-format", "blockfs",
+                     "--output", interpolator,
+                     "--initial-rotation=" + initial_rotation,
+                     "--initial-translation=" + initial_translation,
+                     "--rotation-center=" + rotation_center,
+                     "--mipmap-level=" + str(level),
+                     "--working-dir", start_working_dir,
+                     "--invert"]
+                )
         self.go_button.setText("Cancel")
+        self.start_time = time.time()
+        start_progress(0, self.on_cancel)
 
-    def on_stdout(self):
-        #
-        # Code derived from
-        # https://stackoverflow.com/questions/22069321/realtime-output-from-a-subprogram-to-stdout-of-a-pyqt-widget
-        #
-        cursor = self.stdout.textCursor()
-        cursor.movePosition(cursor.End)
-        btext:bytes = bytes(self.process.readAllStandardOutput())
-        cursor.insertText(btext.decode("ascii"))
-        self.stdout.ensureCursorVisible()
+    def on_cancel(self, *args):
+        for process in self.processes:
+            process.kill()
 
-    def on_stderr(self):
+    def append_output(self, idx:int, btext:bytes):
+        """
+        Append a registration's output to the text box
+
+        :param idx: the index of the registration's process
+        :param btext: the text that the process wrote
+        """
+        text = btext.decode("ascii", errors="replace")
+        if len(self.parsers[idx].feed(text)) > 0:
+            self.on_progress(idx)
+        if len(self.processes) > 1:
+            text = "".join(["[start %d] %s" % (idx, line)
+                            for line in text.splitlines(True)])
         #
         # Code derived from
         # https://stackoverflow.com/questions/22069321/realtime-output-from-a-subprogram-to-stdout-of-a-pyqt-widget
         #
         cursor = self.stdout.textCursor()
         cursor.movePosition(cursor.End)
-        btext:bytes = bytes(self.process.readAllStandardError())
-        cursor.insertText(btext.decode("ascii"))
+        cursor.insertText(text)
         self.stdout.ensureCursorVisible()
 
+    def on_stdout(self, idx:int):
+        self.append_output(
+            idx, bytes(self.processes[idx].readAllStandardOutput()))
+
+    def on_stderr(self, idx:int):
+        self.append_output(
+            idx, bytes(self.processes[idx].readAllStandardError()))
+
     def on_process_started(self):
         pass
 
-    def on_process_finished(self):
+    def reset_plot(self, n_starts:int):
+        """
+        Clear the convergence plot and make a line for each registration
+
+        :param n_starts: the number of registrations
+        """
+        self.axes.clear()
+        self.axes.set_xlabel("Iteration")
+        self.axes.set_ylabel("Metric")
+        self.metric_lines = [
+            self.axes.plot([], [], label="start %d" % idx)[0]
+            for idx in range(n_starts)]
+        if n_starts > 1:
+            self.axes.legend(loc="upper right")
+        self.canvas.draw_idle()
+
+    def on_progress(self, idx:int):
+        """
+        Called when a registration has reported new iterations
+
+        :param idx: the index of the registration's process
+        """
+        parser = self.parsers[idx]
+        metrics = [_.metric for _ in parser.events]
+        self.metric_lines[idx].set_data(np.arange(len(metrics)), metrics)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.canvas.draw_idle()
+        #
+        # Overall progress is the sum over the registrations
+        #
+        totals = [_.total_iterations() for _ in self.parsers]
+        done = sum([_.completed_iterations() for _ in self.parsers])
+        if any([_ is None for _ in totals]):
+            total = 0
+            eta = "?"
+        else:
+            total = sum(totals)
+            elapsed = time.time() - self.start_time
+            eta = tqdm.tqdm.format_interval(
+                elapsed * (total - done) / max(done, 1))
+        resolution = parser.events[-1].resolution
+        message = "Resolution %d, iteration %d, metric %.5g, ETA %s" % (
+            resolution, parser.events[-1].iteration, parser.metric, eta)
+        if len(self.parsers) > 1:
+            message = "Start %d: %s" % (idx, message)
+        update_progress(done, message, total)
+        if idx not in self.plateaued and \
+                parser.has_plateaued(PLATEAU_WINDOW, PLATEAU_TOLERANCE):
+            self.on_plateau(idx)
+
+    def on_plateau(self, idx:int):
+        """
+        Called when the metric of a registration stops improving
+
+        Elastix writes the transform only when it finishes, so killing a
+        registration discards it. A registration is stopped early only if
+        it has no chance to win: another registration is at least as far
+        along and has a better metric.
+
+        :param idx: the index of the registration whose metric plateaued
+        """
+        self.plateaued.add(idx)
+        parser = self.parsers[idx]
+        self.stdout.append("Metric plateaued at %.5g%s\n" % (
+            parser.metric,
+            "" if len(self.parsers) == 1 else " for start %d" % idx))
+        for other_idx, other in enumerate(self.parsers):
+            if other_idx == idx or \
+                    self.process_interpolators[other_idx] is None or \
+                    not other.in_last_resolution():
+                continue
+            if min(other.metric, other.final_metric) < parser.metric:
+                self.stdout.append(
+                    "Stopping start %d, start %d has a better metric\n" %
+                    (idx, other_idx))
+                self.process_interpolators[idx] = None
+                self.processes[idx].kill()
+                return
+
+    def on_process_finished(self, idx:int, exit_code:int,
+                            exit_status:QProcess.ExitStatus):
+        self.n_running -= 1
+        if exit_code != 0 or exit_status != QProcess.NormalExit:
+            self.process_interpolators[idx] = None
+        if self.n_running > 0:
+            return
+        end_progress()
+        if len(self.processes) > 1:
+            self.choose_best_start()
         self.running = False
-        self.process = None
-        self.decorate_go_button()
\ No newline at end of file
+        self.processes = []
+        self.model.file_status.invalidate(self.model.rough_interpolator.get())
+        self.decorate_go_button()
+
+    def choose_best_start(self):
+        """
+        Keep the interpolator of the registration with the lowest final
+        metric as the rough interpolator and delete the others.
+        """
+        best_idx = None
+        best_metric = np.inf
+        for idx, (interpolator, parser) in enumerate(
+                zip(self.process_interpolators, self.parsers)):
+            if interpolator is None or not os.path.exists(interpolator):
+                continue
+            metric = parser.final_metric
+            if best_idx is None or metric < best_metric:
+                best_idx = idx
+                best_metric = metric
+        for idx, interpolator in enumerate(self.process_interpolators):
+            if idx != best_idx:
+                path = self.start_interpolator_path(idx)
+                if os.path.exists(path):
+                    os.remove(path)
+        if best_idx is None:
+            self.stdout.append("No registration completed\n")
+            return
+        os.replace(self.process_interpolators[best_idx],
+                   self.model.rough_interpolator.get())
+        self.stdout.append("Start %d had the best final metric (%f)\n" %
+                           (best_idx, best_metric))
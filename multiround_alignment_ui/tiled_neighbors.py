@@ -0,0 +1,185 @@
+#
+# Find neighbors one block of space at a time, so that the memory needed is
+# bounded by the number of cells in a block rather than in the whole volume.
+#
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import typing
+
+import numpy as np
+from phathom.pipeline.find_neighbors_cmd import main as find_neighbors
+
+from .convergence import MATCH_KEYS, match_keys, warp_coords
+from .feature_storage import load_coords, load_geometric_features
+
+#
+# The default edge length, in voxels, of a tile
+#
+DEFAULT_TILE_SIZE = 1024
+
+
+def tile_starts(shape:typing.Sequence[float], tile_size:int) \
+        -> typing.List[typing.Sequence[int]]:
+    """
+    The x, y, z start of each tile covering a volume
+
+    :param shape: the x, y, z extent of the volume
+    :param tile_size: the edge length of a tile
+    """
+    return list(itertools.product(
+        *[range(0, max(int(np.ceil(size)), 1), tile_size) for size in shape]))
+
+
+def find_neighbors_tiled(fixed_coords_path:str,
+                         moving_coords_path:str,
+                         fixed_features_path:str,
+                         moving_features_path:str,
+                         transform_path:str,
+                         output_path:str,
+                         visualization_path:str,
+                         voxel_size:typing.Sequence[float],
+                         radius:float,
+                         max_fdist:float,
+                         prom_thresh:float,
+                         max_neighbors:int,
+                         n_workers:int,
+                         tile_size:int=DEFAULT_TILE_SIZE,
+                         progress:typing.Callable[[int, int], None]=None):
+    """
+    Run find-neighbors on overlapping tiles of the moving volume
+
+    Each fixed cell is assigned to the tile that holds its position in the
+    moving volume after the transform. The tile's moving cells are those
+    within the tile, padded by the search radius, so every fixed cell sees
+    the same candidates as it would if the volume were processed whole.
+
+    :param fixed_coords_path: the JSON file of fixed cell coordinates
+    :param moving_coords_path: the JSON file of moving cell coordinates
+    :param fixed_features_path: the .npy file of the fixed cells' features,
+    one row per fixed cell
+    :param moving_features_path: the .npy file of the moving cells' features,
+    one row per moving cell
+    :param transform_path: the interpolator mapping fixed to moving
+    coordinates
+    :param output_path: where to write the merged matches
+    :param visualization_path: where to write the visualization of the tile
+    with the most matches
+    :param voxel_size: the x, y, z voxel size in microns
+    :param radius: the search radius in microns
+    :param max_fdist: the maximum feature distance
+    :param prom_thresh: the prominence threshold
+    :param max_neighbors: the maximum number of neighbors of a cell
+    :param n_workers: the number of worker processes for each tile
+    :param tile_size: the edge length, in voxels, of a tile
+    :param progress: called with the number of tiles done and the number of
+    tiles after each tile
+    """
+    fixed_coords = load_coords(fixed_coords_path)
+    moving_coords = load_coords(moving_coords_path)
+    fixed_features = load_geometric_features(fixed_features_path)
+    moving_features = load_geometric_features(moving_features_path)
+    warped_coords = warp_coords(np.asarray(fixed_coords), transform_path,
+                                n_workers)
+    padding = radius / np.asarray(voxel_size, float)
+    extent = np.maximum(warped_coords.max(axis=0, initial=0),
+                        moving_coords.max(axis=0, initial=0)) + 1
+    starts = tile_starts(extent, tile_size)
+    #
+    # Fixed cells that land outside of the volume go into the nearest tile.
+    #
+    n_tiles = np.ceil(extent / tile_size).astype(int)
+    tile_idxs = np.clip(np.floor(warped_coords / tile_size).astype(int),
+                        0, n_tiles - 1)
+    results = []
+    best_n_matches = -1
+    with tempfile.TemporaryDirectory() as tempdir:
+        for tile_idx, start in enumerate(starts):
+            start = np.array(start)
+            fixed_mask = np.all(tile_idxs == start // tile_size, axis=1)
+            if not np.any(fixed_mask):
+                if progress is not None:
+                    progress(tile_idx + 1, len(starts))
+                continue
+            moving_mask = np.all(
+                (moving_coords >= start - padding) &
+                (moving_coords < start + tile_size + padding), axis=1)
+            fixed_idxs = np.where(fixed_mask)[0]
+            moving_idxs = np.where(moving_mask)[0]
+            tile_dir = os.path.join(tempdir, "tile_%d" % tile_idx)
+            os.mkdir(tile_dir)
+            paths = dict([(name, os.path.join(tile_dir, name)) for name in (
+                "fixed-coords.json", "moving-coords.json",
+                "fixed-features.npy", "moving-features.npy",
+                "matches.json", "matches.pdf")])
+            with open(paths["fixed-coords.json"], "w") as fd:
+                json.dump(fixed_coords[fixed_idxs].tolist(), fd)
+            with open(paths["moving-coords.json"], "w") as fd:
+                json.dump(moving_coords[moving_idxs].tolist(), fd)
+            np.save(paths["fixed-features.npy"], fixed_features[fixed_idxs])
+            np.save(paths["moving-features.npy"], moving_features[moving_idxs])
+            find_neighbors([str(_) for _ in (
+                "--fixed-coords", paths["fixed-coords.json"],
+                "--moving-coords", paths["moving-coords.json"],
+                "--fixed-features", paths["fixed-features.npy"],
+                "--moving-features", paths["moving-features.npy"],
+                "--non-rigid-transformation", transform_path,
+                "--output", paths["matches.json"],
+                "--visualization-file", paths["matches.pdf"],
+                "--voxel-size", ",".join(["%.02f" % _ for _ in voxel_size]),
+                "--radius", radius,
+                "--max-fdist", max_fdist,
+                "--prom-thresh", prom_thresh,
+                "--max-neighbors", max_neighbors,
+                "--n-workers", n_workers)])
+            with open(paths["matches.json"]) as fd:
+                result = json.load(fd)
+            results.append(result)
+            n_matches = count_matches(result)
+            if n_matches > best_n_matches and \
+                    os.path.exists(paths["matches.pdf"]):
+                shutil.copyfile(paths["matches.pdf"], visualization_path)
+                best_n_matches = n_matches
+            if progress is not None:
+                progress(tile_idx + 1, len(starts))
+    with open(output_path, "w") as fd:
+        json.dump(merge_matches(results), fd)
+
+
+def count_matches(matches:dict) -> int:
+    """The number of matches in a match file's dictionary"""
+    return len(matches[match_keys(matches)[0]])
+
+
+def merge_matches(results:typing.Sequence[dict]) -> dict:
+    """
+    Merge the matches of several tiles, dropping duplicated matches
+
+    Values that have one entry per match are concatenated. Other values are
+    taken from the first tile.
+
+    :param results: the contents of each tile's match file
+    """
+    results = [_ for _ in results if count_matches(_) > 0]
+    if len(results) == 0:
+        return dict([(key, []) for key in MATCH_KEYS[0]])
+    fixed_key, moving_key = match_keys(results[0])
+    merged = dict(results[0])
+    per_match_keys = [key for key, value in results[0].items()
+                      if isinstance(value, list) and
+                      len(value) == count_matches(results[0])]
+    for key in per_match_keys:
+        merged[key] = []
+    seen = set()
+    for result in results:
+        for idx, (fixed, moving) in enumerate(
+                zip(result[fixed_key], result[moving_key])):
+            match = (tuple(fixed), tuple(moving))
+            if match in seen:
+                continue
+            seen.add(match)
+            for key in per_match_keys:
+                merged[key].append(result[key][idx])
+    return merged
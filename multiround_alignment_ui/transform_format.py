@@ -0,0 +1,296 @@
+#
+# A versioned binary format for transforms.
+#
+# The file starts with a fixed header:
+#
+#   8 bytes   magic, b"MRAXFORM"
+#   uint32    format version
+#   uint32    reserved, zero
+#   uint64    length of the JSON header in bytes
+#   uint64    offset of the array data from the start of the file
+#
+# followed by the JSON header, which describes the transform's type,
+# attributes and the dtype, shape and offset of each array. The arrays are
+# stored raw, in C order and little-endian, each starting on a 64-byte
+# boundary, so they can be memory-mapped without copying.
+#
+# Interpolators pickled by phathom can be converted: the arguments of their
+# constructors are stored as a tree of values and arrays, and they are
+# rebuilt on loading by calling the constructor with the memory-mapped
+# arrays. Only the classes in INTERPOLATOR_CLASSES are stored and rebuilt.
+#
+import argparse
+import json
+import os
+import pickle
+import struct
+import sys
+import typing
+
+import numpy as np
+from scipy import interpolate
+
+MAGIC = b"MRAXFORM"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+FIXED_HEADER = struct.Struct("<8sIIQQ")
+#
+# The classes, by the name stored in the file, that can be stored in and
+# rebuilt from an interpolator's transform file
+#
+INTERPOLATOR_CLASSES = {
+    "RegularGridInterpolator": interpolate.RegularGridInterpolator,
+    "Rbf": interpolate.Rbf,
+}
+
+
+def align(offset:int) -> int:
+    """Round an offset up to the next multiple of ALIGNMENT"""
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def binary_transform_path(path:str) -> str:
+    """
+    The path to the binary copy of an interpolator pickle
+
+    :param path: the path to the pickle
+    """
+    return os.path.splitext(path)[0] + ".xform"
+
+
+def write_transform(path:str, transform_type:str,
+                    arrays:typing.Dict[str, np.ndarray],
+                    attributes:dict=None):
+    """
+    Write a transform file
+
+    :param path: the path to the file
+    :param transform_type: the kind of transform, e.g. "displacement-field"
+    :param arrays: the transform's arrays by name
+    :param attributes: other JSON-serializable values
+    """
+    arrays = dict([(name, np.ascontiguousarray(array).astype(
+                    np.asarray(array).dtype.newbyteorder("<"), copy=False))
+                   for name, array in arrays.items()])
+    array_headers = {}
+    offset = 0
+    for name, array in arrays.items():
+        array_headers[name] = dict(dtype=array.dtype.str,
+                                   shape=list(array.shape),
+                                   offset=offset)
+        offset = align(offset + array.nbytes)
+    header = json.dumps(dict(
+        type=transform_type,
+        attributes=attributes or {},
+        arrays=array_headers)).encode("utf-8")
+    data_offset = align(FIXED_HEADER.size + len(header))
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as fd:
+        fd.write(FIXED_HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(header),
+                                   data_offset))
+        fd.write(header)
+        for name, array in arrays.items():
+            fd.seek(data_offset + array_headers[name]["offset"])
+            fd.write(array.tobytes())
+        fd.truncate(data_offset + offset)
+    os.replace(temp_path, path)
+
+
+def read_transform(path:str) \
+        -> typing.Tuple[str, dict, typing.Dict[str, np.ndarray]]:
+    """
+    Read a transform file, memory-mapping its arrays read-only
+
+    :param path: the path to the file
+    :return: the transform's type, attributes and arrays by name
+    """
+    with open(path, "rb") as fd:
+        magic, version, _, header_length, data_offset = \
+            FIXED_HEADER.unpack(fd.read(FIXED_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a transform file" % path)
+        if version > FORMAT_VERSION:
+            raise ValueError(
+                "%s is version %d of the transform format, but only versions "
+                "up to %d can be read" % (path, version, FORMAT_VERSION))
+        header = json.loads(fd.read(header_length).decode("utf-8"))
+    arrays = {}
+    for name, array_header in header["arrays"].items():
+        shape = tuple(array_header["shape"])
+        dtype = np.dtype(array_header["dtype"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype)
+        else:
+            arrays[name] = np.memmap(
+                path, dtype, "r", data_offset + array_header["offset"], shape)
+    return header["type"], header["attributes"], arrays
+
+
+def constructor_arguments(value) -> typing.Tuple[tuple, dict]:
+    """
+    The arguments that rebuild an interpolator when passed to its class
+
+    :param value: an instance of one of the INTERPOLATOR_CLASSES
+    :return: the positional and keyword arguments
+    """
+    if type(value) is interpolate.RegularGridInterpolator:
+        return (tuple(value.grid), np.asarray(value.values)), dict(
+            method=value.method,
+            bounds_error=bool(value.bounds_error),
+            fill_value=value.fill_value)
+    function = value.function
+    norm = getattr(value, "norm", "euclidean")
+    if not isinstance(function, str) or not isinstance(norm, str):
+        raise ValueError("Can't store an Rbf with a custom function or norm "
+                         "in a transform file")
+    return tuple(value.xi) + (value.di,), dict(
+        function=function,
+        epsilon=float(value.epsilon),
+        smooth=float(value.smooth),
+        norm=norm,
+        mode=getattr(value, "mode", "1-D"))
+
+
+def encode_state(value, arrays:typing.Dict[str, np.ndarray]):
+    """
+    Encode a value as a JSON-serializable tree, moving its arrays into arrays
+
+    :param value: the value to encode
+    :param arrays: the arrays found so far, by name
+    :return: the tree
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return dict(value=value)
+    if isinstance(value, np.generic):
+        return dict(scalar=value.item(), dtype=value.dtype.str)
+    if isinstance(value, np.ndarray):
+        if value.ndim == 0:
+            return encode_state(value[()], arrays)
+        if value.dtype.hasobject:
+            return dict(list=[encode_state(_, arrays) for _ in value.tolist()])
+        name = "a%d" % len(arrays)
+        arrays[name] = value
+        return dict(array=name)
+    if isinstance(value, (list, tuple)):
+        key = "list" if isinstance(value, list) else "tuple"
+        return {key: [encode_state(_, arrays) for _ in value]}
+    if isinstance(value, dict) and all([isinstance(_, str) for _ in value]):
+        return dict(dict=dict([(k, encode_state(v, arrays))
+                               for k, v in value.items()]))
+    for name, cls in INTERPOLATOR_CLASSES.items():
+        if type(value) is cls:
+            args, kwargs = constructor_arguments(value)
+            return dict(object=name,
+                        args=encode_state(args, arrays),
+                        kwargs=encode_state(kwargs, arrays))
+    raise ValueError("Can't store a %s in a transform file" %
+                     type(value).__name__)
+
+
+def decode_state(tree:dict, arrays:typing.Dict[str, np.ndarray]):
+    """
+    Rebuild a value encoded by encode_state
+
+    :param tree: the encoded value
+    :param arrays: the transform file's arrays by name
+    """
+    if "value" in tree:
+        return tree["value"]
+    if "scalar" in tree:
+        return np.dtype(tree["dtype"]).type(tree["scalar"])
+    if "array" in tree:
+        return arrays[tree["array"]]
+    if "list" in tree:
+        return [decode_state(_, arrays) for _ in tree["list"]]
+    if "tuple" in tree:
+        return tuple([decode_state(_, arrays) for _ in tree["tuple"]])
+    if "dict" in tree:
+        return dict([(k, decode_state(v, arrays))
+                     for k, v in tree["dict"].items()])
+    if tree["object"] not in INTERPOLATOR_CLASSES:
+        raise ValueError("Won't load a %s from a transform file" %
+                         tree["object"])
+    cls = INTERPOLATOR_CLASSES[tree["object"]]
+    return cls(*decode_state(tree["args"], arrays),
+               **decode_state(tree["kwargs"], arrays))
+
+
+def convert_interpolator(
+        pickle_path:str, dest_path:str=None,
+        check:typing.Callable[[typing.Any], bool]=None) -> str:
+    """
+    Convert a pickled interpolator to the binary transform format
+
+    :param pickle_path: the path to the pickle
+    :param dest_path: the path to the transform file or None to write it
+    next to the pickle
+    :param check: a function that is given the rebuilt interpolator and
+    returns True if it transforms points like the pickled one. Its result is
+    recorded as the "checked" attribute.
+    :return: the path to the transform file
+    """
+    if dest_path is None:
+        dest_path = binary_transform_path(pickle_path)
+    with open(pickle_path, "rb") as fd:
+        interpolator = pickle.load(fd)
+    arrays = {}
+    state = encode_state(interpolator, arrays)
+    attributes = dict(state=state)
+    if check is not None:
+        attributes["checked"] = bool(check(decode_state(state, arrays)))
+    write_transform(dest_path, "interpolator", arrays, attributes)
+    return dest_path
+
+
+def binary_interpolator_attributes(path:str) -> typing.Optional[dict]:
+    """
+    The attributes of an interpolator's binary copy
+
+    :param path: the path to the interpolator pickle
+    :return: the attributes or None if there is no binary copy that is
+    up to date with the pickle
+    """
+    binary_path = binary_transform_path(path)
+    if not os.path.exists(binary_path) or (
+            os.path.exists(path) and
+            os.path.getmtime(binary_path) < os.path.getmtime(path)):
+        return None
+    transform_type, attributes, arrays = read_transform(binary_path)
+    if transform_type != "interpolator":
+        raise ValueError("%s holds a %s, not an interpolator" %
+                         (binary_path, transform_type))
+    return attributes
+
+
+def load_interpolator(path:str):
+    """
+    Load an interpolator, from its binary copy if it has an up-to-date one
+    (see convert_interpolator)
+
+    :param path: the path to the interpolator pickle
+    """
+    binary_path = binary_transform_path(path)
+    if binary_interpolator_attributes(path) is not None:
+        transform_type, attributes, arrays = read_transform(binary_path)
+        return decode_state(attributes["state"], arrays)
+    with open(path, "rb") as fd:
+        return pickle.load(fd)
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Convert pickled interpolators to the binary transform "
+                    "format")
+    parser.add_argument("input", nargs="+",
+                        help="The path to an interpolator pickle")
+    return parser.parse_args(args)
+
+
+def main(args=sys.argv[1:]):
+    opts = parse_args(args)
+    for path in opts.input:
+        print("%s -> %s" % (path, convert_interpolator(path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import contextlib
+import hashlib
 import json
 import multiprocessing
 
+import numpy as np
+
 from functools import partial
 
 import gunicorn.app.base
@@ -17,11 +20,46 @@ from precomputed_tif.wsgi_webserver import serve_precomputed
 import tqdm
 import threading
 import traceback
+import typing
 from PyQt5.QtWidgets import QPushButton, QMessageBox, QApplication, QLineEdit,\
     QWidget, QFileDialog
 
+from multiround_alignment_ui.file_status import FileStatus
 from multiround_alignment_ui.model import Model, Variable
 
+#
+# The rough alignment needs a pyramid level whose smallest dimension is less
+# than this...
+#
+ROUGH_ALIGNMENT_MAX_MIN_DIMENSION = 50
+#
+# ... and whose largest dimension is less than this
+#
+ROUGH_ALIGNMENT_MAX_DIMENSION = 1000
+#
+# The rigid alignment preview needs a level that fits in this many voxels
+# on a side.
+#
+PREVIEW_MAX_DIMENSION = 512
+#
+# Never make more levels than this
+#
+MAX_N_PRECOMPUTED_LEVELS = 12
+#
+# The rough alignment's budget: the number of voxels at the registration
+# level per worker...
+#
+ROUGH_ALIGNMENT_VOXELS_PER_WORKER = 2 ** 20
+#
+# ... and in total
+#
+ROUGH_ALIGNMENT_MAX_VOXELS = 2 ** 26
+#
+# There is no point in registering at a finer spacing than this (in microns)
+# for the rough alignment.
+#
+ROUGH_ALIGNMENT_TARGET_SPACING = 20.0
+
 PROGRESS = None
 MESSAGE = None
 CANCEL:QPushButton = None
@@ -101,6 +139,50 @@ def clear_status_bar_message():
     STATUS_BAR.clearMessage()
 
 
+def start_progress(maximum:int, on_cancel=None):
+    """
+    Show the status bar progress for a task that reports its own progress,
+    e.g. a subprocess, rather than iterating through tqdm
+
+    :param maximum: the value at completion or 0 if unknown
+    :param on_cancel: a function to call if the user presses the cancel
+    button. The cancel button is hidden if None.
+    """
+    PROGRESS.setMinimum(0)
+    PROGRESS.setMaximum(maximum)
+    PROGRESS.setValue(0)
+    MESSAGE.setText("")
+    PROGRESS.show()
+    MESSAGE.show()
+    if on_cancel is not None:
+        CANCEL.clicked.connect(on_cancel)
+        CANCEL.show()
+
+
+def update_progress(value:int, message:str=None, maximum:int=None):
+    """
+    Update the progress of a task started with start_progress
+
+    :param value: the amount done
+    :param message: the text to display next to the progress bar
+    :param maximum: the new value at completion if it has changed
+    """
+    if maximum is not None and maximum != PROGRESS.maximum():
+        PROGRESS.setMaximum(maximum)
+    PROGRESS.setValue(value)
+    if message is not None:
+        MESSAGE.setText(message)
+
+
+def end_progress():
+    """Hide the progress of a task started with start_progress"""
+    if CANCEL.isVisible():
+        CANCEL.clicked.disconnect()
+    PROGRESS.hide()
+    MESSAGE.hide()
+    CANCEL.hide()
+
+
 @contextlib.contextmanager
 def tqdm_progress():
     PROGRESS.show()
@@ -122,6 +204,10 @@ def tqdm_progress():
         future.set_result(False)
     finally:
         tqdm.tqdm = old
+        #
+        # The step has written files, so the cached file status is stale.
+        #
+        FileStatus.invalidate_all()
         PROGRESS.hide()
         MESSAGE.hide()
         CANCEL.hide()
@@ -148,9 +234,7 @@ def moving_neuroglancer_path_is_valid(model:Model) -> bool:
     :return:
     :rtype:
     """
-    return os.path.exists(
-        os.path.join(model.moving_precomputed_path.get(),
-                     "2_2_2", "precomputed.blockfs"))
+    return neuroglancer_path_is_valid(model.moving_precomputed_path.get())
 
 
 def fixed_neuroglancer_url(model:Model) -> str:
@@ -173,9 +257,212 @@ def fixed_neuroglancer_path_is_valid(model:Model) -> bool:
     :return:
     :rtype:
     """
+    return neuroglancer_path_is_valid(model.fixed_precomputed_path.get())
+
+
+def read_precomputed_info(path:str) -> dict:
+    """
+    Read the Neuroglancer "info" file of a precomputed volume
+
+    :param path: the path to the precomputed volume's directory
+    :return: the info file's contents or an empty dictionary if the
+    volume has no readable info file.
+    """
+    info_path = os.path.join(path, "info")
+    if not os.path.exists(info_path):
+        return {}
+    try:
+        with open(info_path) as fd:
+            return json.load(fd)
+    except ValueError:
+        return {}
+
+
+def precomputed_level_shapes(path:str) -> \
+        typing.Dict[int, typing.Tuple[int, int, int]]:
+    """
+    Get the shapes of the levels of a precomputed volume from its info file
+
+    :param path: the path to the precomputed volume's directory
+    :return: a dictionary of level (1, 2, 4...) to the z, y, x shape of
+    the volume at that level.
+    """
+    shapes = {}
+    for scale in read_precomputed_info(path).get("scales", []):
+        level = int(scale["key"].split("_")[0])
+        x, y, z = scale["size"]
+        shapes[level] = (z, y, x)
+    return shapes
+
+
+def neuroglancer_path_is_valid(path:str) -> bool:
+    """
+    Return True if the path is a precomputed volume whose pyramid has been
+    written. The coarsest level is written last, so the volume is complete
+    if that level exists.
+
+    :param path: the path to the precomputed volume's directory
+    """
+    scales = read_precomputed_info(path).get("scales", [])
+    if len(scales) == 0:
+        return False
     return os.path.exists(
-        os.path.join(model.fixed_precomputed_path.get(),
-                     "2_2_2", "precomputed.blockfs"))
+        os.path.join(path, scales[-1]["key"], "precomputed.blockfs"))
+
+
+def parameters_path(dest_path:str) -> str:
+    """
+    The path to the file recording the parameters an output was made with
+
+    :param dest_path: the path to the output
+    """
+    return dest_path + ".parameters"
+
+
+def parameters_digest(parameters:dict) -> str:
+    """
+    A hash of a step's parameters
+
+    :param parameters: the parameters by name. The values must be
+    JSON-serializable.
+    """
+    return hashlib.md5(json.dumps(parameters, sort_keys=True)
+                       .encode("utf-8")).hexdigest()
+
+
+def write_parameters(dest_paths:typing.Sequence[str], parameters:dict):
+    """
+    Record the parameters that a step's outputs were made with
+
+    :param dest_paths: the paths to the step's outputs
+    :param parameters: the step's parameters by name
+    """
+    digest = parameters_digest(parameters)
+    for dest_path in dest_paths:
+        if os.path.exists(dest_path):
+            with open(parameters_path(dest_path), "w") as fd:
+                json.dump(dict(digest=digest, parameters=parameters), fd,
+                          indent=2, sort_keys=True)
+
+
+def read_parameters_digest(dest_path:str) -> typing.Optional[str]:
+    """
+    The digest of the parameters an output was made with or None if they
+    weren't recorded
+
+    :param dest_path: the path to the output
+    """
+    try:
+        with open(parameters_path(dest_path)) as fd:
+            return json.load(fd).get("digest")
+    except (OSError, ValueError):
+        return None
+
+
+def is_stale(dest_paths:typing.Sequence[str],
+             src_paths:typing.Sequence[str],
+             parameters:dict=None) -> bool:
+    """
+    Decide whether a step has to be run to make its outputs
+
+    :param dest_paths: the paths to the step's outputs
+    :param src_paths: the paths to the step's inputs
+    :param parameters: the step's current parameters, if the outputs should
+    be considered stale when they were made with other parameters (see
+    write_parameters)
+    :return: True if any output is missing, is older than any input or was
+    made with different parameters
+    """
+    if not all([os.path.exists(_) for _ in dest_paths]):
+        return True
+    if parameters is not None:
+        digest = parameters_digest(parameters)
+        if any([read_parameters_digest(_) != digest for _ in dest_paths]):
+            return True
+    src_mtimes = [os.path.getmtime(_) for _ in src_paths if os.path.exists(_)]
+    if len(src_mtimes) == 0:
+        return False
+    return min([os.path.getmtime(_) for _ in dest_paths]) < max(src_mtimes)
+
+
+def choose_n_levels(shape:typing.Sequence[int], min_n_levels=1) -> int:
+    """
+    Choose the number of levels of a precomputed pyramid. The pyramid has to
+    reach a level that is small enough for the rough alignment and for the
+    rigid alignment preview, but there is no point in going further.
+
+    :param shape: the shape of the full-resolution volume
+    :param min_n_levels: make at least this many levels, e.g. so that the
+    pyramid reaches the Neuroglancer alignment's decimation level.
+    :return: the number of levels, including the full-resolution one.
+    """
+    n_levels = 1
+    while n_levels < MAX_N_PRECOMPUTED_LEVELS:
+        resolution = 2 ** (n_levels - 1)
+        level_shape = [(_ + resolution - 1) // resolution for _ in shape]
+        if min(level_shape) < ROUGH_ALIGNMENT_MAX_MIN_DIMENSION and \
+                max(level_shape) < ROUGH_ALIGNMENT_MAX_DIMENSION and \
+                max(level_shape) <= PREVIEW_MAX_DIMENSION:
+            break
+        n_levels += 1
+    return min(MAX_N_PRECOMPUTED_LEVELS, max(n_levels, min_n_levels))
+
+
+def choose_registration_level(
+        shapes:typing.Dict[int, typing.Sequence[int]],
+        voxel_size:typing.Sequence[float],
+        n_workers:int) -> int:
+    """
+    Choose the pyramid level for the rough alignment
+
+    The level is the coarsest one that is sampled at least as finely as the
+    target spacing along every axis, as long as it is within the voxel
+    budget for the number of workers. If no level within the budget is that
+    fine, the finest level within the budget is used, and if no level is
+    within the budget, the coarsest level is used.
+
+    :param shapes: the z, y, x shape of each level, e.g. from
+    precomputed_level_shapes
+    :param voxel_size: the x, y, z size of a voxel at level 1, in microns
+    :param n_workers: the number of cores available for the registration
+    :return: the level, e.g. 1, 2, 4...
+    """
+    levels = sorted(shapes)
+    if len(levels) == 0:
+        raise ValueError("The volume has no levels")
+    budget = min(ROUGH_ALIGNMENT_MAX_VOXELS,
+                 ROUGH_ALIGNMENT_VOXELS_PER_WORKER * max(1, n_workers))
+    affordable = [level for level in levels
+                  if np.prod(shapes[level], dtype=float) <= budget]
+    if len(affordable) == 0:
+        return levels[-1]
+    fine_enough = [level for level in affordable
+                   if max(voxel_size) * level <= ROUGH_ALIGNMENT_TARGET_SPACING]
+    if len(fine_enough) == 0:
+        return affordable[0]
+    return fine_enough[-1]
+
+
+def choose_display_level(
+        shapes:typing.Dict[int, typing.Sequence[int]],
+        canvas_shape:typing.Sequence[int]) -> int:
+    """
+    Choose the pyramid level for displaying a volume in a canvas
+
+    :param shapes: the z, y, x shape of each level, e.g. from
+    precomputed_level_shapes
+    :param canvas_shape: the height and width of the canvas
+    :return: the finest level whose y or x extent is less than half of the
+    canvas's or the coarsest level if none are.
+    """
+    levels = sorted(shapes)
+    if len(levels) == 0:
+        raise ValueError("The volume has no levels")
+    for level in levels:
+        shape = shapes[level]
+        if shape[1] < canvas_shape[0] // 2 or shape[2] < canvas_shape[1] // 2:
+            return level
+    return levels[-1]
 
 
 class WSGIServer(gunicorn.app.base.BaseApplication):
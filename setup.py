@@ -25,7 +25,9 @@ setup(
     author="Kwanghun Chung Lab",
     packages=["multiround_alignment_ui"],
     entry_points={ 'console_scripts': [
-        "multiround-alignment-ui=multiround_alignment_ui.main:main"
+        "multiround-alignment-ui=multiround_alignment_ui.main:main",
+        "multiround-alignment-convert-interpolator="
+        "multiround_alignment_ui.transform_format:main"
     ]},
     url="https://github.com/chunglabmit/multiround-alignment-ui",
     license="MIT",
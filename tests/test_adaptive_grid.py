@@ -0,0 +1,28 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("phathom")
+pytest.importorskip("precomputed_tif")
+
+
+def test_chooses_points_near_cell_centers():
+    from multiround_alignment_ui.adaptive_grid import \
+        choose_correlation_points
+    mask = np.ones((1, 10, 10), bool)
+    #
+    # Two points in each of the four cells of a 2 x 2 x 1 grid: one near
+    # the cell's center and one near its corner
+    #
+    centers = np.array([[2.5, 2.5, .5], [7.5, 2.5, .5],
+                        [2.5, 7.5, .5], [7.5, 7.5, .5]])
+    coords = np.vstack([centers + [.1, .1, 0], centers - [2.4, 2.4, 0]])
+    chosen = choose_correlation_points(coords, mask, 1, (2, 2, 1), 100)
+    np.testing.assert_array_equal(chosen, [0, 1, 2, 3])
+
+
+def test_correlation_grid_refines():
+    from multiround_alignment_ui.adaptive_grid import correlation_grid, \
+        REFINE_FACTOR
+    assert correlation_grid((10, 20, 5)) == \
+        [10 * REFINE_FACTOR, 20 * REFINE_FACTOR, 5 * REFINE_FACTOR]
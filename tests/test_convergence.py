@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("phathom")
+
+
+def test_transform_change_keeps_going():
+    from multiround_alignment_ui.convergence import RoundStatistics, \
+        has_converged
+    #
+    # The transform fits its matches, but it is still moving
+    #
+    statistics = RoundStatistics(1000, .5, 1.5, 10.0)
+    assert not has_converged(statistics, 1.0, 2.0)
+    assert has_converged(statistics, 1.0, 2.0, require_both=False)
+
+
+def test_residual_keeps_going():
+    from multiround_alignment_ui.convergence import RoundStatistics, \
+        has_converged
+    statistics = RoundStatistics(1000, 5.0, 10.0, .1)
+    assert not has_converged(statistics, 1.0, 2.0)
+    assert has_converged(statistics, 1.0, 2.0, require_both=False)
+
+
+def test_converged():
+    from multiround_alignment_ui.convergence import RoundStatistics, \
+        has_converged
+    statistics = RoundStatistics(1000, .5, 1.5, .1)
+    assert has_converged(statistics, 1.0, 2.0)
@@ -0,0 +1,72 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("matplotlib")
+pytest.importorskip("phathom")
+
+
+def test_preview_count_matches_filter_output(tmpdir):
+    from multiround_alignment_ui.match_coherence import count_passing, \
+        displacement_coherence, passing_matches, write_filtered_matches
+    random_state = np.random.RandomState(1234)
+    fixed = random_state.uniform(0, 1000, (200, 3))
+    displacements = np.array([5.0, -2.0, 1.0]) + \
+        random_state.normal(0, 1, (200, 3))
+    #
+    # A quarter of the matches are false
+    #
+    displacements[::4] = random_state.uniform(-50, 50, (50, 3))
+    moving = fixed + displacements
+    find_neighbors_path = os.path.join(str(tmpdir), "find-neighbors.json")
+    output_path = os.path.join(str(tmpdir), "filter-matches.json")
+    with open(find_neighbors_path, "w") as fd:
+        json.dump(dict(fixed=fixed.tolist(), moving=moving.tolist(),
+                       score=random_state.uniform(size=200).tolist(),
+                       voxel_size=[1.8, 1.8, 2.0]), fd)
+    distance = np.linalg.norm(displacements, axis=1)
+    coherence = displacement_coherence(fixed, displacements)
+    for max_distance, min_coherence in ((10, .5), (20, .9), (100, -1)):
+        n_passing = count_passing(distance, coherence, max_distance,
+                                  min_coherence)
+        n_written = write_filtered_matches(
+            find_neighbors_path, output_path,
+            passing_matches(distance, coherence, max_distance,
+                            min_coherence))
+        with open(output_path) as fd:
+            filtered = json.load(fd)
+        assert n_written == n_passing
+        assert len(filtered["fixed"]) == n_passing
+        assert len(filtered["moving"]) == n_passing
+        assert len(filtered["score"]) == n_passing
+        assert filtered["voxel_size"] == [1.8, 1.8, 2.0]
+
+
+def test_coherence_of_fitted_residuals():
+    from multiround_alignment_ui.match_coherence import \
+        displacement_coherence
+    #
+    # After a fit, the residuals of the true matches are small noise around
+    # zero; the false matches still stand out.
+    #
+    random_state = np.random.RandomState(1234)
+    fixed = random_state.uniform(0, 1000, (400, 3))
+    residuals = random_state.normal(0, .05, (400, 3))
+    outliers = np.arange(0, 400, 20)
+    residuals[outliers] = random_state.uniform(3, 5, (len(outliers), 3))
+    coherence = displacement_coherence(fixed, residuals, noise=.01)
+    inliers = np.setdiff1d(np.arange(400), outliers)
+    assert np.mean(coherence[inliers] >= 1 / 3) > .9
+    assert np.all(coherence[outliers] < 1 / 3)
+
+
+def test_coherence_of_exact_fit():
+    from multiround_alignment_ui.match_coherence import \
+        displacement_coherence
+    random_state = np.random.RandomState(1234)
+    fixed = random_state.uniform(0, 1000, (50, 3))
+    coherence = displacement_coherence(fixed, np.zeros((50, 3)))
+    np.testing.assert_array_equal(coherence, 1)
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def model(qapp):
+    from multiround_alignment_ui.model import Model
+    return Model()
+
+
+def hook_derived_paths(model):
+    """Derive paths from the output path, as the widgets do"""
+    def on_output_path_changed(value):
+        with model.batch():
+            model.fixed_precomputed_path.set(
+                os.path.join(value, "fixed_precomputed"))
+            model.alignment_output_paths[0].set(
+                os.path.join(value, "moving_warped"))
+    model.output_path.register_callback("test", on_output_path_changed)
+
+
+def test_batch_fires_once(model):
+    values = []
+    model.output_path.register_callback("test", values.append)
+    with model.batch():
+        model.output_path.set("/a")
+        model.output_path.set("/b")
+        assert values == []
+    assert values == ["/b"]
+
+
+def test_batch_unchanged_does_not_fire(model):
+    values = []
+    model.output_path.set("/a")
+    model.output_path.register_callback("test", values.append)
+    with model.batch():
+        model.output_path.set("/b")
+        model.output_path.set("/a")
+    assert values == []
+
+
+def test_derived_paths_follow_output_path(model):
+    hook_derived_paths(model)
+    model.output_path.set("/data")
+    assert model.fixed_precomputed_path.get() == "/data/fixed_precomputed"
+
+
+def test_read_keeps_saved_paths(model, tmpdir):
+    from multiround_alignment_ui.model import Model
+    session_path = os.path.join(str(tmpdir), "session.json")
+    model.output_path.set("/data")
+    model.fixed_precomputed_path.set("/elsewhere/fixed")
+    model.alignment_output_paths[0].set("/elsewhere/warped")
+    model.write(session_path)
+
+    other = Model()
+    hook_derived_paths(other)
+    other.read(session_path)
+    assert other.output_path.get() == "/data"
+    assert other.fixed_precomputed_path.get() == "/elsewhere/fixed"
+    assert other.alignment_output_paths[0].get() == "/elsewhere/warped"
+    #
+    # The paths are derived again when the output path changes after reading
+    #
+    other.output_path.set("/other")
+    assert other.fixed_precomputed_path.get() == "/other/fixed_precomputed"
+
+
+def test_read_keeps_saved_paths_with_widget_hooks(model, tmpdir):
+    pytest.importorskip("phathom")
+    pytest.importorskip("precomputed_tif")
+    pytest.importorskip("blockfs")
+    from multiround_alignment_ui.model import Model
+    from multiround_alignment_ui.preprocessing import \
+        hook_src_path_to_precomputed_path
+    session_path = os.path.join(str(tmpdir), "session.json")
+    model.output_path.set("/data")
+    model.fixed_stack_path.set("/stacks/fixed")
+    model.fixed_precomputed_path.set("/elsewhere/fixed")
+    model.write(session_path)
+
+    other = Model()
+    hook_src_path_to_precomputed_path(
+        other, other.fixed_stack_path, other.fixed_precomputed_path)
+    other.read(session_path)
+    assert other.fixed_stack_path.get() == "/stacks/fixed"
+    assert other.fixed_precomputed_path.get() == "/elsewhere/fixed"
+
+
+def test_batches_are_per_model(model):
+    from multiround_alignment_ui.model import Model
+    other = Model()
+    values = []
+    other.output_path.register_callback("test", values.append)
+    with model.batch():
+        other.output_path.set("/a")
+        assert values == ["/a"]
+    #
+    # Appended variables join their model's batch
+    #
+    model.alignment_output_paths.append(type(model.output_path)(""))
+    with model.batch():
+        model.alignment_output_paths[-1].register_callback(
+            "test", values.append)
+        model.alignment_output_paths[-1].set("/b")
+        assert values == ["/a"]
+    assert values == ["/a", "/b"]
@@ -0,0 +1,27 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("phathom")
+
+
+def test_load_after_nuggt_edit(tmpdir):
+    from multiround_alignment_ui.nuggt_points import NuggtPoints
+    path = os.path.join(str(tmpdir), "points.json")
+    points = NuggtPoints([[1, 2, 3]], [[4, 5, 6]])
+    assert points.save(path)
+    assert not points.save(path)
+    np.testing.assert_array_equal(NuggtPoints.load(path).moving, [[4, 5, 6]])
+    #
+    # nuggt-align rewrites the JSON file when the user moves a point
+    #
+    with open(path, "w") as fd:
+        json.dump(dict(reference=[[1, 2, 3]], moving=[[7, 8, 9]]), fd)
+    np.testing.assert_array_equal(NuggtPoints.load(path).moving, [[7, 8, 9]])
+    #
+    # Saving the old points again overwrites the user's edit
+    #
+    assert points.save(path)
+    np.testing.assert_array_equal(NuggtPoints.load(path).moving, [[4, 5, 6]])
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tifffile = pytest.importorskip("tifffile")
+pytest.importorskip("phathom")
+pytest.importorskip("precomputed_tif")
+pytest.importorskip("blockfs")
+
+
+def write_stack(path, n_planes):
+    os.makedirs(path)
+    for z in range(n_planes):
+        tifffile.imwrite(os.path.join(path, "img_%04d.tiff" % z),
+                         np.zeros((16, 16), np.uint16))
+
+
+def test_count_files(tmpdir):
+    from multiround_alignment_ui.preprocessing import count_files
+    stack_path = os.path.join(str(tmpdir), "stack")
+    write_stack(stack_path, 3)
+    assert count_files(stack_path) == 3
+    assert count_files(os.path.join(str(tmpdir), "missing")) == 0
+
+
+def test_dest_change(qapp, tmpdir):
+    from multiround_alignment_ui.model import Model
+    from multiround_alignment_ui.preprocessing import PreprocessingChannel
+    model = Model()
+    stack_path = os.path.join(str(tmpdir), "fixed")
+    write_stack(stack_path, 2)
+    model.output_path.set(str(tmpdir))
+    channel = PreprocessingChannel(model,
+                                   model.fixed_stack_path,
+                                   model.fixed_precomputed_path,
+                                   "Fixed")
+    assert channel.src_file_count == 0
+    model.fixed_stack_path.set(stack_path)
+    model.fixed_precomputed_path.set(
+        os.path.join(str(tmpdir), "fixed_precomputed"))
+    assert channel.src_file_count == 2
+    assert "(2 files)" in channel.source_widget.text()
+    assert "Not done" in channel.precomputed_widget.text()
+    assert channel.precomputed_button.isEnabled()
+
+
+def test_split_cores():
+    from multiround_alignment_ui.preprocessing import split_cores
+    assert split_cores(1) == (1, 1)
+    assert split_cores(8) == (4, 4)
+    assert split_cores(5) == (2, 3)
+
+
+def test_build_steps(tmpdir):
+    from multiround_alignment_ui.preprocessing import PrecomputedBuild
+    stack_path = os.path.join(str(tmpdir), "stack")
+    write_stack(stack_path, 70)
+    build = PrecomputedBuild(stack_path,
+                             os.path.join(str(tmpdir), "precomputed"),
+                             n_levels=3, n_cores=1)
+    # Two slabs of level 1 and three levels
+    assert build.n_steps() == 5
+    assert build.n_steps_to_build() == 5
+    assert build.n_recorded_steps() == 0
@@ -0,0 +1,76 @@
+import os
+import pickle
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+
+def test_write_read_transform(tmpdir):
+    from multiround_alignment_ui.transform_format import read_transform, \
+        write_transform
+    path = os.path.join(str(tmpdir), "test.xform")
+    a = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    b = np.array([1, 2, 3], ">i8")
+    write_transform(path, "test", dict(a=a, b=b, c=np.zeros((0, 3))),
+                    dict(spacing=[1, 2, 3]))
+    transform_type, attributes, arrays = read_transform(path)
+    assert transform_type == "test"
+    assert attributes == dict(spacing=[1, 2, 3])
+    np.testing.assert_array_equal(arrays["a"], a)
+    np.testing.assert_array_equal(arrays["b"], b)
+    assert arrays["c"].shape == (0, 3)
+
+
+def test_refuses_other_classes():
+    from multiround_alignment_ui.transform_format import decode_state, \
+        encode_state
+    for name in ("builtins:object", "os:system",
+                 "collections:OrderedDict"):
+        with pytest.raises(ValueError):
+            decode_state(dict(object=name, state=dict(dict={})), {})
+
+    class NotAnInterpolator:
+        def __init__(self):
+            self.x = 1
+    with pytest.raises(ValueError):
+        encode_state(NotAnInterpolator(), {})
+
+
+def test_convert_interpolator(tmpdir):
+    pytest.importorskip("scipy")
+    from scipy.interpolate import RegularGridInterpolator
+    from multiround_alignment_ui.transform_format import \
+        convert_interpolator, load_interpolator
+    axes = [np.linspace(0, 10, 5)] * 3
+    values = np.random.RandomState(0).uniform(size=(5, 5, 5))
+    interpolator = RegularGridInterpolator(axes, values)
+    pickle_path = os.path.join(str(tmpdir), "interpolator.pkl")
+    with open(pickle_path, "wb") as fd:
+        pickle.dump(interpolator, fd)
+    convert_interpolator(pickle_path)
+    loaded = load_interpolator(pickle_path)
+    points = np.random.RandomState(1).uniform(0, 10, (20, 3))
+    np.testing.assert_allclose(loaded(points), interpolator(points))
+
+
+def test_convert_rbf(tmpdir):
+    pytest.importorskip("scipy")
+    from scipy.interpolate import Rbf
+    from multiround_alignment_ui.transform_format import \
+        binary_interpolator_attributes, convert_interpolator, \
+        load_interpolator
+    random_state = np.random.RandomState(0)
+    x, y, z = random_state.uniform(0, 10, (3, 20))
+    values = random_state.uniform(size=20)
+    interpolator = Rbf(x, y, z, values, function="thin_plate", smooth=.1)
+    pickle_path = os.path.join(str(tmpdir), "interpolator.pkl")
+    with open(pickle_path, "wb") as fd:
+        pickle.dump(dict(interpolator=interpolator), fd)
+    convert_interpolator(pickle_path, check=lambda rebuilt: True)
+    assert binary_interpolator_attributes(pickle_path)["checked"]
+    loaded = load_interpolator(pickle_path)["interpolator"]
+    assert type(loaded) is Rbf
+    points = random_state.uniform(0, 10, (3, 10))
+    np.testing.assert_allclose(loaded(*points), interpolator(*points))
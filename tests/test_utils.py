@@ -0,0 +1,44 @@
+import os
+import time
+
+import pytest
+
+for module in ("numpy", "PyQt5", "gunicorn", "neuroglancer", "precomputed_tif",
+               "tqdm"):
+    pytest.importorskip(module)
+
+
+def touch(path, mtime):
+    with open(path, "w") as fd:
+        fd.write(path)
+    os.utime(path, (mtime, mtime))
+
+
+def test_is_stale_mtime(tmpdir):
+    from multiround_alignment_ui.utils import is_stale
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    now = time.time()
+    touch(src, now - 10)
+    assert is_stale([dest], [src])
+    touch(dest, now)
+    assert not is_stale([dest], [src])
+    touch(src, now + 10)
+    assert is_stale([dest], [src])
+
+
+def test_is_stale_parameters(tmpdir):
+    from multiround_alignment_ui.utils import is_stale, write_parameters
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    now = time.time()
+    touch(src, now - 10)
+    touch(dest, now)
+    #
+    # Outputs made before the parameters were recorded are stale
+    #
+    assert is_stale([dest], [src], dict(radius=10))
+    write_parameters([dest], dict(radius=10, sigma=2.0))
+    assert not is_stale([dest], [src], dict(sigma=2.0, radius=10))
+    assert is_stale([dest], [src], dict(radius=20, sigma=2.0))
+    assert not is_stale([dest], [src])